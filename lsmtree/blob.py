@@ -0,0 +1,89 @@
+"""
+Key value separation for large values. Values over the memtable's
+`blob_threshold` are written to append only blob files when they're flushed and
+the segment only stores a small pointer to them. Compactions then only copy the
+pointers around instead of the values.
+
+Blob files are garbage collected as part of compaction. The manifest keeps
+track of how many bytes of each blob file are no longer referenced and live
+values in blob files that are mostly garbage are moved into the compaction's
+own blob file. A blob file is removed once no live segment points into it.
+"""
+import os
+from struct import pack, unpack
+
+from .segment import KIND_BLOB, KIND_VALUE, Block
+from .settings import BLOCK_COMPRESSION
+
+# blob file id, offset of the record in the file and the size of the record
+POINTER_FMT = "<QQQ"
+
+
+def pack_pointer(blob_id, offset, size):
+    return pack(POINTER_FMT, blob_id, offset, size)
+
+
+def unpack_pointer(pointer):
+    return unpack(POINTER_FMT, pointer)
+
+
+def read_blob(db_dir, pointer):
+    blob_id, offset, size = unpack_pointer(pointer)
+    with open(BlobFile.path_for(db_dir, blob_id), "rb") as f:
+        f.seek(offset)
+        raw_block = f.read(size)
+    return next(Block.iter_from_binary(raw_block))[1]
+
+
+def separate_values(entries, blob_file, threshold):
+    """
+    Moves the values of `(key, seq, kind, value)` entries that are larger than
+    `threshold` into `blob_file` and yields the entries with a pointer to them
+    instead.
+    """
+    for key, seq, kind, value in entries:
+        if kind == KIND_VALUE and len(value) > threshold:
+            value = blob_file.add(key, value)
+            kind = KIND_BLOB
+        yield key, seq, kind, value
+
+
+class BlobFile:
+    """
+    Writes values to a blob file. Each value is stored as a block of its own
+    (so it's checksummed and compressed like any other block) along with its
+    key. Nothing is synced to disk until the file is closed.
+    """
+
+    def __init__(self, id, db_dir, compress=BLOCK_COMPRESSION):
+        self.id = id
+        self.path = self.path_for(db_dir, id)
+        self.compress = compress
+        self.file = None
+        self.size = 0
+
+    @staticmethod
+    def path_for(db_dir, blob_id):
+        return os.path.join(db_dir, f"blob.{blob_id}")
+
+    def add(self, key, value):
+        if self.file is None:
+            self.file = open(self.path, "ab")
+            self.size = self.file.tell()
+
+        block = Block()
+        block.add(key, value)
+        data = block.dump(compress=self.compress)
+        offset = self.size
+        self.file.write(data)
+        self.size += len(data)
+        return pack_pointer(self.id, offset, len(data))
+
+    def close(self):
+        if self.file is None:
+            return
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
@@ -0,0 +1,106 @@
+"""
+Size bounded LRU caches shared by the segments of a memtable.
+"""
+from collections import OrderedDict
+from threading import Lock
+
+
+class BlockCache:
+    """
+    Caches blocks (or anything decoded from them) keyed by `(segment, offset)`.
+    Every entry is charged a size in bytes and the least recently used entries
+    are evicted once the total goes over `capacity`.
+    """
+
+    def __init__(self, capacity, name="block", stats=None, listeners=None):
+        self.capacity = capacity
+        self.name = name
+        self.stats = stats
+        self.listeners = listeners if listeners is not None else []
+        self.usage = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is None:
+            if self.stats is not None:
+                self.stats.incr(f"{self.name}_cache.misses")
+            for listener in self.listeners:
+                listener.on_cache_miss(self.name, key)
+            return None
+
+        if self.stats is not None:
+            self.stats.incr(f"{self.name}_cache.hits")
+        for listener in self.listeners:
+            listener.on_cache_hit(self.name, key)
+        return entry[0]
+
+    def put(self, key, value, charge):
+        if charge > self.capacity:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.usage -= previous[1]
+
+            self._entries[key] = (value, charge)
+            self.usage += charge
+            self._evict(self.capacity)
+
+    def evict_segment(self, segment):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == segment]:
+                self.usage -= self._entries.pop(key)[1]
+
+    def shrink(self, capacity):
+        """
+        Evicts entries until the cache uses at most `capacity` bytes.
+        """
+        with self._lock:
+            self._evict(capacity)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.usage = 0
+
+    def _evict(self, capacity):
+        while self.usage > capacity and self._entries:
+            _, (_, charge) = self._entries.popitem(last=False)
+            self.usage -= charge
+
+
+class RowCache(BlockCache):
+    """
+    Caches what a point lookup found in the segment files, keyed by the key:
+    its value, or a TOMBSTONE when the segments don't have it. Compaction
+    doesn't change what a lookup finds so entries only have to be evicted when
+    a flush adds newer versions of their keys.
+    """
+
+    def __init__(self, capacity, stats=None, listeners=None):
+        super().__init__(capacity, name="row", stats=stats, listeners=listeners)
+
+    def evict_keys(self, keys):
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self.usage -= entry[1]
+
+    def evict_range(self, start, end):
+        """
+        Evicts the keys with `start <= key < end`.
+        """
+        with self._lock:
+            for key in [key for key in self._entries if start <= key < end]:
+                self.usage -= self._entries.pop(key)[1]
@@ -0,0 +1,171 @@
+"""
+Checkpoints and incremental backups. Segment and blob files are never changed
+once written, so a consistent copy of a database only needs a flush, links to
+(or copies of) the live files and a manifest listing them.
+
+A checkpoint hard links the files into a new directory, which takes about as
+long as the flush does and doesn't take up more space until compaction
+replaces the files in the database. The linked files stay around for as long
+as the checkpoint does, whatever compaction does to the database.
+
+A backup directory holds any number of backups. Every backup is a checkpoint
+of which only the files the backup directory doesn't have yet are copied, so a
+backup only copies the segments added since the previous one.
+
+    backup_dir/
+        segment.N, blob.N   files shared by the backups
+        backup.N/           the manifest of each backup
+"""
+import os
+import shutil
+
+from .manifest import Manifest
+from .segment import fsync_dir, list_segments
+
+BACKUP_PREFIX = "backup"
+
+
+def live_files(manifest):
+    return [f"segment.{segment_id}" for segment_id in manifest.live_ids()] + [
+        f"blob.{blob_id}" for blob_id in manifest.blob_files
+    ]
+
+
+def create_checkpoint(memtable, path):
+    """
+    Flushes the memtable and creates a checkpoint of its database in `path`,
+    which must not exist yet. The checkpoint can be opened like any other
+    database directory. Files are copied instead when `path` is on another
+    file system.
+    """
+    os.makedirs(path)
+    # Only held for the flush and to pick the files. Compaction can go ahead
+    # while they're linked or copied, the pinned files stay until that's done.
+    with memtable.sparse_index_lock:
+        memtable.flush_tree()
+        names = live_files(memtable.manifest)
+        memtable.manifest.write_snapshot(path)
+        memtable.pin_files(names)
+
+    try:
+        for name in names:
+            link_or_copy(os.path.join(memtable.db_dir, name), os.path.join(path, name))
+    finally:
+        memtable.unpin_files(names)
+    fsync_dir(path)
+    memtable.statistics.incr("checkpoint.count")
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy_file(src, dst)
+
+
+def copy_file(src, dst):
+    """
+    Copies `src` to `dst` through a temporary file so `dst` only ever exists
+    once it's complete.
+    """
+    tmp = f"{dst}.tmp"
+    shutil.copyfile(src, tmp)
+    with open(tmp, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, dst)
+
+
+def create_backup(memtable, backup_dir):
+    """
+    Backs up the memtable's database to `backup_dir`, copying only the files
+    earlier backups haven't already. Returns the id of the backup.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    backup_id = max(list_backups(backup_dir), default=-1) + 1
+    # A checkpoint keeps the files around while they're copied, without
+    # holding up writes or compaction
+    staging = os.path.join(memtable.db_dir, f"_{BACKUP_PREFIX}.{backup_id}")
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    create_checkpoint(memtable, staging)
+
+    try:
+        copied = 0
+        for name in live_files(Manifest(staging)):
+            dst = os.path.join(backup_dir, name)
+            if not os.path.exists(dst):
+                copy_file(os.path.join(staging, name), dst)
+                copied += os.path.getsize(dst)
+        fsync_dir(backup_dir)
+
+        manifest_dir = os.path.join(backup_dir, f"{BACKUP_PREFIX}.{backup_id}")
+        os.makedirs(manifest_dir)
+        copy_file(
+            os.path.join(staging, "manifest.log"),
+            os.path.join(manifest_dir, "manifest.log"),
+        )
+        fsync_dir(manifest_dir)
+        fsync_dir(backup_dir)
+    finally:
+        shutil.rmtree(staging)
+
+    memtable.statistics.incr("backup.bytes_copied", copied)
+    return backup_id
+
+
+def list_backups(backup_dir):
+    """
+    The ids of the complete backups in `backup_dir`, oldest first.
+    """
+    backup_ids = []
+    for name in os.listdir(backup_dir):
+        prefix, _, backup_id = name.partition(".")
+        if (
+            prefix == BACKUP_PREFIX
+            and backup_id.isnumeric()
+            and os.path.exists(os.path.join(backup_dir, name, "manifest.log"))
+        ):
+            backup_ids.append(int(backup_id))
+    return sorted(backup_ids)
+
+
+def restore_backup(backup_dir, db_dir, backup_id=None):
+    """
+    Restores a backup (the latest one by default) to `db_dir`, which must not
+    exist yet.
+    """
+    if backup_id is None:
+        backup_id = list_backups(backup_dir)[-1]
+    manifest_dir = os.path.join(backup_dir, f"{BACKUP_PREFIX}.{backup_id}")
+
+    os.makedirs(db_dir)
+    for name in live_files(Manifest(manifest_dir)):
+        copy_file(os.path.join(backup_dir, name), os.path.join(db_dir, name))
+    copy_file(
+        os.path.join(manifest_dir, "manifest.log"), os.path.join(db_dir, "manifest.log")
+    )
+    fsync_dir(db_dir)
+
+
+def purge_backups(backup_dir, keep):
+    """
+    Removes all but the newest `keep` backups along with the files only they
+    used.
+    """
+    backup_ids = list_backups(backup_dir)
+    removed, kept = backup_ids[: max(len(backup_ids) - keep, 0)], backup_ids[-keep:]
+    if not removed:
+        return
+
+    for backup_id in removed:
+        shutil.rmtree(os.path.join(backup_dir, f"{BACKUP_PREFIX}.{backup_id}"))
+
+    used = set()
+    for backup_id in kept:
+        manifest_dir = os.path.join(backup_dir, f"{BACKUP_PREFIX}.{backup_id}")
+        used.update(live_files(Manifest(manifest_dir)))
+    for fname in ("segment", "blob"):
+        for file_id in list_segments(backup_dir, fname=fname):
+            if f"{fname}.{file_id}" not in used:
+                os.remove(os.path.join(backup_dir, f"{fname}.{file_id}"))
+    fsync_dir(backup_dir)
@@ -0,0 +1,212 @@
+"""
+A client for `server.py`. It's thread safe and keeps a pool of connections to
+the server so threads don't have to wait on each other's requests.
+"""
+import itertools
+import queue
+import socket
+import threading
+from struct import pack
+
+from .protocol import (BATCH, DELETE, DELETE_RANGE, ERROR, GET, HEADER_SIZE,
+                       MULTI_GET, NOT_FOUND, PUT, SCAN, SCAN_LIMIT_FMT,
+                       pack_batch, pack_frame, pack_ttl, unpack_fields,
+                       unpack_header)
+from .settings import CLIENT_POOL_SIZE, SCAN_BATCH_SIZE
+
+
+class ServerError(Exception):
+    pass
+
+
+class Client:
+    """
+    Connects to the server at `address`, either a `(host, port)` tuple or the
+    path of a Unix domain socket. At most `pool_size` connections are opened,
+    they're only opened when needed and then reused.
+    """
+
+    def __init__(self, address, pool_size=CLIENT_POOL_SIZE, timeout=None):
+        self.address = address
+        self.timeout = timeout
+        self._pool = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def get(self, key):
+        value = self.request([(GET, [key])])[0]
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        self.delete(key)
+
+    def put(self, key, value, ttl=None):
+        self.request([(PUT, [key, value, pack_ttl(ttl)])])
+
+    def delete(self, key):
+        self.request([(DELETE, [key])])
+
+    def delete_range(self, start, end):
+        self.request([(DELETE_RANGE, [start, end])])
+
+    def multi_get(self, keys):
+        """
+        Returns the values of `keys` in the same order, None for the keys that
+        aren't set.
+        """
+        return self.request([(MULTI_GET, list(keys))])[0]
+
+    def write(self, batch):
+        """
+        Applies the writes of a `shard.WriteBatch` in order.
+        """
+        self.request([(BATCH, pack_batch(batch.ops))])
+
+    def scan(self, start=None, end=None, batch_size=SCAN_BATCH_SIZE):
+        """
+        Yields the `(key, value)` pairs with `start <= key < end` in key order,
+        fetching `batch_size` of them at a time. Unlike a local scan, every
+        batch reads the latest state of the database.
+        """
+        while True:
+            fields = self.request(
+                [(SCAN, [start, end, pack(SCAN_LIMIT_FMT, batch_size)])]
+            )[0]
+            pairs = list(zip(fields[::2], fields[1::2]))
+            yield from pairs
+            if len(pairs) < batch_size:
+                return
+            # The smallest key after the last one
+            start = pairs[-1][0] + b"\x00"
+
+    def pipeline(self):
+        return Pipeline(self)
+
+    def request(self, requests):
+        """
+        Sends `(op, fields)` requests on one connection without waiting for
+        the replies in between and returns the result of each. That's the
+        value for a get (None if not found), the fields of the response for
+        everything else. Raises a `ServerError` if any request failed.
+        """
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                conn = _Connection(self.address, self.timeout)
+
+            try:
+                responses = conn.request(requests)
+            except BaseException:
+                # The connection is in an unknown state, don't reuse it
+                conn.close()
+                raise
+            self._pool.put(conn)
+        finally:
+            self._slots.release()
+
+        results = []
+        for (op, _), (status, fields) in zip(requests, responses):
+            if status == ERROR:
+                raise ServerError(fields[0].decode())
+            if op == GET:
+                results.append(None if status == NOT_FOUND else fields[0])
+            else:
+                results.append(fields)
+        return results
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Pipeline:
+    """
+    Queues up requests and sends them all at once with `execute`, which returns
+    their results in order: the value (or None) for gets and `multi_get`s and
+    None for writes.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.requests = []
+
+    def get(self, key):
+        self.requests.append((GET, [key]))
+
+    def multi_get(self, keys):
+        self.requests.append((MULTI_GET, list(keys)))
+
+    def put(self, key, value, ttl=None):
+        self.requests.append((PUT, [key, value, pack_ttl(ttl)]))
+
+    def delete(self, key):
+        self.requests.append((DELETE, [key]))
+
+    def delete_range(self, start, end):
+        self.requests.append((DELETE_RANGE, [start, end]))
+
+    def execute(self):
+        requests, self.requests = self.requests, []
+        results = self.client.request(requests)
+        return [
+            result if op in (GET, MULTI_GET) else None
+            for (op, _), result in zip(requests, results)
+        ]
+
+
+class _Connection:
+    def __init__(self, address, timeout=None):
+        if isinstance(address, str):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        self.file = self.sock.makefile("rb")
+        self.ids = itertools.count()
+
+    def request(self, requests):
+        ids = []
+        frames = []
+        for op, fields in requests:
+            request_id = next(self.ids) & 0xFFFFFFFF
+            ids.append(request_id)
+            frames.append(pack_frame(request_id, op, fields))
+        self.sock.sendall(b"".join(frames))
+
+        responses = []
+        for request_id in ids:
+            length, response_id, status = unpack_header(self._read(HEADER_SIZE))
+            if response_id != request_id:
+                raise ServerError(f"Expected response {request_id}, got {response_id}")
+            responses.append((status, unpack_fields(self._read(length))))
+        return responses
+
+    def _read(self, size):
+        data = self.file.read(size)
+        if len(data) != size:
+            raise ConnectionError("Connection closed by the server")
+        return data
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
@@ -1,150 +1,346 @@
 """
 Performs background compaction on segment files.
 """
-import os
-import threading
 import time
+from collections import Counter
 
-from .memtable import TOMBSTONE, SparseIndex
-from .segment import Block, Segment, list_segments
-from .settings import BLOCK_COMPRESSION, BLOCK_SIZE
-
-_RUNNING = False
-_STOP_EVENT = threading.Event()
-
-
-def run_compactor(memtable, interval=1):
-    if _RUNNING:
-        return
-    compactor = Compactor(memtable, interval)
-    thread = threading.Thread(target=compactor.run, daemon=True)
-    thread.start()
-
-
-def stop_compactor():
-    _STOP_EVENT.set()
-    while _RUNNING:
-        pass
-    _STOP_EVENT.clear()
+from .blob import read_blob, unpack_pointer
+from .manifest import BlobMeta
+from .memtable import TOMBSTONE, expire, iter_versions
+from .segment import (KIND_BLOB, KIND_MERGE, KIND_RANGE_DELETE, Block, Segment,
+                      SegmentWriter, fsync_dir)
+from .settings import BLOB_GC_RATIO
+from .tombstones import RangeTombstones
 
 
 class Compactor:
-    def __init__(self, memtable, interval=1):
+    def __init__(
+        self,
+        memtable,
+        tombstone_ratio=None,
+        blob_gc_ratio=BLOB_GC_RATIO,
+    ):
         self.memtable = memtable
         self.db_dir = memtable.db_dir
-        self.interval = interval
+        if tombstone_ratio is None:
+            tombstone_ratio = memtable.tombstone_compaction_ratio
+        self.tombstone_ratio = tombstone_ratio
+        self.blob_gc_ratio = blob_gc_ratio
 
     def get_target_segments(self):
-        return sorted(list_segments(self.db_dir))[:2]
+        """
+        Picks two neighbouring segments to merge. That's the segment with the
+        most tombstones (if enough of its entries are tombstones) along with
+        the next older segment whose keys they delete, otherwise the oldest
+        two segments.
+        """
+        segments = self.memtable.manifest.segments
+        ids = [meta.id for meta in segments]
+
+        snapshots = self.memtable.snapshot_seqs()
+        dense = [
+            i
+            for i, meta in enumerate(segments)
+            if meta.tombstone_ratio >= self.tombstone_ratio
+            # a snapshot older than the tombstones would keep them around
+            and not any(s < meta.max_seq for s in snapshots)
+        ]
+        if len(segments) >= 2 and dense:
+            i = max(dense, key=lambda i: segments[i].tombstone_ratio)
+            self.memtable.statistics.incr("compaction.tombstone_triggered")
+            return ids[i - 1 : i + 1] if i else ids[:2]
+
+        return ids[:2]
 
     def compact(self):
         """
         Works as follows:
          - find the oldest two segment files
          - iteratively compact them by taking advantage of the fact that key
-           values are in sorted order within the segment files.
+           values are in sorted order within the segment files. Only the
+           newest version of a key and the versions live snapshots can still
+           see are kept. Without snapshots merge operands are merged into the
+           version below them. Versions deleted by a range tombstone are dropped.
+           Tombstones are only dropped when no older segment has the key, or
+           they would stop hiding its older versions. Values still in blob
+           files that are mostly garbage are moved to a new blob file.
+         - write the merged output to a new segment file
          - acquire a lock on the sparse_index
-         - remove the old files and replace with the new compacted one
-         - unlink the old sparse_index node and update it with the new one
+         - swap the old segments for the new one in the manifest and the
+           sparse_index list, then remove the old files
          - release the lock
         """
+        self.drop_expired_segments()
+        self.drop_deleted_segments()
+
+        # Flushes only add a segment to the manifest once it's fully written so
+        # there's no risk of picking up a segment that's still being written.
         targets = self.get_target_segments()
-        # The second part of this check makes sure we avoid a race condition where
-        # the memtable starts flushing to the newest segment and we pick it up for
-        # compaction before it is fully flushed. So we wait to flush it until the
-        # flush is complete (the sparse_index_counter has been incremented)
-        if len(targets) != 2 or max(targets) == self.memtable.sparse_index_counter:
+        if len(targets) != 2:
             return
 
-        with Segment(
-            id=max(targets), db_dir=self.db_dir, fname="_compact_segment"
-        ) as segment:
-            index = SparseIndex(entries=[], segment=segment.id)
-            block = Block()
-
-            for key, val in self.iter_smallest_kv_pair(*targets):
-                if val == TOMBSTONE:
-                    continue
-
-                block.add(key, val)
-                index.bloomfilter.add(key)
-
-                if len(block) > BLOCK_SIZE:
-                    bytes_written = segment.write(
-                        block.dump(compress=BLOCK_COMPRESSION)
-                    )
-                    eof_pos = segment.tell_eof
-                    index.add(block.key, (eof_pos - bytes_written, eof_pos))
-                    block = Block()
-
-            if block.data:
-                bytes_written = segment.write(block.dump(compress=BLOCK_COMPRESSION))
-                index.add(
-                    block.key, (segment.tell_eof - bytes_written, segment.tell_eof)
-                )
+        stats = self.memtable.statistics
+        start = time.perf_counter()
+        if self.memtable.listeners:
+            self.memtable.notify("on_compaction_begin", targets)
+
+        manifest = self.memtable.manifest
+        bytes_in = sum(manifest.get(i).size for i in targets)
+        stats.incr("compaction.bytes_in", bytes_in)
+
+        snapshots = self.memtable.snapshot_seqs()
+        now = self.memtable.clock()
+        with self.memtable.sparse_index_lock:
+            output = manifest.new_segment_id()
+            range_tombstones = RangeTombstones()
+            for index in self.memtable.iter_sparse_indexes():
+                if index.segment in targets:
+                    range_tombstones.extend(index.range_tombstones)
+            older = manifest.segments[: manifest.live_ids().index(targets[0])]
+
+            gc_blobs = {
+                meta.id
+                for meta in manifest.blob_files.values()
+                if meta.garbage_ratio >= self.blob_gc_ratio
+            }
+
+        blob_file = self.memtable.new_blob_file(output)
+        blob_garbage = Counter()
+        with SegmentWriter(output, self.db_dir, stats=stats) as segment:
+            index = self.memtable.write_segment(
+                segment,
+                self.iter_compacted_entries(
+                    targets,
+                    snapshots,
+                    now,
+                    range_tombstones,
+                    older,
+                    gc_blobs,
+                    blob_file,
+                    blob_garbage,
+                ),
+                range_tombstones=[
+                    (start, end, seq)
+                    for start, end, seq in range_tombstones
+                    if any(s < seq for s in snapshots)
+                    or any(meta.overlaps_range(start, end) for meta in older)
+                ],
+            )
+            bytes_out = segment.tell_eof
+            stats.incr("compaction.bytes_out", bytes_out)
+
+        blob_file.close()
+        add_blobs = []
+        if blob_file.size:
+            add_blobs.append(BlobMeta(blob_file.id, blob_file.size))
+            stats.incr("blob.gc_bytes", blob_file.size)
 
+        index.level = 1
+        fsync_dir(self.db_dir)
+
+        # Swapping the segments is a single manifest edit. If we crash before
+        # it's written the output is an orphan that's cleaned up on startup,
+        # after it the targets are.
         with self.memtable.sparse_index_lock:
-            for i in targets:
-                os.remove(os.path.join(self.db_dir, f"segment.{i}"))
+            self.memtable.install_segments(
+                add=[index],
+                remove=targets,
+                add_blobs=add_blobs,
+                blob_garbage=sorted(blob_garbage.items()),
+            )
+            self.memtable.remove_segment_files(targets)
 
-            os.rename(
-                os.path.join(self.db_dir, f"_compact_segment.{max(targets)}"),
-                os.path.join(self.db_dir, f"segment.{max(targets)}"),
+        duration = time.perf_counter() - start
+        stats.incr("compaction.count")
+        stats.record_time("compaction", duration)
+        if self.memtable.listeners:
+            self.memtable.notify(
+                "on_compaction_end",
+                targets,
+                index.segment,
+                bytes_in,
+                bytes_out,
+                duration,
             )
 
-            previous_index = None
-            sparse_index = self.memtable.sparse_index
-            while sparse_index:
-                if sparse_index.segment == index.segment:
-                    if previous_index is None:
-                        self.memtable.sparse_index = index
-                    else:
-                        previous_index.next = index
-                    break
-                previous_index = sparse_index
-                sparse_index = sparse_index.next
+    def iter_compacted_entries(
+        self,
+        targets,
+        snapshots,
+        now,
+        range_tombstones,
+        older,
+        gc_blobs,
+        blob_file,
+        blob_garbage,
+    ):
+        """
+        Yields the `(key, seq, kind, value)` entries of the merged targets that
+        are still needed. The size of every blob that's no longer pointed to is
+        added to `blob_garbage` and live blobs in `gc_blobs` are moved to
+        `blob_file`.
+        """
+        collapse = self.memtable.merge_operator is not None and not snapshots
+        for key, versions in self.iter_merged_versions(*targets):
+            versions = expire_versions(versions, now)
+            bottommost = not any(meta.in_range(key) for meta in older)
+            live = apply_range_tombstones(key, versions, range_tombstones)
+            if self.memtable.merge_operator is None and any(
+                kind == KIND_MERGE for _, kind, _ in live
+            ):
+                raise ValueError(f"{key!r} has merge operands but no merge operator")
+            if collapse and live[0][1] == KIND_MERGE:
+                live = self.memtable.collapse_merges(key, live, bottommost)
+                self.memtable.statistics.incr("compaction.merges_collapsed")
+            retained = retained_versions(live, snapshots, bottommost)
+
+            for version in versions:
+                if version[1] == KIND_BLOB and version not in retained:
+                    blob_id, _, size = unpack_pointer(version[2])
+                    blob_garbage[blob_id] += size
+
+            for seq, kind, value in retained:
+                if kind == KIND_BLOB:
+                    blob_id, _, size = unpack_pointer(value)
+                    if blob_id in gc_blobs:
+                        blob_garbage[blob_id] += size
+                        value = blob_file.add(key, read_blob(self.db_dir, value))
+                yield key, seq, kind, value
+
+    def drop_expired_segments(self):
+        """
+        Removes segments where every value has expired without rewriting them.
+        A segment is only dropped if no older segment overlaps its key range,
+        otherwise its (expired) values would stop hiding older ones.
+        """
+        now = self.memtable.clock() * 1000
+        segments = self.memtable.manifest.segments
+        expired = []
+
+        for i, meta in enumerate(segments):
+            if meta.expires_at is None or meta.expires_at > now:
+                continue
+            older = [m for m in segments[:i] if m.id not in expired]
+            if not any(meta.overlaps(m) for m in older):
+                expired.append(meta.id)
+
+        if not expired:
+            return
+
+        with self.memtable.sparse_index_lock:
+            self.memtable.install_segments(remove=expired)
+            self.memtable.remove_segment_files(expired)
+        self.memtable.statistics.incr("compaction.expired_segments", len(expired))
+
+    def drop_deleted_segments(self):
+        """
+        Removes segments that are entirely deleted by a newer range tombstone
+        without rewriting them. Segments a snapshot can still read from are
+        kept.
+        """
+        snapshots = self.memtable.snapshot_seqs()
+        visible_at = min(snapshots) if snapshots else None
+
+        with self.memtable.sparse_index_lock:
+            # newest first, so the tombstones seen so far are all newer than
+            # the segment being looked at
+            range_tombstones = RangeTombstones(self.memtable.range_tombstones)
+            deleted = []
+            for index in self.memtable.iter_sparse_indexes():
+                if index.smallest is not None and range_tombstones.covers(
+                    index.smallest, index.largest, index.max_seq, visible_at
+                ):
+                    deleted.append(index.segment)
+                else:
+                    range_tombstones.extend(index.range_tombstones)
+
+            if not deleted:
+                return
+
+            self.memtable.install_segments(remove=deleted)
+            self.memtable.remove_segment_files(deleted)
+        self.memtable.statistics.incr("compaction.deleted_segments", len(deleted))
 
     def iter_kv_pairs(self, target):
+        for key, _, _, value in self.iter_entries(target):
+            yield key, value
+
+    def iter_entries(self, target):
         with Segment(id=target, db_dir=self.db_dir) as segment:
-            for _, _, _, raw_block in segment:
-                for k, v in Block.iter_from_binary(raw_block):
-                    yield k, v
-
-    def iter_smallest_kv_pair(self, segment_a, segment_b):
-        default = (None, None)
-        segment_a_generator = self.iter_kv_pairs(segment_a)
-        segment_b_generator = self.iter_kv_pairs(segment_b)
-        segment_a_key, segment_a_val = next(segment_a_generator, default)
-        segment_b_key, segment_b_val = next(segment_b_generator, default)
-
-        while segment_a_key is not None or segment_b_key is not None:
-            if segment_a_key is None:
-                yield segment_b_key, segment_b_val
-                segment_b_key, segment_b_val = next(segment_b_generator, default)
-            elif segment_b_key is None:
-                yield segment_a_key, segment_a_val
-                segment_a_key, segment_a_val = next(segment_a_generator, default)
-            elif segment_a_key < segment_b_key:
-                yield segment_a_key, segment_a_val
-                segment_a_key, segment_a_val = next(segment_a_generator, default)
-            elif segment_b_key < segment_a_key:
-                yield segment_b_key, segment_b_val
-                segment_b_key, segment_b_val = next(segment_b_generator, default)
-            # keys are the same so the newer segment wins and the old one is discarded
-            else:
-                yield segment_b_key, segment_b_val
-                segment_a_key, segment_a_val = next(segment_a_generator, default)
-                segment_b_key, segment_b_val = next(segment_b_generator, default)
-
-    def run(self):
-        _RUNNING = True
-        try:
-            while not _STOP_EVENT.is_set():
-                start = time.time()
-                self.compact()
-                total = time.time() - start
-
-                if total < self.interval:
-                    time.sleep(self.interval - total)
-        finally:
-            _RUNNING = False
+            # A single pass over files that are about to be removed, so
+            # don't let them push other pages out of the page cache
+            for _, _, _, raw_block in segment.iter_data_blocks(drop_cache=True):
+                for entry in Block.iter_entries_from_binary(raw_block):
+                    yield entry
+
+    def iter_merged_versions(self, *targets):
+        """
+        Merges the entries of the target segments in key order. Yields each key
+        with all of its versions, newest first.
+        """
+        newest_first = sorted(targets, reverse=True)
+        return iter_versions([self.iter_entries(target) for target in newest_first])
+
+
+def retained_versions(versions, snapshots, bottommost=False):
+    """
+    Filters the versions of a key (newest first) down to the ones a reader can
+    still see. That's the newest version plus, for every snapshot, the newest
+    version at or below the snapshot's sequence number. Below a retained merge
+    operand the versions are kept down to the first one that isn't an
+    operand, which is what the operands merge into. When the versions are
+    `bottommost`, that is no older segment has the key, tombstones that would
+    end up as the oldest retained version are dropped since there is nothing
+    left for them to hide. Range tombstones added by `apply_range_tombstones`
+    are never retained.
+    """
+    retained = []
+    newer_seq = None
+    merges_into = False
+    for seq, kind, value in versions:
+        if (
+            newer_seq is None
+            or merges_into
+            or any(seq <= s < newer_seq for s in snapshots)
+        ):
+            retained.append((seq, kind, value))
+            merges_into = kind == KIND_MERGE
+        newer_seq = seq
+
+    while (
+        bottommost
+        and retained
+        and retained[-1][2] == TOMBSTONE
+        and retained[-1][1] != KIND_MERGE
+    ):
+        retained.pop()
+
+    return [version for version in retained if version[1] != KIND_RANGE_DELETE]
+
+
+def apply_range_tombstones(key, versions, range_tombstones):
+    """
+    Drops the versions of a key (newest first) that are deleted by a range
+    tombstone. The tombstones are added to the versions as point tombstones
+    for `retained_versions`, so versions a snapshot can still see are kept,
+    which then removes them again since range tombstones are written
+    separately.
+    """
+    seqs = range_tombstones.seqs_covering(key) if range_tombstones else None
+    if not seqs:
+        return versions
+
+    merged = sorted(
+        versions + [(seq, KIND_RANGE_DELETE, TOMBSTONE) for seq in seqs],
+        key=lambda version: version[0],
+        reverse=True,
+    )
+    return merged
+
+
+def expire_versions(versions, now):
+    """
+    Turns the expired versions of a key into tombstones so they keep hiding
+    older versions until it's safe to drop them.
+    """
+    return [(seq, *expire(kind, value, now)) for seq, kind, value in versions]
@@ -0,0 +1,461 @@
+"""
+A database made up of named column families. Each column family is a
+`MemTable` with its own directory of segment files, manifest and tuning (block
+size, compression, bloom filter size, ...) but they all share a single write
+ahead log and a pool of compaction threads. That way a lot of small tables
+don't each pay for their own fsyncs and compactor thread.
+"""
+import functools
+import json
+import os
+import shutil
+import threading
+import time
+from collections import defaultdict
+from struct import calcsize, pack, unpack_from
+
+from .events import EventListener
+from .memtable import MemTable
+from .options import Options
+from .scheduler import CompactionScheduler
+from .segment import KIND_VALUE, WAL, Block, fsync_dir, list_segments
+from .settings import COMPACTION_WORKERS
+from .stats import Statistics
+
+DEFAULT_COLUMN_FAMILY = "default"
+# Keys in the shared WAL are prefixed with the id of their column family
+CF_ID_FMT = "<I"
+CF_ID_SIZE = calcsize(CF_ID_FMT)
+# The `MemTable` options a column family can be created with. They're saved
+# along with the column family so it's reopened with the same tuning.
+COLUMN_FAMILY_OPTIONS = Options.FIELDS
+
+
+class DB:
+    """
+    Opens (or creates) the database in `db_dir`. There's always a `default`
+    column family and more can be added with `create_column_family`.
+
+    The column families and their options are stored in `families.json`, each
+    column family's files are in a sub directory named after it and the shared
+    WAL files are in `db_dir` itself. `merge_operators` maps the names of
+    column families to their `MergeOperator`, see `MemTable.merge`. With a
+    `memory_budget` the column families share it, see `memory.py`.
+
+    Options changed on a column family's memtable with `set_options` (or by an
+    `AutoTuner`) are saved too, and it's reopened with them.
+    """
+
+    FAMILIES_FILE = "families.json"
+
+    def __init__(
+        self,
+        db_dir,
+        compaction_workers=COMPACTION_WORKERS,
+        merge_operators=None,
+        memory_budget=None,
+    ):
+        self.db_dir = db_dir
+        self.compaction_workers = compaction_workers
+        # Merge operators are code, not options that can be saved, so they're
+        # passed in every time the database is opened
+        self.merge_operators = dict(merge_operators or {})
+        self.memory_budget = memory_budget
+        self.statistics = Statistics()
+        self.lock = threading.Lock()
+        # name -> {"id": ..., "options": {...}}
+        self.families = {}
+        self.column_families = {}
+        self.next_family_id = 0
+        # Compactions are only run once `start_compaction` is called
+        self.scheduler = CompactionScheduler(compaction_workers, stats=self.statistics)
+
+        path = os.path.join(db_dir, self.FAMILIES_FILE)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                data = json.load(f)
+            self.families = data["families"]
+            self.next_family_id = data["next_family_id"]
+
+        self.wal = GroupCommitWAL(db_dir, stats=self.statistics)
+        for name, family in self.families.items():
+            self.column_families[name] = MemTable.reconstruct(
+                os.path.join(db_dir, name),
+                wal=ColumnFamilyWAL(self, family["id"]),
+                merge_operator=self.merge_operators.get(name),
+                memory_budget=memory_budget,
+                **family["options"],
+            )
+            self.column_families[name].add_listener(_SaveOptions(self, name))
+        self.recover()
+        for memtable in self.column_families.values():
+            self.scheduler.register(memtable)
+
+        if DEFAULT_COLUMN_FAMILY not in self.families:
+            self.create_column_family(DEFAULT_COLUMN_FAMILY)
+
+    def recover(self):
+        """
+        Replays the shared WAL into the memtables of the column families. The
+        memtables skip anything they had already flushed.
+        """
+        by_id = {
+            family["id"]: self.column_families[name]
+            for name, family in self.families.items()
+        }
+        for cf_id, entries in self.wal.replay():
+            memtable = by_id.get(cf_id)
+            # Records of dropped column families are ignored
+            if memtable is not None:
+                memtable.apply_batch(entries)
+
+        # Logs only holding records of dropped column families can go
+        self.wal.release(self.flushed_seqs())
+
+    def create_column_family(self, name, **options):
+        if not name or os.sep in name or name.startswith("."):
+            raise ValueError(f"Invalid column family name {name!r}")
+
+        unknown = set(options) - set(COLUMN_FAMILY_OPTIONS)
+        if unknown:
+            raise TypeError(f"Unknown column family options {sorted(unknown)}")
+
+        with self.lock:
+            if name in self.families:
+                raise ValueError(f"Column family {name!r} already exists")
+
+            cf_id = self.next_family_id
+            self.next_family_id += 1
+            path = os.path.join(self.db_dir, name)
+            os.makedirs(path, exist_ok=True)
+            fsync_dir(self.db_dir)
+
+            self.families[name] = {"id": cf_id, "options": options}
+            self.save_families()
+            memtable = MemTable(
+                path,
+                wal=ColumnFamilyWAL(self, cf_id),
+                merge_operator=self.merge_operators.get(name),
+                memory_budget=self.memory_budget,
+                **options,
+            )
+            memtable.add_listener(_SaveOptions(self, name))
+            self.column_families[name] = memtable
+
+        self.scheduler.register(memtable)
+        return memtable
+
+    def drop_column_family(self, name):
+        if name == DEFAULT_COLUMN_FAMILY:
+            raise ValueError("The default column family can't be dropped")
+
+        with self.lock:
+            del self.families[name]
+            self.save_families()
+            memtable = self.column_families.pop(name)
+
+        self.scheduler.unregister(memtable)
+        if self.memory_budget is not None:
+            self.memory_budget.unregister(memtable)
+        shutil.rmtree(os.path.join(self.db_dir, name))
+        fsync_dir(self.db_dir)
+        self.wal.release(self.flushed_seqs())
+
+    def column_family(self, name=DEFAULT_COLUMN_FAMILY):
+        return self.column_families[name]
+
+    def list_column_families(self):
+        return sorted(self.families)
+
+    def save_families(self):
+        path = os.path.join(self.db_dir, self.FAMILIES_FILE)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"families": self.families, "next_family_id": self.next_family_id}, f
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        fsync_dir(self.db_dir)
+
+    def save_options(self, name, changes):
+        with self.lock:
+            # The column family may have been dropped in the meantime
+            if name in self.families:
+                self.families[name]["options"].update(changes)
+                self.save_families()
+
+    def get(self, key, column_family=DEFAULT_COLUMN_FAMILY):
+        return self.column_families[column_family][key]
+
+    def put(self, key, value, column_family=DEFAULT_COLUMN_FAMILY, ttl=None):
+        self.column_families[column_family].put(key, value, ttl=ttl)
+
+    def delete(self, key, column_family=DEFAULT_COLUMN_FAMILY):
+        del self.column_families[column_family][key]
+
+    def merge(self, key, operand, column_family=DEFAULT_COLUMN_FAMILY):
+        self.column_families[column_family].merge(key, operand)
+
+    def flush(self):
+        for memtable in list(self.column_families.values()):
+            with memtable.sparse_index_lock:
+                memtable.flush_tree()
+
+    def flushed_seqs(self):
+        """
+        The last sequence number each column family has written to a segment.
+        """
+        return {
+            family["id"]: self.column_families[name].manifest.last_seq
+            for name, family in list(self.families.items())
+            if name in self.column_families
+        }
+
+    def column_family_flushed(self):
+        # Start a new log so the old ones can be removed once every column
+        # family has flushed what's in them.
+        self.wal.roll()
+        self.wal.release(self.flushed_seqs())
+
+    def start_compaction(self):
+        """
+        Starts compacting the column families in the background on a pool of
+        `compaction_workers` threads. Column families are compacted after they
+        flush, the ones with the most segments first.
+        """
+        self.scheduler.start()
+
+    def pause_compaction(self):
+        self.scheduler.pause()
+
+    def resume_compaction(self):
+        self.scheduler.resume()
+
+    def stop_compaction(self):
+        self.scheduler.stop()
+
+    def close(self):
+        self.stop_compaction()
+        self.wal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _SaveOptions(EventListener):
+    """
+    Saves the options changed on the memtable of a column family.
+    """
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def on_options_changed(self, changes):
+        self.db.save_options(self.name, changes)
+
+
+class ColumnFamilyWAL:
+    """
+    What a column family's memtable uses as its WAL. Writes go to the shared
+    log, and it's the `DB` that replays the log and removes old log files.
+    """
+
+    def __init__(self, db, cf_id):
+        self.db = db
+        self.cf_id = cf_id
+
+    def add(self, key, value, seq=None, kind=KIND_VALUE):
+        """
+        Queues the record in the shared log and returns a function that waits
+        for it to be committed. The memtable calls it after letting go of its
+        write lock, so writers to the same column family share fsyncs too.
+        """
+        request = self.db.wal.queue(self.cf_id, key, value, seq or 0, kind)
+        return functools.partial(self.db.wal.wait, request)
+
+    def reset(self):
+        self.db.column_family_flushed()
+
+    def iter_batches(self, *args, **kwargs):
+        return iter(())
+
+
+class GroupCommitWAL:
+    """
+    The write ahead log shared by the column families. Writers are group
+    committed: the first writer to arrive writes and fsyncs every record that
+    queues up behind it in one go, so concurrent writes (to any column family)
+    share a single fsync.
+
+    The log is split into numbered files (`wal.0`, `wal.1`, ...). A new one is
+    started whenever a column family flushes and the old ones are removed
+    once every column family has flushed all of its records in them.
+    """
+
+    def __init__(self, db_dir, stats=None):
+        self.db_dir = db_dir
+        self.stats = stats
+        self._cond = threading.Condition()
+        self._pending = []
+        self._writing = False
+        self._file = None
+        self._file_number = None
+        # log number -> {column family id: largest sequence number in the log}
+        self.logs = {number: {} for number in list_segments(db_dir, fname="wal")}
+        self.number = max(self.logs, default=-1) + 1
+        self.logs[self.number] = {}
+
+    def path(self, number):
+        return os.path.join(self.db_dir, f"wal.{number}")
+
+    def add(self, cf_id, key, value, seq, kind=KIND_VALUE):
+        self.wait(self.queue(cf_id, key, value, seq, kind))
+
+    def queue(self, cf_id, key, value, seq, kind=KIND_VALUE):
+        """
+        Queues a record for the next group commit, see `wait`. Records are
+        written in the order they're queued.
+        """
+        block = Block()
+        block.add(pack(CF_ID_FMT, cf_id) + key, value, seq=seq, kind=kind)
+        request = _CommitRequest(cf_id, seq, block.dump(compress=False))
+        with self._cond:
+            self._pending.append(request)
+        return request
+
+    def wait(self, request):
+        """
+        Waits until the queued `request` is written and fsynced, and raises
+        the error if that failed.
+        """
+        with self._cond:
+            while not request.done and self._writing:
+                self._cond.wait()
+
+            if not request.done:
+                # Nobody is writing, so commit everything queued up so far
+                self._writing = True
+                batch, self._pending = self._pending, []
+                number = self.number
+
+        if not request.done:
+            self._commit(number, batch)
+
+        if request.error is not None:
+            raise request.error
+
+    def _commit(self, number, batch):
+        error = None
+        try:
+            self._write(number, b"".join(request.data for request in batch))
+        except Exception as e:
+            error = e
+
+        with self._cond:
+            seqs = self.logs[number]
+            for request in batch:
+                request.done = True
+                request.error = error
+                if error is None:
+                    seqs[request.cf_id] = max(seqs.get(request.cf_id, 0), request.seq)
+            self._writing = False
+            self._cond.notify_all()
+
+        if self.stats is not None:
+            self.stats.incr("wal.group_commits")
+            self.stats.incr("wal.group_commit_records", len(batch))
+
+    def _write(self, number, data):
+        if self._file_number != number:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.path(number), "ab")
+            self._file_number = number
+            fsync_dir(self.db_dir)
+
+        start = time.perf_counter()
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        if self.stats is not None:
+            self.stats.record_time("wal.fsync", time.perf_counter() - start)
+
+    def roll(self):
+        """
+        Starts a new log file, unless nothing was written to the current one.
+        """
+        with self._cond:
+            while self._writing:
+                self._cond.wait()
+
+            if not self.logs[self.number]:
+                return
+            self.number += 1
+            self.logs[self.number] = {}
+
+    def release(self, flushed_seqs):
+        """
+        Removes the log files that only have records already flushed to
+        segments. `flushed_seqs` maps the id of every live column family to
+        the last sequence number it flushed.
+        """
+        with self._cond:
+            obsolete = [
+                number
+                for number, seqs in self.logs.items()
+                if number != self.number
+                and all(
+                    seq <= flushed_seqs.get(cf_id, seq) for cf_id, seq in seqs.items()
+                )
+            ]
+            for number in obsolete:
+                del self.logs[number]
+                if number == self._file_number:
+                    self._file.close()
+                    self._file, self._file_number = None, None
+                if os.path.exists(self.path(number)):
+                    os.remove(self.path(number))
+
+        if obsolete:
+            fsync_dir(self.db_dir)
+
+    def replay(self):
+        """
+        Yields `(column family id, entries)` for the records in the existing
+        log files, oldest first.
+        """
+        for number in sorted(self.logs):
+            if number == self.number:
+                continue
+
+            seqs = self.logs[number]
+            for batch in WAL(self.db_dir, id=number).iter_batches():
+                entries = defaultdict(list)
+                for key, seq, kind, value in batch:
+                    cf_id = unpack_from(CF_ID_FMT, key)[0]
+                    entries[cf_id].append((key[CF_ID_SIZE:], seq, kind, value))
+                    seqs[cf_id] = max(seqs.get(cf_id, 0), seq)
+                yield from entries.items()
+
+    def close(self):
+        with self._cond:
+            while self._writing:
+                self._cond.wait()
+            if self._file is not None:
+                self._file.close()
+                self._file, self._file_number = None, None
+
+
+class _CommitRequest:
+    def __init__(self, cf_id, seq, data):
+        self.cf_id = cf_id
+        self.seq = seq
+        self.data = data
+        self.done = False
+        self.error = None
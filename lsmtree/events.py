@@ -0,0 +1,125 @@
+"""
+Hooks around engine operations. Register an `EventListener` subclass with a
+memtable to trace or profile it without patching the engine.
+"""
+import cProfile
+import io
+import itertools
+import pstats
+import threading
+
+
+class EventListener:
+    """
+    Base class for listeners. Every hook is a no-op so subclasses only need to
+    override the ones they care about. Durations are in seconds and sizes are
+    in bytes.
+
+    Hooks are called synchronously on the thread doing the work so they should
+    be cheap.
+    """
+
+    def on_get_begin(self, key):
+        pass
+
+    def on_get_end(self, key, found, duration):
+        pass
+
+    def on_put_begin(self, key, size):
+        pass
+
+    def on_put_end(self, key, size, duration):
+        pass
+
+    def on_segment_probe(self, segment, key, bloom_hit):
+        pass
+
+    def on_block_read(self, segment, offset, size, duration):
+        pass
+
+    def on_cache_hit(self, cache, key):
+        pass
+
+    def on_cache_miss(self, cache, key):
+        pass
+
+    def on_flush_begin(self, segment):
+        pass
+
+    def on_flush_end(self, segment, size, duration):
+        pass
+
+    def on_compaction_begin(self, targets):
+        pass
+
+    def on_compaction_end(self, targets, output, bytes_in, bytes_out, duration):
+        pass
+
+    def on_options_changed(self, changes):
+        pass
+
+
+class SamplingProfiler(EventListener):
+    """
+    Runs cProfile on every `sample_rate`th get and keeps the aggregated
+    profile. Gets slower than `slow_threshold` are also remembered (up to
+    `max_slow`) as `(key, duration)` so tail latency can be attributed.
+
+    Only one get is profiled at a time, since only one profiler can be active
+    in a process. Samples that come up while one is running are skipped.
+    """
+
+    def __init__(self, sample_rate=100, slow_threshold=None, max_slow=100):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_slow = max_slow
+        self.slow_operations = []
+        self.stats = None
+        # Unlike `+= 1`, taking the next value of a count is atomic
+        self._count = itertools.count(1)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Held by the thread whose get is being profiled
+        self._profiling = threading.Lock()
+
+    def on_get_begin(self, key):
+        if next(self._count) % self.sample_rate:
+            return
+        if not self._profiling.acquire(blocking=False):
+            return
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Something other than us is already profiling
+            self._profiling.release()
+            return
+        self._local.profiler = profiler
+
+    def on_get_end(self, key, found, duration):
+        profiler = getattr(self._local, "profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            self._local.profiler = None
+            self._profiling.release()
+            with self._lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profiler)
+                else:
+                    self.stats.add(profiler)
+
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            with self._lock:
+                if len(self.slow_operations) < self.max_slow:
+                    self.slow_operations.append((key, duration))
+
+    def report(self, sort="cumulative", limit=20):
+        if self.stats is None:
+            return ""
+
+        out = io.StringIO()
+        with self._lock:
+            self.stats.stream = out
+            self.stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
@@ -0,0 +1,274 @@
+"""
+The manifest is the source of truth for which segment files make up the
+database. It's an append only log of version edits. Each edit adds and/or
+removes segments and is written as a single checksummed block, so an edit is
+either applied completely or (if we crashed mid write) not at all.
+"""
+import json
+import os
+from struct import error as StructError
+
+from .segment import Block, BlockCorruption, Segment, fsync_dir
+
+
+class SegmentMeta:
+    """
+    What the manifest knows about a live segment file.
+    """
+
+    def __init__(
+        self,
+        id,
+        level=0,
+        smallest=None,
+        largest=None,
+        size=0,
+        max_seq=0,
+        expires_at=None,
+        num_entries=0,
+        num_tombstones=0,
+        blob_refs=(),
+    ):
+        self.id = id
+        self.level = level
+        self.smallest = smallest
+        self.largest = largest
+        self.size = size
+        self.max_seq = max_seq
+        self.expires_at = expires_at
+        # Range tombstones count as entries too
+        self.num_entries = num_entries
+        self.num_tombstones = num_tombstones
+        # The ids of the blob files the segment has pointers into
+        self.blob_refs = sorted(blob_refs)
+
+    @property
+    def tombstone_ratio(self):
+        if not self.num_entries:
+            return 0
+        return self.num_tombstones / self.num_entries
+
+    def in_range(self, key):
+        if None in (self.smallest, self.largest):
+            return True
+        return self.smallest <= key <= self.largest
+
+    def overlaps(self, other):
+        return self.overlaps_range(other.smallest, other.largest)
+
+    def overlaps_range(self, smallest, largest):
+        if None in (self.smallest, self.largest, smallest, largest):
+            return True
+        return self.smallest <= largest and smallest <= self.largest
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "level": self.level,
+            "smallest": None if self.smallest is None else self.smallest.hex(),
+            "largest": None if self.largest is None else self.largest.hex(),
+            "size": self.size,
+            "max_seq": self.max_seq,
+            "expires_at": self.expires_at,
+            "num_entries": self.num_entries,
+            "num_tombstones": self.num_tombstones,
+            "blob_refs": self.blob_refs,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        for field in ("smallest", "largest"):
+            if data.get(field) is not None:
+                data[field] = bytes.fromhex(data[field])
+        return cls(**data)
+
+    def __repr__(self):
+        return f"SegmentMeta(id={self.id}, level={self.level})"
+
+
+class BlobMeta:
+    """
+    What the manifest knows about a blob file. `garbage` is how many of its
+    `size` bytes are values nothing points to anymore.
+    """
+
+    def __init__(self, id, size=0, garbage=0):
+        self.id = id
+        self.size = size
+        self.garbage = garbage
+
+    @property
+    def garbage_ratio(self):
+        if not self.size:
+            return 0
+        return self.garbage / self.size
+
+    def to_dict(self):
+        return {"id": self.id, "size": self.size, "garbage": self.garbage}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def __repr__(self):
+        return f"BlobMeta(id={self.id}, size={self.size}, garbage={self.garbage})"
+
+
+class Manifest:
+    """
+    Keeps the ordered (oldest first) list of live segments along with the next
+    segment id to hand out and the last sequence number persisted to a segment.
+    It also keeps the live blob files.
+
+    Edits are of the form `{"add": [...], "remove": [...], ...}`. Added segments
+    take the place of the newest removed segment, or are appended as the newest
+    segment if nothing was removed. Blob files are added and removed with
+    `add_blobs` and `remove_blobs`, and `blob_garbage` is a list of
+    `[blob id, bytes]` to add to their garbage. Any other fields simply
+    overwrite the manifest's attribute of the same name.
+    """
+
+    EDIT_FIELDS = ("add", "remove", "add_blobs", "remove_blobs", "blob_garbage")
+
+    def __init__(self, db_dir):
+        self.db_dir = db_dir
+        self.segment = Segment(id="log", db_dir=db_dir, fname="manifest")
+        self.segments = []
+        self.blob_files = {}
+        self.next_segment = 0
+        self.last_seq = 0
+        self.edits = 0
+
+        if self.exists:
+            self.load()
+
+    @property
+    def exists(self):
+        return os.path.exists(self.segment.path)
+
+    def live_ids(self):
+        return [meta.id for meta in self.segments]
+
+    def get(self, segment_id):
+        for meta in self.segments:
+            if meta.id == segment_id:
+                return meta
+        raise KeyError(segment_id)
+
+    def new_segment_id(self):
+        segment_id = self.next_segment
+        self.next_segment += 1
+        return segment_id
+
+    def load(self):
+        valid_size = 0
+        with self.segment as segment:
+            try:
+                for offset, _, size, raw_block in segment:
+                    for _, edit in Block.iter_from_binary(raw_block):
+                        self._apply(json.loads(edit))
+                    valid_size = offset + Block.HEADER_SIZE + size
+            except (BlockCorruption, StructError):
+                # A torn write at the end of the log. The edit never took
+                # effect so drop it.
+                segment.file.truncate(valid_size)
+
+    def referenced_blobs(self):
+        return {blob_id for meta in self.segments for blob_id in meta.blob_refs}
+
+    def apply(
+        self,
+        add=(),
+        remove=(),
+        add_blobs=(),
+        remove_blobs=(),
+        blob_garbage=(),
+        **fields,
+    ):
+        edit = {
+            "add": [meta.to_dict() for meta in add],
+            "remove": list(remove),
+            **fields,
+        }
+        # Only written when there are any, most edits don't touch blob files
+        if add_blobs:
+            edit["add_blobs"] = [meta.to_dict() for meta in add_blobs]
+        if remove_blobs:
+            edit["remove_blobs"] = list(remove_blobs)
+        if blob_garbage:
+            edit["blob_garbage"] = [list(item) for item in blob_garbage]
+        created = not self.exists
+        self._write(self.segment, edit)
+        if created:
+            fsync_dir(self.db_dir)
+        self._apply(edit)
+
+    def rewrite(self):
+        """
+        Replaces the log with a single edit describing the current state.
+        """
+        self.write_snapshot(self.db_dir)
+        self.edits = 1
+
+    def write_snapshot(self, db_dir):
+        """
+        Writes a log with a single edit describing the current state to
+        `db_dir`. It's written next to any existing log and atomically renamed
+        over it.
+        """
+        tmp = Segment(id="tmp", db_dir=db_dir, fname="manifest")
+        if os.path.exists(tmp.path):
+            tmp.remove()
+
+        self._write(tmp, self.snapshot())
+        os.replace(tmp.path, Segment(id="log", db_dir=db_dir, fname="manifest").path)
+        fsync_dir(db_dir)
+
+    def snapshot(self):
+        return {
+            "add": [meta.to_dict() for meta in self.segments],
+            "remove": [],
+            "add_blobs": [meta.to_dict() for meta in self.blob_files.values()],
+            "next_segment": self.next_segment,
+            "last_seq": self.last_seq,
+        }
+
+    def _write(self, segment, edit):
+        block = Block()
+        block.add(b"edit", json.dumps(edit).encode("utf8"))
+        with segment:
+            segment.write(block.dump(compress=False))
+
+    def _apply(self, edit):
+        remove = set(edit.get("remove", ()))
+        add = [SegmentMeta.from_dict(meta) for meta in edit.get("add", ())]
+
+        positions = [i for i, meta in enumerate(self.segments) if meta.id in remove]
+        if positions:
+            insert_at = max(positions) - (len(positions) - 1)
+        else:
+            insert_at = len(self.segments)
+
+        segments = [meta for meta in self.segments if meta.id not in remove]
+        segments[insert_at:insert_at] = add
+        self.segments = segments
+
+        for meta in add:
+            self.next_segment = max(self.next_segment, meta.id + 1)
+
+        for data in edit.get("add_blobs", ()):
+            meta = BlobMeta.from_dict(data)
+            self.blob_files[meta.id] = meta
+            self.next_segment = max(self.next_segment, meta.id + 1)
+        for blob_id in edit.get("remove_blobs", ()):
+            self.blob_files.pop(blob_id, None)
+        for blob_id, garbage in edit.get("blob_garbage", ()):
+            if blob_id in self.blob_files:
+                self.blob_files[blob_id].garbage += garbage
+
+        for field, value in edit.items():
+            if field not in self.EDIT_FIELDS:
+                setattr(self, field, value)
+
+        self.edits += 1
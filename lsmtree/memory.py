@@ -0,0 +1,125 @@
+"""
+Keeps the memory used by any number of memtables, possibly of several
+databases, under a single budget.
+"""
+import sys
+import threading
+
+from .rbtree import Node
+from .settings import MEMORY_BUDGET_MIN_FLUSH_SIZE, MEMORY_BUDGET_SIZE
+
+
+def _rbtree_entry_overhead():
+    """
+    What a key in the RBTree takes on top of the bytes of its key and value:
+    the node, its attributes and the list and tuple of its single version.
+    """
+    node = Node(b"", [(0, 0, b"")])
+    return (
+        sys.getsizeof(node)
+        + sys.getsizeof(node.__dict__)
+        + sys.getsizeof(node.value)
+        + sys.getsizeof(node.value[0])
+        + sys.getsizeof(0) * 2
+        + sys.getsizeof(b"") * 2
+    )
+
+
+RBTREE_ENTRY_OVERHEAD = _rbtree_entry_overhead()
+
+# The parts memory use is reported in, see `MemTable.memory_usage`
+COMPONENTS = ("memtable", "block_cache", "row_cache", "indexes", "filters")
+
+
+class MemoryBudget:
+    """
+    Memtables created with `memory_budget=budget` charge their RBTree, caches,
+    sparse indexes and bloom filters against the budget's `limit` in bytes.
+
+    Whenever a write takes the total over the limit the caches are shrunk
+    first, since they're the cheapest to give back. If that's not enough the
+    memtable with the largest RBTree is flushed early, as long as its RBTree
+    is at least `min_flush_size` or what's left over the limit. Indexes and
+    filters can't be given back, they only get smaller as compaction merges
+    segments.
+    """
+
+    def __init__(
+        self, limit=MEMORY_BUDGET_SIZE, min_flush_size=MEMORY_BUDGET_MIN_FLUSH_SIZE
+    ):
+        self.limit = limit
+        self.min_flush_size = min_flush_size
+        self.memtables = []
+        self._lock = threading.Lock()
+        # Only one writer at a time has to bring the usage back down
+        self._enforcing = threading.Lock()
+
+    def register(self, memtable):
+        with self._lock:
+            self.memtables.append(memtable)
+
+    def unregister(self, memtable):
+        with self._lock:
+            self.memtables.remove(memtable)
+
+    def usage(self):
+        """
+        The bytes used by each component, summed over the memtables, plus the
+        `total`.
+        """
+        with self._lock:
+            memtables = list(self.memtables)
+
+        usage = dict.fromkeys(COMPONENTS, 0)
+        for memtable in memtables:
+            for component, nbytes in memtable.memory_usage().items():
+                usage[component] += nbytes
+        usage["total"] = sum(usage[component] for component in COMPONENTS)
+        return usage
+
+    def enforce(self, memtable=None):
+        """
+        Brings the usage back under the limit if it's over. `memtable` is the
+        one whose write is calling this, its stats count what had to be done.
+        """
+        if not self._enforcing.acquire(blocking=False):
+            return
+
+        try:
+            over = self.usage()["total"] - self.limit
+            if over <= 0:
+                return
+
+            with self._lock:
+                memtables = list(self.memtables)
+
+            caches = [m.block_cache for m in memtables] + [
+                m.row_cache for m in memtables if m.row_cache is not None
+            ]
+            for cache in sorted(caches, key=lambda cache: cache.usage, reverse=True):
+                usage = cache.usage
+                cache.shrink(max(usage - over, 0))
+                # Whole entries are evicted so it can be more than asked for
+                freed = usage - cache.usage
+                if freed:
+                    over -= freed
+                    if memtable is not None:
+                        memtable.statistics.incr(
+                            "memory_budget.cache_bytes_freed", freed
+                        )
+                if over <= 0:
+                    return
+
+            sizes = [m.memory_usage()["memtable"] for m in memtables]
+            size, largest = max(zip(sizes, memtables), key=lambda pair: pair[0])
+            if size < min(over, self.min_flush_size):
+                return
+            if len(largest.rbtree) or largest.range_tombstones:
+                # Its own writers may still be writing, `flush_tree` keeps
+                # them out until the RBTree is replaced
+                with largest.sparse_index_lock:
+                    largest.flush_tree()
+                if memtable is not None:
+                    memtable.statistics.incr("memory_budget.flushes")
+        finally:
+            self._enforcing.release()
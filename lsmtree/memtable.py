@@ -1,13 +1,38 @@
+import heapq
 import os
+import sys
+import time
 import zlib
+from array import array
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from struct import calcsize, pack, unpack, unpack_from
 from threading import Lock
 
+from .blob import BlobFile, read_blob, separate_values, unpack_pointer
+from .cache import BlockCache, RowCache
+from .checkpoint import create_backup, create_checkpoint
+from .manifest import BlobMeta, Manifest, SegmentMeta
+from .memory import RBTREE_ENTRY_OVERHEAD
+from .options import Options
 from .rbtree import RBTree
-from .segment import WAL, Block, Segment, list_segments
-from .settings import (BLOCK_COMPRESSION, BLOCK_SIZE, BLOOM_FILTER_HASHES,
-                       BLOOM_FILTER_SIZE, RBTREE_FLUSH_SIZE)
+from .segment import (KIND_BLOB, KIND_EXPIRING, KIND_MERGE, KIND_RANGE_DELETE,
+                      KIND_VALUE, WAL, Block, BlockCorruption, BlockView,
+                      Segment, SegmentWriter, fsync_dir, list_segments)
+from .settings import (BLOB_THRESHOLD, BLOCK_CACHE_SIZE, BLOCK_COMPRESSION,
+                       BLOCK_SIZE, BLOOM_FILTER_HASHES, BLOOM_FILTER_SIZE,
+                       INDEX_PARTITION_ENTRIES, PREFIX_LENGTH,
+                       RBTREE_FLUSH_SIZE, RECOVERY_WORKERS, ROW_CACHE_SIZE,
+                       TOMBSTONE_COMPACTION_RATIO)
+from .stall import CompactionError, WriteController
+from .stats import Statistics
+from .tombstones import RangeTombstones
 
 TOMBSTONE = b""
+# Expiring values are stored prefixed with the time they expire at in
+# milliseconds since the epoch.
+EXPIRY_FMT = "<Q"
+EXPIRY_SIZE = calcsize(EXPIRY_FMT)
 
 
 class MemTable:
@@ -15,170 +40,1282 @@ class MemTable:
     Wrapper around the RBTree that enforces bytes only and has an upperbound on
     how large the tree can grow. When the tree grows past the `flush_tree_size`
     it is flushed to disk and a new RBTree is constructed.
+
+    Every write is stamped with an increasing sequence number. The RBTree maps
+    a key to its versions as `(seq, kind, value)` tuples, newest first. Older
+    versions are only kept around while a snapshot might still need them.
     """
 
-    def __init__(self, db_dir, flush_tree_size=RBTREE_FLUSH_SIZE):
+    def __init__(
+        self,
+        db_dir,
+        flush_tree_size=RBTREE_FLUSH_SIZE,
+        listeners=None,
+        block_cache_size=BLOCK_CACHE_SIZE,
+        row_cache_size=ROW_CACHE_SIZE,
+        index_partition_entries=INDEX_PARTITION_ENTRIES,
+        blob_threshold=BLOB_THRESHOLD,
+        block_size=BLOCK_SIZE,
+        block_compression=BLOCK_COMPRESSION,
+        bloom_filter_size=BLOOM_FILTER_SIZE,
+        bloom_filter_hashes=BLOOM_FILTER_HASHES,
+        prefix_length=PREFIX_LENGTH,
+        tombstone_compaction_ratio=TOMBSTONE_COMPACTION_RATIO,
+        merge_operator=None,
+        wal=None,
+        write_controller=None,
+        memory_budget=None,
+    ):
         self.db_dir = db_dir
         self.flush_tree_size = flush_tree_size
+        self.index_partition_entries = index_partition_entries
+        self.blob_threshold = blob_threshold
+        self.block_size = block_size
+        self.block_compression = block_compression
+        self.bloom_filter_size = bloom_filter_size
+        self.bloom_filter_hashes = bloom_filter_hashes
+        self.prefix_length = prefix_length
+        self.tombstone_compaction_ratio = tombstone_compaction_ratio
+        self.merge_operator = merge_operator
         self.current_size_bytes = 0
         # An improvement here could be a RWLock instead of simple mutex if
         # we want to allow concurrent reads in the future
         self.sparse_index_lock = Lock()
         self.sparse_index = None
-        self.sparse_index_counter = 0
+        self.manifest = Manifest(db_dir)
         self.rbtree = RBTree()
-        self.wal = WAL(db_dir)
+        # Ranges deleted since the last flush
+        self.range_tombstones = RangeTombstones()
+        # Serializes sequence number assignment so the WAL and the RBTree see
+        # writes in the same order.
+        self.write_lock = Lock()
+        self.last_seq = 0
+        self.snapshots = []
+        self.recovery_futures = []
+        # Files being copied (see `checkpoint.py`) are only removed once the
+        # copies are done
+        self.pinned_files = Counter()
+        self._unpinned_removals = set()
+        self._pin_lock = Lock()
+        # What the sparse indexes and bloom filters of the live segments take
+        # up, kept up to date as segments come and go and indexes are loaded
+        self.index_bytes = 0
+        self.filter_bytes = 0
+        self._index_bytes_lock = Lock()
+        self.clock = time.time
+        self.statistics = Statistics()
+        self.listeners = list(listeners or [])
+        self.block_cache = BlockCache(
+            block_cache_size, stats=self.statistics, listeners=self.listeners
+        )
+        self.row_cache = None
+        if row_cache_size:
+            self.row_cache = RowCache(
+                row_cache_size, stats=self.statistics, listeners=self.listeners
+            )
+        # A `DB` shares one WAL between all of its column families
+        self.wal = wal if wal is not None else WAL(db_dir, stats=self.statistics)
+        # Slows writes down when compaction falls behind
+        self.write_controller = write_controller or WriteController()
+        # Set by the `CompactionScheduler` the memtable is registered with
+        self.compaction_scheduler = None
+        # A `MemoryBudget` shared with other memtables, see `memory.py`
+        self.memory_budget = memory_budget
+        if memory_budget is not None:
+            memory_budget.register(self)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def notify(self, event, *args):
+        for listener in self.listeners:
+            getattr(listener, event)(*args)
+
+    def snapshot(self):
+        """
+        Returns a `Snapshot` of the current state of the database. Reads made
+        with it don't see any later writes. Release it when done so compaction
+        can discard the versions it was holding on to.
+        """
+        with self.write_lock:
+            snapshot = Snapshot(self, self.last_seq)
+            self.snapshots.append(snapshot)
+        return snapshot
+
+    def release_snapshot(self, snapshot):
+        with self.write_lock:
+            self.snapshots.remove(snapshot)
+
+    def snapshot_seqs(self):
+        return sorted(snapshot.seq for snapshot in self.snapshots)
+
+    def iter_sparse_indexes(self):
+        # newest first
+        sparse_index = self.sparse_index
+        while sparse_index:
+            yield sparse_index
+            sparse_index = sparse_index.next
+
+    def install_segments(self, add=(), remove=(), add_blobs=(), **fields):
+        """
+        Records the added and removed segments in the manifest and then relinks
+        the sparse index list to match it. Callers should hold the
+        `sparse_index_lock`.
+
+        Blob files no live segment points into anymore are removed in the same
+        edit, unless a snapshot (or scan) might still be reading from them.
+        """
+        metas = [
+            SegmentMeta(
+                id=index.segment,
+                level=index.level,
+                smallest=index.smallest,
+                largest=index.largest,
+                size=os.path.getsize(Segment(index.segment, self.db_dir).path),
+                max_seq=index.max_seq,
+                expires_at=index.expires_at,
+                num_entries=index.num_entries,
+                num_tombstones=index.num_tombstones,
+                blob_refs=index.blob_refs,
+            )
+            for index in add
+        ]
+
+        unreferenced = []
+        if self.manifest.blob_files and not self.snapshots:
+            referenced = {blob_id for meta in metas for blob_id in meta.blob_refs}
+            referenced.update(
+                blob_id
+                for meta in self.manifest.segments
+                if meta.id not in remove
+                for blob_id in meta.blob_refs
+            )
+            unreferenced = [i for i in self.manifest.blob_files if i not in referenced]
+
+        self.manifest.apply(
+            add=metas,
+            remove=remove,
+            add_blobs=add_blobs,
+            remove_blobs=unreferenced,
+            **fields,
+        )
+        self.update_write_controller()
+        if remove:
+            self.statistics.remove_segments(remove)
+
+        indexes = {index.segment: index for index in self.iter_sparse_indexes()}
+        indexes.update((index.segment, index) for index in add)
+        for segment_id in remove:
+            if segment_id in indexes:
+                indexes[segment_id].on_load = None
+        self.link_indexes([indexes[i] for i in self.manifest.live_ids()])
+
+        if unreferenced:
+            self.remove_files(f"blob.{blob_id}" for blob_id in unreferenced)
+            self.statistics.incr("blob.files_removed", len(unreferenced))
+
+    def throttle(self):
+        """
+        Holds a write up while compaction is behind, see `WriteController`.
+        Only memtables compacted in the background by a running
+        `CompactionScheduler` are throttled. Otherwise compaction is up to the
+        caller and nothing would catch up while the write waits.
+        """
+        scheduler = self.compaction_scheduler
+        if scheduler is not None and scheduler.running:
+            try:
+                self.write_controller.throttle(self.statistics)
+            except CompactionError:
+                # Have another go so writes can succeed again once it does
+                scheduler.schedule(self)
+                raise
+
+    def update_write_controller(self):
+        segments = self.manifest.segments
+        # The oldest segment is what every compaction merges into, so only the
+        # newer ones count as work compaction still has to do.
+        self.write_controller.update(
+            len(segments), sum(meta.size for meta in segments[1:])
+        )
+
+    def link_indexes(self, indexes):
+        """
+        Rebuilds the sparse index linked list from indexes ordered oldest first.
+        """
+        head = None
+        index_bytes = filter_bytes = 0
+        with self._index_bytes_lock:
+            for index in indexes:
+                index.next = head
+                head = index
+                index.on_load = self.index_loaded
+                index_bytes += index.index_nbytes
+                filter_bytes += index.filter_nbytes
+            self.index_bytes, self.filter_bytes = index_bytes, filter_bytes
+        self.sparse_index = head
+
+    def index_loaded(self, index, index_bytes, filter_bytes):
+        """
+        Called by lazy indexes once they're read from disk, with what they took
+        up before.
+        """
+        with self._index_bytes_lock:
+            self.index_bytes += index.index_nbytes - index_bytes
+            self.filter_bytes += index.filter_nbytes - filter_bytes
+
+    def remove_segment_files(self, segment_ids):
+        for segment_id in segment_ids:
+            self.block_cache.evict_segment(segment_id)
+        self.remove_files(f"segment.{segment_id}" for segment_id in segment_ids)
+
+    def remove_files(self, names):
+        """
+        Removes files of the database directory, except for pinned ones which
+        are removed when they're unpinned.
+        """
+        with self._pin_lock:
+            for name in names:
+                if self.pinned_files[name]:
+                    self._unpinned_removals.add(name)
+                else:
+                    os.remove(os.path.join(self.db_dir, name))
+        fsync_dir(self.db_dir)
+
+    def pin_files(self, names):
+        """
+        Keeps compaction from removing the files until `unpin_files`.
+        """
+        with self._pin_lock:
+            self.pinned_files.update(names)
+
+    def unpin_files(self, names):
+        with self._pin_lock:
+            self.pinned_files.subtract(names)
+            removals = [
+                name for name in self._unpinned_removals if not self.pinned_files[name]
+            ]
+            for name in removals:
+                self._unpinned_removals.remove(name)
+                os.remove(os.path.join(self.db_dir, name))
+            self.pinned_files += Counter()  # drops the zero counts
+        if removals:
+            fsync_dir(self.db_dir)
 
     def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def put(self, key, value, ttl=None):
+        """
+        Sets `key` to `value`. With a `ttl` (in seconds) the key expires and
+        reads treat it as deleted once the ttl has passed.
+        """
         assert isinstance(key, bytes)
         assert isinstance(value, bytes)
 
+        kind = KIND_VALUE
+        if ttl is not None:
+            expires_at = int((self.clock() + ttl) * 1000)
+            value = pack(EXPIRY_FMT, expires_at) + value
+            kind = KIND_EXPIRING
+
+        listeners = self.listeners
+        if listeners:
+            start = time.perf_counter()
+            self.notify("on_put_begin", key, len(value))
+
+        self.throttle()
         additional_bytes = len(key) + len(value)
         if additional_bytes + self.current_size_bytes > self.flush_tree_size:
             with self.sparse_index_lock:
                 self.flush_tree()
-            self.current_size_bytes = 0
 
-        self.wal.add(key, value)
-        self.rbtree[key] = value
+        self.write(key, value, kind)
 
         self.current_size_bytes += additional_bytes
+        if self.memory_budget is not None:
+            self.memory_budget.enforce(self)
+
+        if listeners:
+            self.notify("on_put_end", key, len(value), time.perf_counter() - start)
+
+    def write(self, key, value, kind=KIND_VALUE):
+        with self.write_lock:
+            seq = self.last_seq + 1
+            commit = self.wal.add(key, value, seq=seq, kind=kind)
+            self.apply(key, seq, kind, value)
+            self.last_seq = seq
+        # Group committed WALs (see `db.py`) only queue the record under the
+        # lock and it's written along with other writers' records here
+        if commit is not None:
+            commit()
+        return seq
+
+    def apply(self, key, seq, kind, value):
+        if kind == KIND_RANGE_DELETE:
+            self.range_tombstones.add(key, value, seq)
+            return
+
+        versions = self.rbtree.get(key)
+        # Merge operands need the versions below them until they're merged
+        if versions is None or (not self.snapshots and kind != KIND_MERGE):
+            self.rbtree[key] = [(seq, kind, value)]
+        else:
+            versions.insert(0, (seq, kind, value))
 
     def __getitem__(self, key):
+        return self.get(key)
+
+    def get(self, key, snapshot=None):
         assert isinstance(key, bytes)
+        self.statistics.incr("get.count")
+        seq = None if snapshot is None else snapshot.seq
+
+        listeners = self.listeners
+        if listeners:
+            start = time.perf_counter()
+            self.notify("on_get_begin", key)
+
+        found = False
         try:
-            val = self.rbtree[key]
-        except KeyError:
-            with self.sparse_index_lock:
-                val = self.find_in_segment_file(key)
+            version = self.find_in_rbtree(key, seq)
+            deleted_seq = self.range_tombstones.covering(key, seq)
+            if version is not None and version[0] > deleted_seq:
+                self.statistics.incr("memtable.hits")
+                if version[1] == KIND_MERGE:
+                    with self.sparse_index_lock:
+                        val = self.get_merged(key, seq)
+                else:
+                    val = self.resolve(*version[1:])
+            elif deleted_seq:
+                # Everything older than the memtable is deleted too
+                raise KeyError(key)
+            else:
+                val = self.get_from_segments(key, seq)
 
-        # value hasn't yet been cleaned up by compaction
-        if val == TOMBSTONE:
-            raise KeyError(key)
+            # value hasn't yet been cleaned up by compaction
+            if val == TOMBSTONE:
+                raise KeyError(key)
 
-        return val
+            found = True
+            return val
+        finally:
+            if listeners:
+                self.notify("on_get_end", key, found, time.perf_counter() - start)
 
     def __delitem__(self, key):
         assert isinstance(key, bytes)
-        self.wal.add(key, TOMBSTONE)
-        self.rbtree[key] = TOMBSTONE
 
-    def find_in_segment_file(self, key):
+        listeners = self.listeners
+        if listeners:
+            start = time.perf_counter()
+            self.notify("on_put_begin", key, 0)
+
+        self.throttle()
+        self.write(key, TOMBSTONE)
+        if self.memory_budget is not None:
+            self.memory_budget.enforce(self)
+
+        if listeners:
+            self.notify("on_put_end", key, 0, time.perf_counter() - start)
+
+    def delete_range(self, start, end):
+        """
+        Deletes every key with `start <= key < end` with a single range
+        tombstone instead of a tombstone per key.
+        """
+        assert isinstance(start, bytes)
+        assert isinstance(end, bytes)
+        if start >= end:
+            return
+
+        listeners = self.listeners
+        if listeners:
+            begin = time.perf_counter()
+            self.notify("on_put_begin", start, len(end))
+
+        self.throttle()
+        self.write(start, end, KIND_RANGE_DELETE)
+
+        if listeners:
+            self.notify("on_put_end", start, len(end), time.perf_counter() - begin)
+
+    def merge(self, key, operand):
+        """
+        Merges `operand` into the value of `key` with the `merge_operator`.
+        Only the operand is written, it's combined with the value when the key
+        is read, flushed or compacted.
+        """
+        assert isinstance(key, bytes)
+        assert isinstance(operand, bytes)
+        if self.merge_operator is None:
+            raise ValueError("The memtable has no merge operator")
+
+        listeners = self.listeners
+        if listeners:
+            start = time.perf_counter()
+            self.notify("on_put_begin", key, len(operand))
+
+        self.throttle()
+        additional_bytes = len(key) + len(operand)
+        if additional_bytes + self.current_size_bytes > self.flush_tree_size:
+            with self.sparse_index_lock:
+                self.flush_tree()
+
+        self.write(key, operand, KIND_MERGE)
+
+        self.current_size_bytes += additional_bytes
+        if self.memory_budget is not None:
+            self.memory_budget.enforce(self)
+
+        if listeners:
+            self.notify("on_put_end", key, len(operand), time.perf_counter() - start)
+
+    def stats(self):
+        """
+        Returns a point in time view of the engine counters.
+        """
+        return self.statistics.snapshot()
+
+    def memory_usage(self):
+        """
+        The bytes of memory used by the RBTree, the caches and the sparse
+        indexes and bloom filters of the segments.
+        """
+        return {
+            "memtable": self.current_size_bytes
+            + len(self.rbtree) * RBTREE_ENTRY_OVERHEAD,
+            "block_cache": self.block_cache.usage,
+            "row_cache": self.row_cache.usage if self.row_cache is not None else 0,
+            "indexes": self.index_bytes,
+            "filters": self.filter_bytes,
+        }
+
+    @property
+    def options(self):
+        """
+        The current `Options` of the memtable.
+        """
+        return Options(
+            flush_tree_size=self.flush_tree_size,
+            block_cache_size=self.block_cache.capacity,
+            row_cache_size=self.row_cache.capacity if self.row_cache is not None else 0,
+            index_partition_entries=self.index_partition_entries,
+            blob_threshold=self.blob_threshold,
+            block_size=self.block_size,
+            block_compression=self.block_compression,
+            bloom_filter_size=self.bloom_filter_size,
+            bloom_filter_hashes=self.bloom_filter_hashes,
+            prefix_length=self.prefix_length,
+            tombstone_compaction_ratio=self.tombstone_compaction_ratio,
+        )
+
+    def set_options(self, **changes):
+        """
+        Changes options (see `Options`) of the live memtable. Segments that
+        are already written keep the block size and bloom filters they were
+        written with, the new options apply to the ones written from now on.
+        Listeners get the changes with `on_options_changed`.
+        """
+        unknown = set(changes) - set(Options.FIELDS)
+        if unknown:
+            raise TypeError(f"Unknown options {sorted(unknown)}")
+
+        for name, value in changes.items():
+            if name == "block_cache_size":
+                self.block_cache.capacity = value
+                self.block_cache.shrink(value)
+            elif name == "row_cache_size":
+                if not value:
+                    self.row_cache = None
+                elif self.row_cache is None:
+                    self.row_cache = RowCache(
+                        value, stats=self.statistics, listeners=self.listeners
+                    )
+                else:
+                    self.row_cache.capacity = value
+                    self.row_cache.shrink(value)
+            else:
+                setattr(self, name, value)
+        if self.listeners:
+            self.notify("on_options_changed", changes)
+
+    def checkpoint(self, path):
+        """
+        Creates a checkpoint of the database in `path`, see `checkpoint.py`.
+        """
+        create_checkpoint(self, path)
+
+    def backup(self, backup_dir):
+        """
+        Adds an incremental backup of the database to `backup_dir` and returns
+        its id, see `checkpoint.py`.
+        """
+        return create_backup(self, backup_dir)
+
+    def resolve(self, kind, value):
+        """
+        Turns a stored `(kind, value)` into the value a reader sees, which is
+        a TOMBSTONE for expired values.
+        """
+        if kind == KIND_BLOB:
+            self.statistics.incr("blob.reads")
+            return read_blob(self.db_dir, value)
+
+        kind, value = expire(kind, value, self.clock())
+        if kind == KIND_EXPIRING:
+            return value[EXPIRY_SIZE:]
+        return value
+
+    def find_in_rbtree(self, key, seq=None):
+        versions = self.rbtree.get(key)
+        if versions is None:
+            return None
+
+        for version in versions:
+            if seq is None or version[0] <= seq:
+                return version
+        return None
+
+    def get_from_segments(self, key, seq=None):
+        """
+        Returns the value of `key` in the segment files, a TOMBSTONE if it's
+        not in them. Lookups of the newest version go through the row cache
+        when there is one.
+        """
+        row_cache = self.row_cache if seq is None else None
+        if row_cache is not None:
+            val = row_cache.get(key)
+            if val is not None:
+                return val
+
+        with self.sparse_index_lock:
+            try:
+                version = self.find_in_segment_file(key, seq)
+            except KeyError:
+                version = None
+                val = TOMBSTONE
+            else:
+                # Resolved under the lock so compaction can't remove the blob
+                # file the value is in first
+                if version[1] == KIND_MERGE:
+                    val = self.get_merged(key, seq)
+                else:
+                    val = self.resolve(*version[1:])
+
+            # Filled under the lock so a flush can't slip in between the lookup
+            # and the fill and leave a stale entry behind. Expiring values
+            # aren't cached, they'd have to be expired on the way out too.
+            expiring = version is not None and version[1] == KIND_EXPIRING
+            if row_cache is not None and not expiring:
+                row_cache.put(key, val, len(key) + len(val))
+        return val
+
+    def get_merged(self, key, seq=None):
+        """
+        Returns the value of a key whose newest version is a merge operand.
+        Callers should hold the `sparse_index_lock`.
+        """
+        versions = list(self.iter_key_versions(key, seq))
+        self.statistics.incr("merge.versions_read", len(versions))
+        _, kind, value = self.collapse_merges(key, versions, bottommost=True)[0]
+        return self.resolve(kind, value)
+
+    def iter_key_versions(self, key, seq=None):
+        """
+        Yields the versions of `key` at or below `seq`, newest first, from the
+        RBTree and then the segments, up to and including the first version
+        that isn't a merge operand. Versions deleted by a range tombstone are
+        replaced with a single tombstone. Callers should hold the
+        `sparse_index_lock`.
+        """
+        deleted_seq = self.range_tombstones.covering(key, seq)
+        versions = list(self.rbtree.get(key, ()))
         sparse_index = self.sparse_index
 
-        while sparse_index:
-            if key not in sparse_index.bloomfilter:
+        while True:
+            for version in versions:
+                if seq is not None and version[0] > seq:
+                    continue
+                if version[0] < deleted_seq:
+                    yield deleted_seq, KIND_VALUE, TOMBSTONE
+                    return
+                yield version
+                if version[1] != KIND_MERGE:
+                    return
+
+            # The next segment that might have the key
+            while sparse_index and not sparse_index.in_range(key):
                 sparse_index = sparse_index.next
-                continue
+            if not sparse_index:
+                break
+
+            if sparse_index.range_tombstones:
+                deleted_seq = max(
+                    deleted_seq, sparse_index.range_tombstones.covering(key, seq)
+                )
+            versions = ()
+            if key in sparse_index.bloomfilter:
+                with Segment(
+                    id=sparse_index.segment, db_dir=self.db_dir, stats=self.statistics
+                ) as segment:
+                    start, end = sparse_index.locate(key, segment, self.block_cache)
+                    block = self.read_block(segment, start, end)
+                    view = BlockView.from_binary(block, stats=self.statistics)
+                    versions = list(view.find_versions(key, seq))
+            sparse_index = sparse_index.next
 
-            start, end = sparse_index.find(key)
-            with Segment(id=sparse_index.segment, db_dir=self.db_dir) as segment:
-                block = segment.read_range(start, end)
-                val = self.find_in_block(key, block)
+        if deleted_seq:
+            yield deleted_seq, KIND_VALUE, TOMBSTONE
 
-                if val is not None:
-                    return val
-                else:
+    def collapse_merges(self, key, versions, bottommost=False, deleted_seq=0):
+        """
+        Combines the merge operands at the top of the versions of a key
+        (newest first) into a single version with the newest operand's
+        sequence number. With a version below the operands that's the value
+        they merge into. Without one the operands are only partially merged,
+        unless the versions are `bottommost` and there's nothing else they
+        could merge into. Versions older than `deleted_seq` count as deleted.
+        """
+        operands = []
+        rest = []
+        for i, (seq, kind, value) in enumerate(versions):
+            if kind != KIND_MERGE or seq < deleted_seq:
+                rest = versions[i:]
+                break
+            operands.append(value)
+
+        if not operands:
+            return versions
+
+        merge_operator = self.merge_operator
+        if merge_operator is None:
+            raise ValueError(f"{key!r} has merge operands but no merge operator")
+
+        top_seq = versions[0][0]
+        operands.reverse()
+        if rest and rest[0][0] < deleted_seq:
+            value = merge_operator.full_merge(key, None, operands)
+            return [(top_seq, KIND_VALUE, value)] + rest
+        if rest:
+            _, kind, value = rest[0]
+            kind, value = expire(kind, value, self.clock())
+            if kind == KIND_EXPIRING:
+                # The merged value expires when the value it merged into does
+                existing = value[EXPIRY_SIZE:]
+                value = value[:EXPIRY_SIZE] + merge_operator.full_merge(
+                    key, existing, operands
+                )
+            else:
+                existing = self.resolve(kind, value)
+                kind, value = KIND_VALUE, merge_operator.full_merge(
+                    key, None if existing == TOMBSTONE else existing, operands
+                )
+            return [(top_seq, kind, value)] + rest[1:]
+        if bottommost:
+            value = merge_operator.full_merge(key, None, operands)
+            return [(top_seq, KIND_VALUE, value)]
+        if len(operands) > 1:
+            value = merge_operator.partial_merge(key, operands)
+            if value is not None:
+                return [(top_seq, KIND_MERGE, value)]
+        return versions
+
+    def find_in_segment_file(self, key, seq=None):
+        """
+        Returns the newest `(seq, kind, value)` version of `key` in the segment
+        files. Raises KeyError if there isn't one or it's been deleted by a
+        range tombstone.
+        """
+        stats = self.statistics
+        sparse_index = self.sparse_index
+        probed = 0
+        deleted_seq = 0
+
+        try:
+            while sparse_index:
+                if not sparse_index.in_range(key):
+                    sparse_index = sparse_index.next
+                    continue
+
+                if sparse_index.range_tombstones:
+                    deleted_seq = max(
+                        deleted_seq, sparse_index.range_tombstones.covering(key, seq)
+                    )
+                if deleted_seq and sparse_index.max_seq < deleted_seq:
+                    # Older segments only have older versions
+                    break
+
+                stats.incr_segment("bloom.checks", sparse_index.segment)
+                bloom_hit = key in sparse_index.bloomfilter
+                if self.listeners:
+                    self.notify(
+                        "on_segment_probe", sparse_index.segment, key, bloom_hit
+                    )
+
+                if not bloom_hit:
+                    stats.incr_segment("bloom.negatives", sparse_index.segment)
                     sparse_index = sparse_index.next
+                    continue
+
+                probed += 1
+                with Segment(
+                    id=sparse_index.segment, db_dir=self.db_dir, stats=stats
+                ) as segment:
+                    start, end = sparse_index.locate(key, segment, self.block_cache)
+                    block = self.read_block(segment, start, end)
+                    version = self.find_in_block(key, block, seq)
+
+                    if version is not None:
+                        if version[0] < deleted_seq:
+                            break
+                        return version
+                    else:
+                        stats.incr_segment(
+                            "bloom.false_positives", sparse_index.segment
+                        )
+                        sparse_index = sparse_index.next
+        finally:
+            stats.incr("get.segments_probed", probed)
 
         raise KeyError(key)
 
-    def find_in_block(self, key, raw_block):
-        for k, v in Block.iter_from_binary(raw_block):
-            if k == key:
-                return v
-        return None
+    def read_block(self, segment, start, end):
+        cache_key = (segment.id, start)
+        block = self.block_cache.get(cache_key)
+        if block is not None:
+            return block
+
+        read_start = time.perf_counter()
+        block = segment.read_range(start, end)
+        if self.listeners:
+            self.notify(
+                "on_block_read",
+                segment.id,
+                start,
+                end - start,
+                time.perf_counter() - read_start,
+            )
+
+        self.block_cache.put(cache_key, block, len(block))
+        return block
+
+    def find_in_block(self, key, raw_block, seq=None):
+        return BlockView.from_binary(raw_block, stats=self.statistics).find(key, seq)
+
+    def scan(self, start=None, end=None, snapshot=None):
+        """
+        Yields the `(key, value)` pairs with `start <= key < end` in key order.
+        The scan reads from a snapshot (an implicit one if none is given) so it
+        is unaffected by writes, flushes and compactions that happen while it
+        is running.
+        """
+        for key, _, kind, value in self.scan_entries(start, end, snapshot):
+            value = self.resolve(kind, value)
+            if value != TOMBSTONE:
+                yield key, value
+
+    def scan_prefix(self, prefix, snapshot=None):
+        """
+        Yields the `(key, value)` pairs of the keys starting with `prefix` in
+        key order. Segments whose prefix bloom filter rules out `prefix` aren't
+        read at all, see `prefix_length`.
+        """
+        entries = self.scan_entries(prefix, prefix_end(prefix), snapshot, prefix)
+        for key, _, kind, value in entries:
+            value = self.resolve(kind, value)
+            if value != TOMBSTONE:
+                yield key, value
+
+    def scan_entries(self, start=None, end=None, snapshot=None, prefix=None):
+        """
+        Like `scan` but yields the newest visible version of every key as a
+        stored `(key, seq, kind, value)` entry, tombstones included. Keys
+        deleted by a range tombstone are skipped. With a `prefix` (that all
+        keys in the range start with) segments without it are skipped.
+        """
+        owns_snapshot = snapshot is None
+        if owns_snapshot:
+            snapshot = self.snapshot()
+
+        segments = []
+        try:
+            with self.sparse_index_lock:
+                # Read now, a flush right after the lock is released would
+                # swap in an empty RBTree while the segments are already taken
+                sources = [list(self.iter_rbtree_entries(start, end))]
+                range_tombstones = RangeTombstones(self.range_tombstones)
+                sparse_index = self.sparse_index
+                while sparse_index:
+                    range_tombstones.extend(sparse_index.range_tombstones)
+                    if prefix is not None and not sparse_index.may_contain_prefix(
+                        prefix
+                    ):
+                        self.statistics.incr("scan.prefix_skips")
+                        sparse_index = sparse_index.next
+                        continue
+                    segment = Segment(id=sparse_index.segment, db_dir=self.db_dir)
+                    segment.open()
+                    segments.append(segment)
+                    sources.append(
+                        iter_segment_entries(
+                            segment, sparse_index, start, end, self.statistics
+                        )
+                    )
+                    sparse_index = sparse_index.next
+
+            for key, versions in iter_versions(sources):
+                visible = []
+                for seq, kind, value in versions:
+                    if seq <= snapshot.seq:
+                        if range_tombstones and seq < range_tombstones.covering(
+                            key, snapshot.seq
+                        ):
+                            break
+                        visible.append((seq, kind, value))
+                        if kind != KIND_MERGE:
+                            break
+
+                if visible and visible[0][1] == KIND_MERGE:
+                    visible = self.collapse_merges(key, visible, bottommost=True)
+                if visible:
+                    yield (key, *visible[0])
+        finally:
+            for segment in segments:
+                segment.close()
+            if owns_snapshot:
+                snapshot.release()
+
+    def iter_flush_entries(self):
+        """
+        The entries of the RBTree to flush. Merge operands are collapsed when
+        no snapshot needs the versions between them.
+        """
+        collapse = self.merge_operator is not None and not self.snapshots
+        for key, versions in self.rbtree.items():
+            versions = list(versions)
+            if collapse and versions[0][1] == KIND_MERGE:
+                deleted_seq = self.range_tombstones.covering(key)
+                versions = self.collapse_merges(key, versions, deleted_seq=deleted_seq)
+            for seq, kind, value in versions:
+                yield key, seq, kind, value
+
+    def iter_rbtree_entries(self, start=None, end=None):
+        for key, versions in self.rbtree.items(start, end):
+            for seq, kind, value in list(versions):
+                yield key, seq, kind, value
 
     def flush_tree(self):
         """
         Write the RBtree to disk and build a sparse index that points to offsets
         in the disk. Update the sparse index linked list and then finally
-        replace the RBtree with a new one.
+        replace the RBtree with a new one. Callers should hold the
+        `sparse_index_lock`, writers are kept out until the RBTree and WAL are
+        replaced so no write lands in between.
         """
-        with Segment(self.sparse_index_counter, self.db_dir) as segment:
-            index = SparseIndex(entries=[], segment=segment.id)
-            block = Block()
+        with self.write_lock:
+            flushed = self._flush_tree()
+        if flushed is None:
+            return
 
-            for key, val in self.rbtree.items():
-                block.add(key, val)
-                index.bloomfilter.add(key)
+        segment, flushed_bytes, duration = flushed
+        if self.listeners:
+            self.notify("on_flush_end", segment, flushed_bytes, duration)
+        if self.compaction_scheduler is not None:
+            self.compaction_scheduler.schedule(self)
 
-                if len(block) > BLOCK_SIZE:
-                    bytes_written = segment.write(
-                        block.dump(compress=BLOCK_COMPRESSION)
-                    )
-                    eof_pos = segment.tell_eof
-                    index.add(block.key, (eof_pos - bytes_written, eof_pos))
-                    block = Block()
-
-            # write whatever is left
-            if block.data:
-                bytes_written = segment.write(block.dump(compress=BLOCK_COMPRESSION))
-                index.add(
-                    block.key, (segment.tell_eof - bytes_written, segment.tell_eof)
-                )
+    def _flush_tree(self):
+        if not len(self.rbtree) and not self.range_tombstones:
+            self.current_size_bytes = 0
+            self.wal.reset()
+            return None
 
-        if self.sparse_index is None:
-            self.sparse_index = index
-        else:
-            old_head = self.sparse_index
-            index.next = old_head
-            self.sparse_index = index
+        start = time.perf_counter()
+        segment_id = self.manifest.new_segment_id()
+        if self.listeners:
+            self.notify("on_flush_begin", segment_id)
 
-        self.sparse_index_counter += 1
+        # Values that already expired only need to be written as tombstones
+        now = self.clock()
+        entries = (
+            (key, seq, *expire(kind, value, now))
+            for key, seq, kind, value in self.iter_flush_entries()
+        )
+        # Large values go to a blob file sharing the segment's id
+        blob_file = self.new_blob_file(segment_id)
+        if self.blob_threshold:
+            entries = separate_values(entries, blob_file, self.blob_threshold)
+
+        with SegmentWriter(segment_id, self.db_dir, stats=self.statistics) as segment:
+            index = self.write_segment(
+                segment, entries, range_tombstones=self.range_tombstones
+            )
+            flushed_bytes = segment.tell_eof
+            self.statistics.incr("flush.bytes", flushed_bytes)
+        blob_file.close()
+        add_blobs = []
+        if blob_file.size:
+            add_blobs.append(BlobMeta(blob_file.id, blob_file.size))
+            self.statistics.incr("blob.bytes_written", blob_file.size)
+        fsync_dir(self.db_dir)
+
+        # The segment only becomes part of the database once it's recorded in
+        # the manifest. If we crash before that the WAL still has everything.
+        self.install_segments(
+            add=[index],
+            add_blobs=add_blobs,
+            last_seq=max(self.manifest.last_seq, index.max_seq),
+        )
+        if self.row_cache is not None:
+            # The flushed versions are newer than anything cached for the keys
+            self.row_cache.evict_keys(self.rbtree)
+            for range_start, range_end, _ in self.range_tombstones:
+                self.row_cache.evict_range(range_start, range_end)
         self.rbtree = RBTree()
+        self.range_tombstones = RangeTombstones()
+        self.current_size_bytes = 0
         self.wal.reset()
+        duration = time.perf_counter() - start
+        self.statistics.record_time("flush", duration)
+        return index.segment, flushed_bytes, duration
+
+    def write_segment(self, segment, entries, range_tombstones=()):
+        """
+        `write_entries` with the memtable's block and bloom filter settings.
+        """
+        return write_entries(
+            segment,
+            entries,
+            self.index_partition_entries,
+            range_tombstones=range_tombstones,
+            block_size=self.block_size,
+            compress=self.block_compression,
+            bloom_size=self.bloom_filter_size,
+            bloom_hashes=self.bloom_filter_hashes,
+            prefix_length=self.prefix_length,
+        )
+
+    def new_blob_file(self, blob_id):
+        return BlobFile(blob_id, self.db_dir, compress=self.block_compression)
 
     @classmethod
-    def reconstruct(cls, db_dir):
+    def reconstruct(cls, db_dir, lazy=False, workers=RECOVERY_WORKERS, **options):
+        """
+        Rebuilds a memtable from a database directory. Segment indexes are
+        loaded on a pool of `workers` threads. With `lazy` the memtable is
+        returned as soon as the WAL is replayed and the indexes load in the
+        background (or on first use), see `wait_for_recovery`. Any `options`
+        are passed on to the memtable.
+        """
+        start = time.perf_counter()
+        memtable = cls(db_dir, **options)
+        manifest = memtable.manifest
+
+        if manifest.exists:
+            # The manifest only references fully written segments. Anything
+            # else in the directory is left over from a flush or compaction
+            # that didn't finish.
+            live = set(manifest.live_ids())
+            for segment_id in list_segments(db_dir):
+                if segment_id not in live:
+                    Segment(id=segment_id, db_dir=db_dir).remove()
+            for segment_id in list_segments(db_dir, fname="_compact_segment"):
+                os.remove(os.path.join(db_dir, f"_compact_segment.{segment_id}"))
+            for blob_id in list_segments(db_dir, fname="blob"):
+                if blob_id not in manifest.blob_files:
+                    os.remove(BlobFile.path_for(db_dir, blob_id))
+            fsync_dir(db_dir)
+
+            if lazy:
+                indexes = [
+                    SparseIndex.lazy(
+                        meta,
+                        db_dir,
+                        bloom_size=memtable.bloom_filter_size,
+                        bloom_hashes=memtable.bloom_filter_hashes,
+                        prefix_length=memtable.prefix_length,
+                    )
+                    for meta in manifest.segments
+                ]
+                memtable.load_indexes_in_background(indexes, workers)
+            else:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    indexes = list(pool.map(memtable.load_index, manifest.segments))
+            memtable.link_indexes(indexes)
+            memtable.last_seq = manifest.last_seq
+            memtable.update_write_controller()
+        else:
+            memtable.reconstruct_from_listing()
+
+        if manifest.edits > 1:
+            manifest.rewrite()
+
+        for batch in memtable.wal.iter_batches():
+            memtable.apply_batch(batch)
+
+        memtable.statistics.record_time("recovery", time.perf_counter() - start)
+        return memtable
+
+    def load_index(self, meta):
+        with Segment(id=meta.id, db_dir=self.db_dir) as segment:
+            try:
+                index = SparseIndex.from_segment(
+                    segment,
+                    self.bloom_filter_size,
+                    self.bloom_filter_hashes,
+                    self.prefix_length,
+                )
+            except BlockCorruption:
+                raise Exception(f"Corruption on {meta.id} - unrecoverable")
+        index.level = meta.level
+        return index
+
+    def load_indexes_in_background(self, indexes, workers=RECOVERY_WORKERS):
+        """
+        Loads lazy indexes on a pool of threads, newest segments first since
+        they're the most likely to be read. Reads that need an index before
+        the pool gets to it just load it themselves.
+        """
+        pool = ThreadPoolExecutor(max_workers=workers)
+        self.recovery_futures = [
+            pool.submit(index.ensure_loaded) for index in reversed(indexes)
+        ]
+        pool.shutdown(wait=False)
+
+    def wait_for_recovery(self):
+        for future in self.recovery_futures:
+            future.result()
+
+    def apply_batch(self, entries):
+        """
+        Applies a batch of replayed WAL entries. Nothing can hold a snapshot
+        during recovery so only the newest version of each key is applied,
+        along with the merge operands on top of it. Entries that already made
+        it into a segment are skipped.
+        """
+        latest = {}
+        flushed_seq = self.manifest.last_seq
+        for key, seq, kind, value in entries:
+            if seq and seq <= flushed_seq:
+                continue
+            self.last_seq = max(self.last_seq, seq)
+            if kind == KIND_RANGE_DELETE:
+                # Keyed by their start so they can't be deduplicated with
+                # the point writes
+                self.apply(key, seq, kind, value)
+                continue
+
+            latest.setdefault(key, []).append((seq, kind, value))
+
+        for key, versions in latest.items():
+            versions.sort(key=lambda version: version[0])
+            # Only merge operands need the versions below them
+            base = max(
+                (i for i, version in enumerate(versions) if version[1] != KIND_MERGE),
+                default=0,
+            )
+            for seq, kind, value in versions[base:]:
+                if kind == KIND_MERGE or self.rbtree.get(key) is None:
+                    self.current_size_bytes += len(key) + len(value)
+                self.apply(key, seq, kind, value)
+
+    def reconstruct_from_listing(self):
+        """
+        Databases written before the manifest existed are rebuilt from the
+        segment files in the directory, and a manifest is created for them.
+        """
         # Check the last segment file for corruption in case we crashed mid
         # write. If so discard the file
         # Rebuild from WAL
-        memtable = cls(db_dir)
-        segment_ids = sorted(list_segments(db_dir))
+        segment_ids = sorted(list_segments(self.db_dir))
+        indexes = []
 
         # rebuild the sparse index
         for segment_id in segment_ids:
-            with Segment(id=segment_id, db_dir=db_dir) as segment:
-                index = SparseIndex(entries=[], segment=segment_id)
-                corrupted = False
-
-                for offset, _, size, block in segment:
-                    if Block.is_block_corrupted(block) and segment_id != max(
-                        segment_ids
-                    ):
+            with Segment(id=segment_id, db_dir=self.db_dir) as segment:
+                try:
+                    indexes.append(
+                        SparseIndex.from_segment(
+                            segment,
+                            self.bloom_filter_size,
+                            self.bloom_filter_hashes,
+                            self.prefix_length,
+                        )
+                    )
+                except BlockCorruption:
+                    if segment_id != max(segment_ids):
                         raise Exception(f"Corruption on {segment_id} - unrecoverable")
-                    elif Block.is_block_corrupted(block) and segment_id == max(
-                        segment_ids
-                    ):
-                        # The WAL will rebuild this
-                        corrupted = True
-                        break
+                    # The WAL will rebuild this
+                    print("Segment corrupted, removing")
+                    segment.remove()
 
-                    first_key = None
-                    for k, v in Block.iter_from_binary(block):
-                        if first_key is None:
-                            first_key = k
-                        index.bloomfilter.add(k)
+        with self.sparse_index_lock:
+            self.last_seq = max([index.max_seq for index in indexes], default=0)
+            self.install_segments(add=indexes, last_seq=self.last_seq)
 
-                    index.add(first_key, (offset, offset + size + Block.HEADER_SIZE))
 
-            if corrupted:
-                print("Segment corrupted, removing")
-                segment.remove()
-            else:
-                if memtable.sparse_index is None:
-                    memtable.sparse_index = index
-                else:
-                    old_index = memtable.sparse_index
-                    memtable.sparse_index = index
-                    index.next = old_index
-                memtable.sparse_index_counter = memtable.sparse_index.segment + 1
+class Snapshot:
+    """
+    A handle on a point in time view of the database. Everything written with a
+    sequence number up to and including `seq` is visible.
+    """
 
-        for k, v in memtable.wal:
-            memtable.rbtree[k] = v
+    def __init__(self, memtable, seq):
+        self.memtable = memtable
+        self.seq = seq
 
-        return memtable
+    def get(self, key):
+        return self.memtable.get(key, snapshot=self)
+
+    def scan(self, start=None, end=None):
+        return self.memtable.scan(start, end, snapshot=self)
+
+    def release(self):
+        self.memtable.release_snapshot(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def expire(kind, value, now):
+    """
+    Returns `(kind, value)` as is, or a tombstone if it's a value that expired
+    before `now` (in seconds).
+    """
+    if kind == KIND_EXPIRING and unpack_from(EXPIRY_FMT, value)[0] <= now * 1000:
+        return KIND_VALUE, TOMBSTONE
+    return kind, value
+
+
+def write_entries(
+    segment,
+    entries,
+    partition_entries=INDEX_PARTITION_ENTRIES,
+    range_tombstones=(),
+    block_size=BLOCK_SIZE,
+    compress=BLOCK_COMPRESSION,
+    bloom_size=BLOOM_FILTER_SIZE,
+    bloom_hashes=BLOOM_FILTER_HASHES,
+    prefix_length=None,
+):
+    """
+    Writes `(key, seq, kind, value)` entries in key order into blocks of the
+    segment file and returns the sparse index for it. All the versions of a key
+    are kept in the same block so the first keys in the sparse index are
+    unique. `range_tombstones` are written in a block of their own after the
+    entries.
+
+    If the sparse index ends up with more than `partition_entries` entries it
+    is also written to the end of the segment in partitions and only the top
+    level index over those partitions is kept in memory.
+    """
+    index = SparseIndex(
+        entries=[],
+        segment=segment.id,
+        bloom_size=bloom_size,
+        bloom_hashes=bloom_hashes,
+        prefix_length=prefix_length,
+    )
+    block = Block()
+
+    for key, seq, kind, val in entries:
+        if len(block) > block_size and key != block.last_key:
+            bytes_written = segment.write(
+                block.dump(compress=compress, offset_table=True)
+            )
+            eof_pos = segment.tell_eof
+            index.add(block.key, (eof_pos - bytes_written, eof_pos))
+            block = Block()
+
+        block.add(key, val, seq=seq, kind=kind)
+        index.add_to_filters(key)
+        index.largest = key
+        index.max_seq = max(index.max_seq, seq)
+        index.track_expiry(kind, val)
+        index.count_entry(val)
+        if kind == KIND_BLOB:
+            index.blob_refs.add(unpack_pointer(val)[0])
+
+    # write whatever is left
+    if block.data:
+        bytes_written = segment.write(block.dump(compress=compress, offset_table=True))
+        index.add(block.key, (segment.tell_eof - bytes_written, segment.tell_eof))
+
+    if range_tombstones:
+        block = Block()
+        for start, end, seq in range_tombstones:
+            block.add(start, end, seq=seq, kind=KIND_RANGE_DELETE)
+        segment.write(block.dump(compress=compress, flags=Block.RANGE_DELETE_FLAG))
+        index.add_range_tombstones(range_tombstones)
+
+    if partition_entries and len(index.packed) > partition_entries:
+        index.partition(segment, partition_entries, compress=compress)
+
+    return index
+
+
+def prefix_end(prefix):
+    """
+    The smallest key greater than every key starting with `prefix`, None if
+    there isn't one.
+    """
+    prefix = prefix.rstrip(b"\xff")
+    if not prefix:
+        return None
+    return prefix[:-1] + bytes([prefix[-1] + 1])
+
+
+def iter_segment_entries(segment, sparse_index, start=None, end=None, stats=None):
+    """
+    Yields the `(key, seq, kind, value)` entries of an open segment file with
+    `start <= key < end`, skipping straight to the block `start` would be in.
+    """
+    offset = 0
+    packed = sparse_index.packed
+    if start is not None and packed and packed.key(0) <= start:
+        offset = sparse_index.locate(start, segment)[0]
+
+    for _, _, _, raw_block in segment.iter_data_blocks(offset):
+        for key, seq, kind, value in Block.iter_entries_from_binary(
+            raw_block, stats=stats
+        ):
+            if start is not None and key < start:
+                continue
+            if end is not None and key >= end:
+                return
+            yield key, seq, kind, value
+
+
+def iter_versions(sources):
+    """
+    Merges sources of `(key, seq, kind, value)` entries ordered by key. Sources
+    are given newest first. Yields every key once along with its versions as
+    `(seq, kind, value)` newest first.
+    """
+
+    def ranked(source, rank):
+        # Entries written before sequence numbers existed all have a sequence
+        # number of 0, so ties are broken by how new the source is.
+        for key, seq, kind, value in source:
+            yield key, -seq, rank, kind, value
+
+    merged = heapq.merge(*[ranked(source, rank) for rank, source in enumerate(sources)])
+    current_key = None
+    versions = []
+    for key, neg_seq, _, kind, value in merged:
+        if key != current_key and versions:
+            yield current_key, versions
+            versions = []
+        current_key = key
+        versions.append((-neg_seq, kind, value))
+
+    if versions:
+        yield current_key, versions
 
 
 class SparseIndex:
@@ -188,45 +1325,419 @@ class SparseIndex:
     It's possible a key doesn't exist in the sparse index, but fall into a range
     between two other keys. In that case the lower of the two keys is taken.
 
+    The entries are stored in a `PackedIndex` rather than as a list of tuples
+    to keep the memory overhead per block low. For large segments the index is
+    partitioned: the partitions are written as index blocks at the end of the
+    segment file and only a top level index over the partitions is kept in
+    memory. Partitions are read on demand through the block cache.
+
     The sparse index forms a linked list where the head is always the newest
     segment file. That way when searching for a key if it's not found in the
     first segment file we can get the next sparse index + segment file and
     check there.
     """
 
-    def __init__(self, entries, segment, sort=True):
-        self.entries = entries
+    def __init__(
+        self,
+        entries,
+        segment,
+        sort=True,
+        level=0,
+        bloom_size=BLOOM_FILTER_SIZE,
+        bloom_hashes=BLOOM_FILTER_HASHES,
+        prefix_length=None,
+    ):
+        if sort:
+            entries = sorted(entries, key=lambda t: t[0])
+        self._packed = PackedIndex(entries)
+        self.partitioned = False
         self.segment = segment
+        self.level = level
+        self._smallest = None
+        self.largest = None
+        self.max_seq = 0
+        # When every value in the segment expires this is the time (in
+        # milliseconds) at which the last one does. None otherwise.
+        self.expires_at = None
+        self._expires = True
+        self.num_entries = 0
+        self.num_tombstones = 0
+        # The ids of the blob files the segment points into
+        self.blob_refs = set()
+        self._range_tombstones = RangeTombstones()
         self.next = None
-        self.bloomfilter = BloomFilter(
-            size=BLOOM_FILTER_SIZE, hashes=BLOOM_FILTER_HASHES
+        self._bloomfilter = BloomFilter(size=bloom_size, hashes=bloom_hashes)
+        # The first `prefix_length` bytes of every key long enough to have
+        # them, so prefix scans can skip the segment
+        self.prefix_length = prefix_length
+        self._prefix_bloomfilter = None
+        if prefix_length:
+            self._prefix_bloomfilter = BloomFilter(size=bloom_size, hashes=bloom_hashes)
+        # Set for indexes that haven't been read from their segment file yet.
+        self._pending_db_dir = None
+        self._load_lock = None
+        # Called with the index and what it took up before once it's loaded
+        self.on_load = None
+
+    @classmethod
+    def lazy(
+        cls,
+        meta,
+        db_dir,
+        bloom_size=BLOOM_FILTER_SIZE,
+        bloom_hashes=BLOOM_FILTER_HASHES,
+        prefix_length=None,
+    ):
+        """
+        An index for a segment that is only read from disk the first time its
+        entries or bloom filter are needed. The key range comes from the
+        manifest so segments can be ruled out without loading them.
+        """
+        index = cls(
+            entries=[],
+            segment=meta.id,
+            level=meta.level,
+            bloom_size=bloom_size,
+            bloom_hashes=bloom_hashes,
+            prefix_length=prefix_length,
         )
+        index._smallest = meta.smallest
+        index.largest = meta.largest
+        index.max_seq = meta.max_seq
+        index.expires_at = meta.expires_at
+        index.num_entries = meta.num_entries
+        index.num_tombstones = meta.num_tombstones
+        index.blob_refs = set(meta.blob_refs)
+        index._pending_db_dir = db_dir
+        index._load_lock = Lock()
+        return index
 
-        if sort:
-            self.sort()
+    def ensure_loaded(self):
+        if self._pending_db_dir is None:
+            return
+
+        with self._load_lock:
+            if self._pending_db_dir is None:
+                return
+
+            with Segment(id=self.segment, db_dir=self._pending_db_dir) as segment:
+                try:
+                    loaded = SparseIndex.from_segment(
+                        segment,
+                        self._bloomfilter.size,
+                        self._bloomfilter.hashes,
+                        self.prefix_length,
+                    )
+                except BlockCorruption:
+                    raise Exception(f"Corruption on {self.segment} - unrecoverable")
+
+            index_bytes, filter_bytes = self.index_nbytes, self.filter_nbytes
+            self._packed = loaded._packed
+            self.partitioned = loaded.partitioned
+            self._bloomfilter = loaded._bloomfilter
+            self._prefix_bloomfilter = loaded._prefix_bloomfilter
+            self._range_tombstones = loaded._range_tombstones
+            self._pending_db_dir = None
+            on_load = self.on_load
+            if on_load is not None:
+                on_load(self, index_bytes, filter_bytes)
+
+    @property
+    def loaded(self):
+        return self._pending_db_dir is None
+
+    @property
+    def packed(self):
+        if self._pending_db_dir is not None:
+            self.ensure_loaded()
+        return self._packed
+
+    @property
+    def entries(self):
+        return list(self.packed)
+
+    @property
+    def bloomfilter(self):
+        if self._pending_db_dir is not None:
+            self.ensure_loaded()
+        return self._bloomfilter
+
+    @property
+    def prefix_bloomfilter(self):
+        if self._pending_db_dir is not None:
+            self.ensure_loaded()
+        return self._prefix_bloomfilter
+
+    @property
+    def range_tombstones(self):
+        if self._pending_db_dir is not None:
+            self.ensure_loaded()
+        return self._range_tombstones
+
+    @classmethod
+    def from_segment(
+        cls,
+        segment,
+        bloom_size=BLOOM_FILTER_SIZE,
+        bloom_hashes=BLOOM_FILTER_HASHES,
+        prefix_length=None,
+    ):
+        """
+        Rebuilds the index of a segment file by reading all of its blocks.
+        Raises `BlockCorruption` if any of them fail their checksum.
+        """
+        index = cls(
+            entries=[],
+            segment=segment.id,
+            bloom_size=bloom_size,
+            bloom_hashes=bloom_hashes,
+            prefix_length=prefix_length,
+        )
+        partitions = PackedIndex()
+        range_tombstones = []
+
+        for offset, flags, size, block in segment:
+            if Block.is_block_corrupted(block):
+                raise BlockCorruption(segment.id)
+
+            end = offset + size + Block.HEADER_SIZE
+            if flags & Block.INDEX_FLAG:
+                partitions.append(next(Block.iter_from_binary(block))[0], (offset, end))
+                continue
+
+            if flags & Block.RANGE_DELETE_FLAG:
+                range_tombstones = [
+                    (start, end, seq)
+                    for start, seq, _, end in Block.iter_entries_from_binary(block)
+                ]
+                continue
+
+            first_key = None
+            for k, seq, kind, value in Block.iter_entries_from_binary(block):
+                if first_key is None:
+                    first_key = k
+                index.add_to_filters(k)
+                index.largest = k
+                index.max_seq = max(index.max_seq, seq)
+                index.track_expiry(kind, value)
+                index.count_entry(value)
+                if kind == KIND_BLOB:
+                    index.blob_refs.add(unpack_pointer(value)[0])
+
+            index.add(first_key, (offset, end))
+
+        if partitions:
+            index._smallest = index.smallest
+            index._packed = partitions
+            index.partitioned = True
+
+        if range_tombstones:
+            index.add_range_tombstones(range_tombstones)
+
+        return index
+
+    def add_range_tombstones(self, range_tombstones):
+        """
+        Adds the range tombstones written to the segment and widens the key
+        range of the index to include the keys they delete.
+        """
+        self._range_tombstones.extend(range_tombstones)
+        tombstones = self._range_tombstones
+        self.num_entries += len(range_tombstones)
+        self.num_tombstones += len(range_tombstones)
+        self._smallest = min(
+            key for key in (self.smallest, tombstones.smallest) if key is not None
+        )
+        self.largest = max(
+            key for key in (self.largest, tombstones.largest) if key is not None
+        )
+        self.max_seq = max([self.max_seq] + [seq for _, _, seq in tombstones])
+
+    def add_to_filters(self, key):
+        self.bloomfilter.add(key)
+        if self._prefix_bloomfilter is not None and len(key) >= self.prefix_length:
+            self._prefix_bloomfilter.add(key[: self.prefix_length])
+
+    def may_contain_prefix(self, prefix):
+        """
+        Whether the segment might have keys starting with `prefix`. Only
+        prefixes at least `prefix_length` long can be checked against the
+        prefix bloom filter, shorter ones are only checked against the key
+        range.
+        """
+        smallest, largest = self.smallest, self.largest
+        if smallest is not None and largest is not None:
+            end = prefix_end(prefix)
+            if largest < prefix or (end is not None and smallest >= end):
+                return False
 
-    def sort(self):
-        self.entries = sorted(self.entries, key=lambda t: t[0])
+        if self.prefix_length and len(prefix) >= self.prefix_length:
+            return prefix[: self.prefix_length] in self.prefix_bloomfilter
+        return True
+
+    def count_entry(self, value):
+        self.num_entries += 1
+        if value == TOMBSTONE:
+            self.num_tombstones += 1
+
+    def track_expiry(self, kind, value):
+        if kind == KIND_EXPIRING:
+            expires_at = unpack_from(EXPIRY_FMT, value)[0]
+            if self._expires:
+                self.expires_at = max(self.expires_at or 0, expires_at)
+        elif value != TOMBSTONE:
+            self._expires = False
+            self.expires_at = None
+
+    @property
+    def smallest(self):
+        if self._smallest is not None:
+            return self._smallest
+        return self.packed.key(0) if self.packed else None
+
+    def in_range(self, key):
+        smallest = self.smallest
+        if smallest is None or self.largest is None:
+            return False
+        return smallest <= key <= self.largest
 
     def add(self, key, offset):
-        self.entries.append((key, offset))
+        self._packed.append(key, offset)
+
+    def find(self, key):
+        return self.packed.find(key)
+
+    def locate(self, key, segment, cache=None):
+        """
+        Finds the byte offsets of the block `key` would be in. Partitioned
+        indexes first find the partition, read it (or get it from the cache)
+        and then search it.
+        """
+        offsets = self.find(key)
+        if not self.partitioned:
+            return offsets
+
+        cache_key = (self.segment, offsets[0])
+        partition = cache.get(cache_key) if cache is not None else None
+        if partition is None:
+            partition = PackedIndex.from_block(segment.read_range(*offsets))
+            if cache is not None:
+                cache.put(cache_key, partition, partition.nbytes)
+
+        return partition.find(key)
+
+    def partition(self, segment, partition_entries, compress=BLOCK_COMPRESSION):
+        """
+        Writes the index to the end of the segment in partitions of
+        `partition_entries` entries and replaces it with an index over the
+        partitions.
+        """
+        self._smallest = self.smallest
+        partitions = PackedIndex()
+        entries = self._packed
+
+        for i in range(0, len(entries), partition_entries):
+            block = Block()
+            for j in range(i, min(i + partition_entries, len(entries))):
+                key, (start, end) = entries[j]
+                block.add(key, pack(PackedIndex.OFFSETS_FMT, start, end))
+
+            bytes_written = segment.write(
+                block.dump(compress=compress, flags=Block.INDEX_FLAG)
+            )
+            eof_pos = segment.tell_eof
+            partitions.append(block.key, (eof_pos - bytes_written, eof_pos))
+
+        self._packed = partitions
+        self.partitioned = True
+
+    @property
+    def index_nbytes(self):
+        # Indexes that aren't loaded yet are left unloaded
+        return self._packed.nbytes
+
+    @property
+    def filter_nbytes(self):
+        nbytes = self._bloomfilter.nbytes
+        if self._prefix_bloomfilter is not None:
+            nbytes += self._prefix_bloomfilter.nbytes
+        return nbytes
+
+    @property
+    def nbytes(self):
+        return self.index_nbytes + self.filter_nbytes
+
+
+class PackedIndex:
+    """
+    Sorted `(key, (start, end))` entries packed into a contiguous key buffer and
+    arrays of offsets. Compared to a list of tuples this is a few flat buffers
+    per index instead of several Python objects per entry.
+    """
+
+    OFFSETS_FMT = "<QQ"
+
+    def __init__(self, entries=()):
+        self.keys = bytearray()
+        self.key_offsets = array("Q", [0])
+        self.starts = array("Q")
+        self.ends = array("Q")
+
+        for key, offset in entries:
+            self.append(key, offset)
+
+    @classmethod
+    def from_block(cls, raw_block):
+        packed = cls()
+        for key, value in Block.iter_from_binary(raw_block):
+            packed.append(key, unpack(cls.OFFSETS_FMT, value))
+        return packed
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        return self.key(i), (self.starts[i], self.ends[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def key(self, i):
+        return bytes(self.keys[self.key_offsets[i] : self.key_offsets[i + 1]])
+
+    def append(self, key, offset):
+        start, end = offset
+        self.keys += key
+        self.key_offsets.append(len(self.keys))
+        self.starts.append(start)
+        self.ends.append(end)
 
     def find(self, key):
         low = 0
-        high = len(self.entries) - 1
+        high = len(self) - 1
 
         while low <= high:
             middle = low + (high - low) // 2
-            entry = self.entries[middle]
+            entry_key = self.key(middle)
 
-            if key < entry[0]:
+            if key < entry_key:
                 high = middle - 1
-            elif key > entry[0]:
+            elif key > entry_key:
                 low = middle + 1
             else:
-                return entry[1]
+                return self.starts[middle], self.ends[middle]
 
-        return self.entries[high][1]
+        return self.starts[high], self.ends[high]
+
+    @property
+    def nbytes(self):
+        return (
+            len(self.keys)
+            + self.key_offsets.itemsize * len(self.key_offsets)
+            + self.starts.itemsize * len(self.starts)
+            + self.ends.itemsize * len(self.ends)
+        )
 
 
 class BloomFilter:
@@ -237,6 +1748,10 @@ class BloomFilter:
         self._filter = [False] * size
         self._full = False
 
+    @property
+    def nbytes(self):
+        return sys.getsizeof(self._filter)
+
     def _get_hashed_indexes(self, item):
         indexes = []
         for i in range(self.hashes):
@@ -0,0 +1,67 @@
+"""
+Merge operators turn read-modify-write updates into blind writes. Instead of
+reading a value, changing it and writing it back, `MemTable.merge` writes only
+the change (an operand) and the operator combines the operands with the value
+below them when the key is read, flushed or compacted.
+"""
+from struct import pack, unpack
+
+
+class MergeOperator:
+    """
+    Subclasses implement `full_merge` and, optionally, `partial_merge`.
+    """
+
+    def full_merge(self, key, existing, operands):
+        """
+        Returns the value of `key` after applying `operands` (oldest first) to
+        the `existing` value, which is None if the key isn't set.
+        """
+        raise NotImplementedError
+
+    def partial_merge(self, key, operands):
+        """
+        Combines `operands` (oldest first) into a single operand without
+        knowing the value below them. Returns None if they can't be combined,
+        in which case they're kept as they are.
+        """
+        return None
+
+
+class CounterMergeOperator(MergeOperator):
+    """
+    Values and operands are signed 64 bit integers packed with `pack_counter`.
+    Merging adds them up.
+    """
+
+    def full_merge(self, key, existing, operands):
+        total = unpack_counter(existing) if existing else 0
+        return pack_counter(total + sum(unpack_counter(op) for op in operands))
+
+    def partial_merge(self, key, operands):
+        return pack_counter(sum(unpack_counter(op) for op in operands))
+
+
+class AppendMergeOperator(MergeOperator):
+    """
+    Appends operands to the value, separated by `delimiter`.
+    """
+
+    def __init__(self, delimiter=b","):
+        self.delimiter = delimiter
+
+    def full_merge(self, key, existing, operands):
+        if existing:
+            operands = [existing, *operands]
+        return self.delimiter.join(operands)
+
+    def partial_merge(self, key, operands):
+        return self.delimiter.join(operands)
+
+
+def pack_counter(n):
+    return pack("<q", n)
+
+
+def unpack_counter(value):
+    return unpack("<q", value)[0]
@@ -0,0 +1,76 @@
+"""
+Per instance tuning. The constants in `settings.py` are only the defaults, every
+memtable (and column family) can be tuned on its own with an `Options`.
+"""
+from .settings import (BLOB_THRESHOLD, BLOCK_CACHE_SIZE, BLOCK_COMPRESSION,
+                       BLOCK_SIZE, BLOOM_FILTER_HASHES, BLOOM_FILTER_SIZE,
+                       INDEX_PARTITION_ENTRIES, PREFIX_LENGTH,
+                       RBTREE_FLUSH_SIZE, ROW_CACHE_SIZE,
+                       TOMBSTONE_COMPACTION_RATIO)
+
+
+class Options:
+    """
+    The tunable options of a memtable, see `settings.py` for what each of them
+    does. Create a memtable with them with `MemTable(db_dir, **options.to_dict())`
+    and change the options of a live one with `MemTable.set_options`.
+    """
+
+    FIELDS = (
+        "flush_tree_size",
+        "block_cache_size",
+        "row_cache_size",
+        "index_partition_entries",
+        "blob_threshold",
+        "block_size",
+        "block_compression",
+        "bloom_filter_size",
+        "bloom_filter_hashes",
+        "prefix_length",
+        "tombstone_compaction_ratio",
+    )
+
+    def __init__(
+        self,
+        flush_tree_size=RBTREE_FLUSH_SIZE,
+        block_cache_size=BLOCK_CACHE_SIZE,
+        row_cache_size=ROW_CACHE_SIZE,
+        index_partition_entries=INDEX_PARTITION_ENTRIES,
+        blob_threshold=BLOB_THRESHOLD,
+        block_size=BLOCK_SIZE,
+        block_compression=BLOCK_COMPRESSION,
+        bloom_filter_size=BLOOM_FILTER_SIZE,
+        bloom_filter_hashes=BLOOM_FILTER_HASHES,
+        prefix_length=PREFIX_LENGTH,
+        tombstone_compaction_ratio=TOMBSTONE_COMPACTION_RATIO,
+    ):
+        self.flush_tree_size = flush_tree_size
+        self.block_cache_size = block_cache_size
+        self.row_cache_size = row_cache_size
+        self.index_partition_entries = index_partition_entries
+        self.blob_threshold = blob_threshold
+        self.block_size = block_size
+        self.block_compression = block_compression
+        self.bloom_filter_size = bloom_filter_size
+        self.bloom_filter_hashes = bloom_filter_hashes
+        self.prefix_length = prefix_length
+        self.tombstone_compaction_ratio = tombstone_compaction_ratio
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def copy(self, **changes):
+        return Options(**{**self.to_dict(), **changes})
+
+    def __eq__(self, other):
+        return isinstance(other, Options) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        fields = ", ".join(
+            f"{name}={value!r}" for name, value in self.to_dict().items()
+        )
+        return f"Options({fields})"
@@ -0,0 +1,109 @@
+"""
+The binary protocol spoken between `server.py` and `client.py`.
+
+Every request and response is a frame: a header holding the length of the
+payload, the id of the request and an op code (or a status for responses)
+followed by the payload. The payload is a list of fields, each prefixed by its
+length. Responses carry the id of the request they answer so clients can
+pipeline requests: send several without waiting on the replies.
+
++------------------------+-----------------------+-----------------------+---------+
+| 4 bytes payload length | 4 bytes request id    | 1 byte op code/status | payload |
++------------------------+-----------------------+-----------------------+---------+
+"""
+from struct import calcsize, pack, unpack_from
+
+HEADER_FMT = "<IIB"
+HEADER_SIZE = calcsize(HEADER_FMT)
+FIELD_FMT = "<I"
+FIELD_SIZE = calcsize(FIELD_FMT)
+# The length of a field standing for None
+NULL_FIELD = 0xFFFFFFFF
+TTL_FMT = "<d"
+SCAN_LIMIT_FMT = "<I"
+
+# Op codes
+GET = 1
+PUT = 2
+DELETE = 3
+DELETE_RANGE = 4
+MULTI_GET = 5
+SCAN = 6
+BATCH = 7
+
+# Statuses
+OK = 0
+NOT_FOUND = 1
+ERROR = 2
+
+# The `WriteBatch` op names and their op codes
+BATCH_OPS = {"put": PUT, "delete": DELETE, "delete_range": DELETE_RANGE}
+
+
+def pack_frame(request_id, code, fields=()):
+    payload = pack_fields(fields)
+    return pack(HEADER_FMT, len(payload), request_id, code) + payload
+
+
+def unpack_header(header):
+    """
+    Returns `(payload length, request id, op code or status)`.
+    """
+    return unpack_from(HEADER_FMT, header)
+
+
+def pack_fields(fields):
+    parts = []
+    for field in fields:
+        if field is None:
+            parts.append(pack(FIELD_FMT, NULL_FIELD))
+        else:
+            parts.append(pack(FIELD_FMT, len(field)))
+            parts.append(field)
+    return b"".join(parts)
+
+
+def unpack_fields(payload):
+    """
+    Raises `ValueError` for a payload that isn't a list of fields.
+    """
+    fields = []
+    offset = 0
+    while offset < len(payload):
+        if offset + FIELD_SIZE > len(payload):
+            raise ValueError("Truncated field length")
+        size = unpack_from(FIELD_FMT, payload, offset)[0]
+        offset += FIELD_SIZE
+        if size == NULL_FIELD:
+            fields.append(None)
+        else:
+            if offset + size > len(payload):
+                raise ValueError("Truncated field")
+            fields.append(bytes(payload[offset : offset + size]))
+            offset += size
+    return fields
+
+
+def pack_ttl(ttl):
+    return None if ttl is None else pack(TTL_FMT, ttl)
+
+
+def unpack_ttl(field):
+    return None if field is None else unpack_from(TTL_FMT, field)[0]
+
+
+def pack_batch(ops):
+    """
+    Flattens the `(op, key, value, ttl)` ops of a `WriteBatch` into fields,
+    four per op.
+    """
+    fields = []
+    for op, key, value, ttl in ops:
+        fields.extend((bytes([BATCH_OPS[op]]), key, value, pack_ttl(ttl)))
+    return fields
+
+
+def unpack_batch(fields):
+    for i in range(0, len(fields), 4):
+        code, key, value, ttl = fields[i : i + 4]
+        yield code[0], key, value, unpack_ttl(ttl)
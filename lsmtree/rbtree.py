@@ -116,23 +116,25 @@ class RBTree:
         self.root = self._set_recursive(self.root, key, value)
         self.root.color = BLACK
 
-    def _gather_keys(self, queue, node, include_items=False):
+    def _gather_keys(self, queue, node, include_items=False, start=None, end=None):
         """
-        Inorder tree traversal to get the keys in sorted order.
+        Inorder tree traversal to get the keys in sorted order. Subtrees that
+        can't have keys with `start <= key < end` aren't visited.
         """
         if node is None:
             return
 
-        if node.left:
-            self._gather_keys(queue, node.left, include_items=include_items)
+        if node.left and (start is None or start < node.key):
+            self._gather_keys(queue, node.left, include_items, start, end)
 
-        if include_items:
-            queue.append((node.key, node.value))
-        else:
-            queue.append(node.key)
+        if (start is None or start <= node.key) and (end is None or node.key < end):
+            if include_items:
+                queue.append((node.key, node.value))
+            else:
+                queue.append(node.key)
 
-        if node.right:
-            self._gather_keys(queue, node.right, include_items=include_items)
+        if node.right and (end is None or node.key < end):
+            self._gather_keys(queue, node.right, include_items, start, end)
 
     def __iter__(self):
         keys = []
@@ -140,7 +142,10 @@ class RBTree:
         self._gather_keys(keys, self.root)
         return iter(keys)
 
-    def items(self):
+    def items(self, start=None, end=None):
+        """
+        The `(key, value)` pairs with `start <= key < end` in key order.
+        """
         items = []
-        self._gather_keys(items, self.root, include_items=True)
+        self._gather_keys(items, self.root, include_items=True, start=start, end=end)
         return iter(items)
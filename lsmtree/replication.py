@@ -0,0 +1,394 @@
+"""
+Replicates a memtable to read only followers by shipping its WAL records, so
+reads can be spread over several processes (or machines) without sharing the
+primary's locks.
+
+A follower first gets a copy of everything the primary holds at a snapshot
+and then every write after it, in order, as the primary writes it to its WAL.
+When the primary flushes, the followers flush too. Followers are connected
+over a socket, either in the same process (`Primary.attach`) or over TCP
+(`Primary.listen` and `Follower.connect`).
+
+Messages are a 1 byte type and a 4 byte payload length followed by the
+payload. Records are sent as blocks of `(key, seq, kind, value)` records,
+preceded by the newest sequence number of the primary when they were sent. The
+other messages only carry a sequence number.
+"""
+import os
+import queue
+import shutil
+import socket
+import threading
+import time
+from collections import deque
+from struct import calcsize, pack, unpack_from
+
+from .memtable import TOMBSTONE, MemTable, expire
+from .scheduler import CompactionScheduler
+from .segment import KIND_BLOB, KIND_VALUE, WAL, Block
+from .settings import REPLICATION_BATCH_SIZE, REPLICATION_HEARTBEAT_INTERVAL
+
+MESSAGE_FMT = "<BI"
+MESSAGE_SIZE = calcsize(MESSAGE_FMT)
+SEQ_FMT = "<Q"
+SEQ_SIZE = calcsize(SEQ_FMT)
+
+# Message types
+RECORDS = 1
+# The copy of the primary's data is complete up to the sequence number
+SNAPSHOT = 2
+# The newest sequence number of the primary, sent whenever there's nothing
+# else to send for a while
+HEARTBEAT = 3
+FLUSH = 4
+
+# Tells the thread shipping records to a follower to stop
+_STOP = ("stop",)
+
+# Marks a directory as a follower's, which it may empty when it starts
+FOLLOWER_MARKER = "FOLLOWER"
+
+
+class StaleReadError(Exception):
+    pass
+
+
+class ShippingWAL:
+    """
+    Wraps the WAL of the primary's memtable and passes every record written to
+    it on to the followers.
+    """
+
+    def __init__(self, wal, primary):
+        self.wal = wal
+        self.primary = primary
+
+    def add(self, key, value, seq=None, kind=KIND_VALUE):
+        commit = self.wal.add(key, value, seq=seq, kind=kind)
+        self.primary.publish(("record", key, seq, kind, value))
+        return commit
+
+    def reset(self):
+        self.wal.reset()
+        self.primary.publish(("flush",))
+
+    def iter_batches(self, *args, **kwargs):
+        return self.wal.iter_batches(*args, **kwargs)
+
+
+class Primary:
+    """
+    Opens the memtable in `db_dir` (with `options`) and replicates its writes
+    to any number of followers. Writes go to `primary.memtable` as usual.
+
+    Each follower has a queue of records and a thread sending them, so a slow
+    follower doesn't hold up writes, but its queue grows until it catches up.
+    """
+
+    def __init__(
+        self, db_dir, heartbeat_interval=REPLICATION_HEARTBEAT_INTERVAL, **options
+    ):
+        self.heartbeat_interval = heartbeat_interval
+        self.lock = threading.Lock()
+        self.links = []
+        self.threads = []
+        self._listener = None
+        self._closed = threading.Event()
+        self.memtable = MemTable.reconstruct(
+            db_dir, wal=ShippingWAL(WAL(db_dir), self), **options
+        )
+
+    def publish(self, message):
+        with self.lock:
+            for link in self.links:
+                link.put(message)
+
+    def attach(self, db_dir, **options):
+        """
+        Returns a `Follower` in `db_dir` replicating from this primary in the
+        same process.
+        """
+        sock, follower_sock = socket.socketpair()
+        self.add_follower(sock)
+        return Follower(db_dir, follower_sock, **options)
+
+    def listen(self, host="127.0.0.1", port=0):
+        """
+        Accepts followers over TCP. Returns the address it's listening on.
+        """
+        self._listener = socket.create_server((host, port))
+        # So the accept loop notices when the primary is closed
+        self._listener.settimeout(self.heartbeat_interval)
+        thread = threading.Thread(target=self._accept, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        return self._listener.getsockname()[:2]
+
+    def _accept(self):
+        while not self._closed.is_set():
+            try:
+                sock, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            sock.settimeout(None)
+            self.add_follower(sock)
+
+    def add_follower(self, sock):
+        link = queue.SimpleQueue()
+        with self.lock:
+            self.links.append(link)
+        # Taken after the link is added so every write after the snapshot is
+        # queued up. Queued writes the snapshot already has are skipped.
+        snapshot = self.memtable.snapshot()
+        thread = threading.Thread(
+            target=self._ship, args=(sock, link, snapshot), daemon=True
+        )
+        thread.start()
+        self.threads.append(thread)
+
+    def _ship(self, sock, link, snapshot):
+        stats = self.memtable.statistics
+        try:
+            try:
+                self._send_snapshot(sock, snapshot)
+            finally:
+                snapshot.release()
+
+            message = None
+            while True:
+                if message is None:
+                    try:
+                        message = link.get(timeout=self.heartbeat_interval)
+                    except queue.Empty:
+                        send(sock, HEARTBEAT, pack(SEQ_FMT, self.memtable.last_seq))
+                        continue
+
+                if message is _STOP:
+                    return
+                if message[0] == "flush":
+                    send(sock, FLUSH, pack(SEQ_FMT, self.memtable.manifest.last_seq))
+                    message = None
+                    continue
+
+                # Batch up the records queued behind this one. Anything else
+                # is left in `message` for the next time around.
+                block = Block()
+                count = 0
+                while message is not None and message[0] == "record":
+                    _, key, seq, kind, value = message
+                    if seq > snapshot.seq:
+                        block.add(key, value, seq=seq, kind=kind)
+                        count += 1
+                    message = None
+                    if len(block) >= REPLICATION_BATCH_SIZE:
+                        break
+                    try:
+                        message = link.get_nowait()
+                    except queue.Empty:
+                        pass
+
+                if count:
+                    send_records(sock, self.memtable.last_seq, block)
+                    stats.incr("replication.records_shipped", count)
+        except OSError:
+            stats.incr("replication.disconnects")
+        finally:
+            with self.lock:
+                if link in self.links:
+                    self.links.remove(link)
+            sock.close()
+
+    def _send_snapshot(self, sock, snapshot):
+        """
+        Sends the newest version of every key at `snapshot` as records with the
+        snapshot's sequence number.
+        """
+        now = self.memtable.clock()
+        block = Block()
+        for key, _, kind, value in self.memtable.scan_entries(snapshot=snapshot):
+            if kind == KIND_BLOB:
+                kind, value = KIND_VALUE, self.memtable.resolve(kind, value)
+            # Deleted and expired keys are left out
+            if expire(kind, value, now)[1] == TOMBSTONE:
+                continue
+            block.add(key, value, seq=snapshot.seq, kind=kind)
+            if len(block) >= REPLICATION_BATCH_SIZE:
+                send_records(sock, self.memtable.last_seq, block)
+                block = Block()
+
+        if block.data:
+            send_records(sock, self.memtable.last_seq, block)
+        send(sock, SNAPSHOT, pack(SEQ_FMT, snapshot.seq))
+
+    def close(self):
+        self._closed.set()
+        with self.lock:
+            for link in self.links:
+                link.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+
+class Follower:
+    """
+    A read only copy of a primary's memtable in `db_dir`, kept up to date over
+    the connected socket `sock`. The directory is emptied first, a follower
+    always starts from a fresh copy of the primary's data. To keep that from
+    wiping out anything else, a directory that isn't empty has to be one a
+    follower created.
+
+    Reads can be limited to a bounded staleness: `get` and `scan` with
+    `max_staleness` raise a `StaleReadError` if the follower hasn't been caught
+    up with the primary within the last `max_staleness` seconds. Every message
+    from the primary says how far along it is, and the follower counts as
+    caught up to when it got the message once it has applied that far.
+    """
+
+    def __init__(self, db_dir, sock, **options):
+        if os.path.exists(db_dir):
+            if os.listdir(db_dir) and not os.path.exists(
+                os.path.join(db_dir, FOLLOWER_MARKER)
+            ):
+                raise ValueError(f"{db_dir} isn't empty or a follower's directory")
+            shutil.rmtree(db_dir)
+        os.makedirs(db_dir)
+        open(os.path.join(db_dir, FOLLOWER_MARKER), "wb").close()
+
+        self.sock = sock
+        self.memtable = MemTable(db_dir, **options)
+        self.scheduler = CompactionScheduler(workers=1, stats=self.memtable.statistics)
+        self.scheduler.register(self.memtable)
+        self.scheduler.start()
+        # The newest sequence number the primary is known to have
+        self.primary_seq = 0
+        # `(seq, received at)` of the primary's sequence numbers the follower
+        # hasn't applied yet
+        self._primary_seqs = deque()
+        # When the follower got the newest sequence number of the primary it
+        # has applied. None until the copy of the primary's data is complete.
+        self.caught_up_at = None
+        # Set once the connection to the primary is gone
+        self.disconnected = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._receive, daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def connect(cls, db_dir, address, **options):
+        return cls(db_dir, socket.create_connection(address), **options)
+
+    @property
+    def applied_seq(self):
+        return self.memtable.last_seq
+
+    @property
+    def staleness(self):
+        """
+        Seconds since the follower was last caught up with the primary.
+        """
+        if self.caught_up_at is None:
+            return float("inf")
+        return time.monotonic() - self.caught_up_at
+
+    def check_staleness(self, max_staleness):
+        if max_staleness is not None and self.staleness > max_staleness:
+            raise StaleReadError(f"Follower is {self.staleness:.3f}s behind")
+
+    def get(self, key, max_staleness=None):
+        self.check_staleness(max_staleness)
+        return self.memtable.get(key)
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def scan(self, start=None, end=None, max_staleness=None):
+        self.check_staleness(max_staleness)
+        return self.memtable.scan(start, end)
+
+    def wait_for(self, seq, timeout=None):
+        """
+        Waits until the follower has applied every write up to `seq`, for
+        example the `last_seq` of the primary after a write to read it back.
+        Returns whether it did, after at most `timeout` seconds. It stops
+        waiting once the connection to the primary is gone.
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self.applied_seq >= seq or self.disconnected, timeout
+            )
+            return self.applied_seq >= seq
+
+    def _receive(self):
+        memtable = self.memtable
+        stream = self.sock.makefile("rb")
+        try:
+            while True:
+                header = stream.read(MESSAGE_SIZE)
+                if len(header) < MESSAGE_SIZE:
+                    return
+                message_type, size = unpack_from(MESSAGE_FMT, header)
+                payload = stream.read(size)
+                # The connection dropped in the middle of the message
+                if len(payload) < size:
+                    return
+                received_at = time.monotonic()
+                if message_type != FLUSH:
+                    seq = unpack_from(SEQ_FMT, payload)[0]
+                    if seq > self.primary_seq:
+                        self.primary_seq = seq
+                        self._primary_seqs.append((seq, received_at))
+
+                if message_type == RECORDS:
+                    entries = list(Block.iter_entries_from_binary(payload[SEQ_SIZE:]))
+                    # Under the write lock so snapshots see all of the batch
+                    # or none of it
+                    with memtable.write_lock:
+                        memtable.apply_batch(entries)
+                    memtable.statistics.incr(
+                        "replication.records_applied", len(entries)
+                    )
+                elif message_type == SNAPSHOT:
+                    with memtable.write_lock:
+                        memtable.last_seq = max(memtable.last_seq, seq)
+                    self.caught_up_at = received_at
+                elif message_type == FLUSH:
+                    with memtable.sparse_index_lock:
+                        memtable.flush_tree()
+
+                with self._cond:
+                    if self.caught_up_at is not None:
+                        primary_seqs = self._primary_seqs
+                        while primary_seqs and primary_seqs[0][0] <= self.applied_seq:
+                            _, caught_up_at = primary_seqs.popleft()
+                            self.caught_up_at = max(self.caught_up_at, caught_up_at)
+                    self._cond.notify_all()
+        except OSError:
+            pass
+        finally:
+            stream.close()
+            with self._cond:
+                self.disconnected = True
+                self._cond.notify_all()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._thread.join()
+        self.sock.close()
+        self.scheduler.stop()
+
+
+def send(sock, message_type, payload):
+    sock.sendall(pack(MESSAGE_FMT, message_type, len(payload)) + payload)
+
+
+def send_records(sock, primary_seq, block):
+    send(sock, RECORDS, pack(SEQ_FMT, primary_seq) + block.dump(compress=False))
@@ -0,0 +1,171 @@
+"""
+Schedules background compactions for any number of memtables.
+"""
+import logging
+import threading
+
+from .compaction import Compactor
+from .settings import COMPACTION_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+def compaction_score(memtable):
+    """
+    The read amplification of a memtable: how many segments a read that misses
+    the memtable might have to look through.
+    """
+    return len(memtable.manifest.segments)
+
+
+class CompactionScheduler:
+    """
+    Runs compactions on `workers` threads for the memtables registered with it.
+
+    Nothing polls. A memtable is queued up when it's registered and every time
+    it flushes, and keeps being compacted until it's down to a single segment.
+    Idle workers take the queued memtable with the highest `compaction_score`
+    first and a memtable is only ever compacted by one worker at a time.
+
+    Failed compactions are logged, kept as `last_error` and passed on to the
+    memtable's writes that are stopped waiting on compaction, see
+    `WriteController`. They're retried when the memtable flushes again or one
+    of those writes fails.
+    """
+
+    def __init__(self, workers=COMPACTION_WORKERS, stats=None):
+        self.workers = workers
+        self.stats = stats
+        self._cond = threading.Condition()
+        self._memtables = []
+        self._pending = []
+        self._running = []
+        self._threads = []
+        self._paused = False
+        self._stopping = False
+        self.last_error = None
+
+    def register(self, memtable):
+        with self._cond:
+            self._memtables.append(memtable)
+            memtable.compaction_scheduler = self
+        self.schedule(memtable)
+
+    def unregister(self, memtable):
+        """
+        Stops scheduling compactions for `memtable`, waiting for the one that's
+        running (if any) to finish.
+        """
+        with self._cond:
+            self._memtables.remove(memtable)
+            memtable.compaction_scheduler = None
+            if memtable in self._pending:
+                self._pending.remove(memtable)
+            while memtable in self._running:
+                self._cond.wait()
+
+    def schedule(self, memtable):
+        with self._cond:
+            if memtable in self._memtables and memtable not in self._pending:
+                self._pending.append(memtable)
+                self._cond.notify_all()
+
+    @property
+    def running(self):
+        """
+        Whether the workers are started, paused or not.
+        """
+        return bool(self._threads)
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            self._threads = [
+                threading.Thread(target=self._work, daemon=True)
+                for _ in range(self.workers)
+            ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Waits for the running compactions to finish and stops the workers.
+        Queued compactions are kept and run once the scheduler is started
+        again.
+        """
+        with self._cond:
+            threads, self._threads = self._threads, []
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in threads:
+            thread.join()
+
+    def pause(self):
+        """
+        Waits for the running compactions to finish. No new ones are started
+        until `resume` is called.
+        """
+        with self._cond:
+            self._paused = True
+            while self._running:
+                self._cond.wait()
+
+    def resume(self):
+        with self._cond:
+            self._paused = False
+            self._cond.notify_all()
+
+    def wait_until_idle(self):
+        """
+        Waits until nothing is queued up or running. The scheduler has to be
+        started for that to happen.
+        """
+        with self._cond:
+            while self._pending or self._running:
+                self._cond.wait()
+
+    def _next(self):
+        """
+        Picks the queued memtable with the highest score that isn't already
+        being compacted. Callers should hold the `_cond` lock.
+        """
+        ready = [m for m in self._pending if m not in self._running]
+        if not ready:
+            return None
+        memtable = max(ready, key=compaction_score)
+        self._pending.remove(memtable)
+        return memtable
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    memtable = None if self._paused else self._next()
+                    if memtable is not None:
+                        break
+                    self._cond.wait()
+                self._running.append(memtable)
+
+            try:
+                Compactor(memtable).compact()
+                again = compaction_score(memtable) > 1
+                error = None
+            except Exception as e:
+                logger.exception("Compaction of %s failed", memtable.db_dir)
+                # Not retried until the memtable flushes again
+                again = False
+                error = self.last_error = e
+                if self.stats is not None:
+                    self.stats.incr("compaction.errors")
+            memtable.write_controller.set_compaction_error(error)
+
+            with self._cond:
+                self._running.remove(memtable)
+                if again and memtable in self._memtables:
+                    if memtable not in self._pending:
+                        self._pending.append(memtable)
+                self._cond.notify_all()
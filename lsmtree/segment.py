@@ -1,21 +1,60 @@
 import io
 import os
+import sys
+import time
 import zlib
-from struct import pack, unpack
-
-
-def list_segments(db_dir):
+from array import array
+from struct import pack, unpack, unpack_from
+
+from .settings import (INITIAL_READAHEAD_SIZE, READAHEAD_SIZE, WAL_READ_SIZE,
+                       WAL_REPLAY_BATCH_SIZE, WRITE_BUFFER_SIZE)
+
+# Record kinds stored in the low byte of a record's sequence trailer.
+KIND_VALUE = 0
+# A value with a time to live, see `MemTable.put`
+KIND_EXPIRING = 1
+# Deletes the keys from the record's key up to (but excluding) its value, see
+# `MemTable.delete_range`
+KIND_RANGE_DELETE = 2
+# The value is a pointer to where it's stored in a blob file, see `blob.py`
+KIND_BLOB = 3
+# An operand to combine with the older versions of the key, see `merge.py`
+KIND_MERGE = 4
+
+
+def list_segments(db_dir, fname="segment"):
     segments = []
 
     for file in os.listdir(db_dir):
         if os.path.isfile(os.path.join(db_dir, file)):
-            segment_id = file.split(".")[1]
-            if segment_id.isnumeric():
+            name, _, segment_id = file.partition(".")
+            if name == fname and segment_id.isnumeric():
                 segments.append(int(segment_id))
 
     return segments
 
 
+def fadvise(fd, offset, length, advice):
+    """
+    Passes an access pattern hint to the OS where `posix_fadvise` is supported
+    (a length of 0 means up to the end of the file). It's only a hint so it's
+    fine to skip it elsewhere.
+    """
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+
+
+def fsync_dir(db_dir):
+    """
+    Makes renames, creations and removals of files in `db_dir` durable.
+    """
+    fd = os.open(db_dir, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 class Segment:
     """
     Represents a file segment which contains the keys and values of a tree in
@@ -24,10 +63,11 @@ class Segment:
     Reads and writes a segment file:
     """
 
-    def __init__(self, id, db_dir, fname="segment"):
+    def __init__(self, id, db_dir, fname="segment", stats=None):
         self.id = id
         self.path = os.path.join(db_dir, f"{fname}.{self.id}")
         self.file = None
+        self.stats = stats
 
     def open(self):
         if not os.path.exists(self.path):
@@ -42,8 +82,14 @@ class Segment:
         self.file.seek(start)
 
         if end == -1:
-            return self.file.read()
-        return self.file.read(end - start)
+            data = self.file.read()
+        else:
+            data = self.file.read(end - start)
+
+        if self.stats is not None:
+            self.stats.incr("segment.reads")
+            self.stats.incr("segment.bytes_read", len(data))
+        return data
 
     def write(self, chunk):
         self.file.seek(0, io.SEEK_END)
@@ -64,16 +110,73 @@ class Segment:
         return end
 
     def __iter__(self):
-        # iterates over the blocks in a segment file
-        offset = 0
-        size = self.tell_eof
+        return self.iter_blocks()
+
+    def iter_data_blocks(self, offset=0, drop_cache=False):
+        # range tombstone and index blocks are written after all of the data
+        # blocks
+        for block in self.iter_blocks(offset, drop_cache=drop_cache):
+            if block[1] & (Block.INDEX_FLAG | Block.RANGE_DELETE_FLAG):
+                return
+            yield block
 
-        self.file.seek(0, io.SEEK_SET)
+    def iter_blocks(self, offset=0, readahead=READAHEAD_SIZE, drop_cache=False):
+        """
+        Iterates over the blocks in a segment file starting at `offset`. The
+        file is read in large chunks instead of with two small reads per block,
+        starting at `INITIAL_READAHEAD_SIZE` bytes and doubling up to
+        `readahead` bytes so short scans don't read much more than they need.
+        The OS is told the file is read sequentially so it reads ahead too.
+
+        With `drop_cache` the pages that were read are dropped from the OS page
+        cache as it goes. That's for one off passes over a file, like the
+        inputs of a compaction which are about to be removed anyway, so they
+        don't push out the pages foreground reads need.
+        """
+        size = self.tell_eof
+        fd = self.file.fileno()
+        fadvise(fd, offset, size - offset, "POSIX_FADV_SEQUENTIAL")
+
+        buffer = b""
+        # file offset of the start of the buffer
+        start = offset
+        chunk = min(INITIAL_READAHEAD_SIZE, readahead)
+        dropped = 0
         while offset < size:
-            header = self.file.read(Block.HEADER_SIZE)
-            flags, _, block_size = unpack(Block.HEADER_FMT, header)
-            yield offset, flags, block_size, header + self.file.read(block_size)
-            offset += Block.HEADER_SIZE + block_size
+            if offset + Block.HEADER_SIZE > start + len(buffer):
+                buffer, start = self._read_ahead(buffer, start, offset, chunk)
+                chunk = min(chunk * 2, readahead)
+
+            flags, _, block_size = unpack_from(Block.HEADER_FMT, buffer, offset - start)
+            block_end = offset + Block.HEADER_SIZE + block_size
+            if block_end > start + len(buffer):
+                buffer, start = self._read_ahead(
+                    buffer, start, offset, max(chunk, block_end - offset)
+                )
+                chunk = min(chunk * 2, readahead)
+
+            if drop_cache and start > dropped:
+                fadvise(fd, dropped, start - dropped, "POSIX_FADV_DONTNEED")
+                dropped = start
+
+            yield offset, flags, block_size, buffer[offset - start : block_end - start]
+            offset = block_end
+
+        if drop_cache:
+            fadvise(fd, dropped, 0, "POSIX_FADV_DONTNEED")
+
+    def _read_ahead(self, buffer, start, offset, size):
+        """
+        Drops what's before `offset` from the buffer and refills it so it holds
+        `size` bytes from `offset`, or up to the end of the file.
+        """
+        buffer = buffer[offset - start :]
+        self.file.seek(offset + len(buffer))
+        data = self.file.read(size - len(buffer))
+        if self.stats is not None:
+            self.stats.incr("segment.reads")
+            self.stats.incr("segment.bytes_read", len(data))
+        return buffer + data, offset
 
     def __enter__(self):
         self.open()
@@ -83,6 +186,56 @@ class Segment:
         self.close()
 
 
+class SegmentWriter:
+    """
+    Writes a new segment file from start to finish. Writes are buffered in
+    chunks of `buffer_size` bytes and the file is only fsynced once, when it's
+    closed, instead of after every block. It keeps track of the size of the
+    file itself so `tell_eof` doesn't have to seek.
+
+    It has the same `write` and `tell_eof` as `Segment` so it can be passed to
+    `write_entries`. A writer that's left because of an exception isn't
+    fsynced, the file is an orphan that's removed on startup.
+    """
+
+    def __init__(
+        self, id, db_dir, fname="segment", buffer_size=WRITE_BUFFER_SIZE, stats=None
+    ):
+        self.id = id
+        self.path = os.path.join(db_dir, f"{fname}.{self.id}")
+        self.buffer_size = buffer_size
+        self.file = None
+        self.stats = stats
+        self.tell_eof = 0
+
+    def open(self):
+        self.file = open(self.path, "wb", buffering=self.buffer_size)
+        self.tell_eof = 0
+
+    def write(self, chunk):
+        written = self.file.write(chunk)
+        self.tell_eof += written
+        return written
+
+    def close(self):
+        start = time.perf_counter()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        if self.stats is not None:
+            self.stats.record_time("segment.fsync", time.perf_counter() - start)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+
 class MaxSizeExceeded(Exception):
     pass
 
@@ -102,6 +255,24 @@ class Block:
     +----------------------+-------------------+---------------------------+------------------+-------------+------------------+-------------+
     | 1 bytes header flags | 4 bytes crc check | 8 bytes block size header | 2 bytes key size | N bytes key | 4 bytes val size | N bytes val |
     +----------------------+-------------------+---------------------------+------------------+-------------+------------------+-------------+
+
+    Blocks with the `OFFSETS_FLAG` set end with the 4 byte offset of every
+    record followed by the 4 byte number of records, see `BlockView`.
+
+    Blocks with the `INDEX_FLAG` set hold a partition of the sparse index
+    instead of data, see `SparseIndex`.
+
+    A block with the `RANGE_DELETE_FLAG` set holds the range tombstones of a
+    segment. It's written right after the data blocks.
+
+    When the `SEQUENCE_FLAG` is set every record also carries an 8 byte trailer
+    right after the key. The upper 7 bytes are the sequence number of the write
+    and the low byte is the record kind. Blocks written without sequence numbers
+    decode with a sequence number of 0.
+
+    +------------------+-------------+-----------------------------+------------------+-------------+
+    | 2 bytes key size | N bytes key | 8 bytes seq << 8 | kind     | 4 bytes val size | N bytes val |
+    +------------------+-------------+-----------------------------+------------------+-------------+
     """
 
     HEADER_FMT = (
@@ -110,22 +281,45 @@ class Block:
     HEADER_SIZE = 13
     KEY_SIZE_FMT = "<H"  # unsigned 2 byte short
     VAL_SIZE_FMT = "<I"  # unsigned 4 byte int
+    TRAILER_FMT = "<Q"  # unsigned 8 byte long long
     COMPRESSION_FLAG = 0b10000000
+    SEQUENCE_FLAG = 0b01000000
+    # Set when the records are followed by a table of their offsets
+    OFFSETS_FLAG = 0b00010000
+    OFFSET_FMT = "<I"  # unsigned 4 byte int
+    # Set on the index partition blocks written after a segment's data blocks
+    INDEX_FLAG = 0b00100000
+    # Set on the block holding a segment's range tombstones
+    RANGE_DELETE_FLAG = 0b00001000
 
     def __init__(self):
         self.max_size = 2 ** 64
         self.size = 0
         # The first key in the block. Used by the sparse index
         self.key = None
+        # The last key in the block.
+        self.last_key = None
+        self.sequenced = None
         self.data = []
+        self.offsets = []
 
     def __len__(self):
         return self.size
 
-    def dump(self, compress=False):
-        flags = 0b00000000
+    def dump(self, compress=False, flags=0b00000000, offset_table=False):
         data = b"".join(self.data)
 
+        # Offsets are 4 bytes so blocks bigger than that go without a table
+        if offset_table and self.size < 2 ** 32:
+            flags |= self.OFFSETS_FLAG
+            table = array("I", self.offsets)
+            if sys.byteorder != "little":
+                table.byteswap()
+            data += table.tobytes() + pack(self.OFFSET_FMT, len(self.offsets))
+
+        if self.sequenced:
+            flags |= self.SEQUENCE_FLAG
+
         if compress:
             flags |= self.COMPRESSION_FLAG
             data = zlib.compress(data, level=zlib.Z_BEST_SPEED)
@@ -134,19 +328,31 @@ class Block:
         header = pack(self.HEADER_FMT, flags, checksum, len(data))
         return header + data
 
-    def add(self, key, value):
+    def add(self, key, value, seq=None, kind=KIND_VALUE):
+        sequenced = seq is not None
+        if self.sequenced is None:
+            self.sequenced = sequenced
+        elif self.sequenced != sequenced:
+            raise ValueError("Can't mix records with and without sequence numbers")
+
         key_len = pack(self.KEY_SIZE_FMT, len(key))
         val_len = pack(self.VAL_SIZE_FMT, len(value))
-        record = key_len + key + val_len + value
+        if sequenced:
+            trailer = pack(self.TRAILER_FMT, seq << 8 | kind)
+            record = key_len + key + trailer + val_len + value
+        else:
+            record = key_len + key + val_len + value
 
         if len(record) + self.size > self.max_size:
             raise MaxSizeExceeded("Maximum block size exceeded!")
 
         self.data.append(record)
+        self.offsets.append(self.size)
         self.size += len(record)
 
         if self.key is None:
             self.key = key
+        self.last_key = key
 
     @classmethod
     def is_block_corrupted(cls, block):
@@ -155,34 +361,165 @@ class Block:
         return zlib.crc32(data) != checksum
 
     @classmethod
-    def iter_from_binary(cls, block, raise_for_corruption=True):
+    def iter_from_binary(cls, block, raise_for_corruption=True, stats=None):
         """
         Iteratively decode key value pairs from a binary block yielding them.
         """
-        flags, checksum, _ = unpack(cls.HEADER_FMT, block[: cls.HEADER_SIZE])
-        is_compressed = flags & cls.COMPRESSION_FLAG
-        data = block[cls.HEADER_SIZE :]
+        for key, _, _, value in cls.iter_entries_from_binary(
+            block, raise_for_corruption=raise_for_corruption, stats=stats
+        ):
+            yield key, value
+
+    @classmethod
+    def iter_entries_from_binary(cls, block, raise_for_corruption=True, stats=None):
+        """
+        Like `iter_from_binary` but yields `(key, seq, kind, value)` entries.
+        """
+        return iter(
+            BlockView.from_binary(
+                block, raise_for_corruption=raise_for_corruption, stats=stats
+            )
+        )
+
+
+class BlockView:
+    """
+    A decoded block with random access to its records by position.
+
+    Blocks with the `OFFSETS_FLAG` end with a table of the offset of every
+    record so nothing has to be parsed up front and a key can be binary
+    searched for. Older blocks are scanned once to build the offsets, the
+    first time they're needed. Iterating over the block doesn't need them.
+    """
+
+    def __init__(self, data, offsets, sequenced):
+        self.data = data
+        self._offsets = offsets
+        self.sequenced = sequenced
+
+    @classmethod
+    def from_binary(cls, block, raise_for_corruption=True, stats=None):
+        flags, checksum, _ = unpack_from(Block.HEADER_FMT, block)
+        data = block[Block.HEADER_SIZE :]
 
         if raise_for_corruption and zlib.crc32(data) != checksum:
             raise BlockCorruption()
 
-        if is_compressed:
+        if flags & Block.COMPRESSION_FLAG:
             data = zlib.decompress(data)
+            if stats is not None:
+                stats.incr("block.bytes_decompressed", len(data))
 
+        sequenced = bool(flags & Block.SEQUENCE_FLAG)
+        if flags & Block.OFFSETS_FLAG:
+            count = unpack_from(Block.OFFSET_FMT, data, len(data) - 4)[0]
+            table_start = len(data) - 4 - 4 * count
+            offsets = array("I")
+            offsets.frombytes(data[table_start : len(data) - 4])
+            if sys.byteorder != "little":
+                offsets.byteswap()
+            return cls(data[:table_start], offsets, sequenced)
+
+        return cls(data, None, sequenced)
+
+    @property
+    def offsets(self):
+        if self._offsets is None:
+            self._offsets = self.scan_offsets(self.data, self.sequenced)
+        return self._offsets
+
+    @staticmethod
+    def scan_offsets(data, sequenced):
+        offsets = array("Q")
         offset = 0
         size = len(data)
+        trailer_size = 8 if sequenced else 0
+
         while offset < size:
-            key_len = unpack(cls.KEY_SIZE_FMT, data[offset : offset + 2])[0]
+            offsets.append(offset)
+            key_len = unpack_from(Block.KEY_SIZE_FMT, data, offset)[0]
+            offset += 2 + key_len + trailer_size
+            val_len = unpack_from(Block.VAL_SIZE_FMT, data, offset)[0]
+            offset += 4 + val_len
+
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def key(self, i):
+        offset = self.offsets[i]
+        key_len = unpack_from(Block.KEY_SIZE_FMT, self.data, offset)[0]
+        return self.data[offset + 2 : offset + 2 + key_len]
+
+    def entry(self, i):
+        data = self.data
+        offset = self.offsets[i]
+        key_len = unpack_from(Block.KEY_SIZE_FMT, data, offset)[0]
+        offset += 2
+        key = data[offset : offset + key_len]
+        offset += key_len
+
+        seq, kind = 0, KIND_VALUE
+        if self.sequenced:
+            trailer = unpack_from(Block.TRAILER_FMT, data, offset)[0]
+            seq, kind = trailer >> 8, trailer & 0xFF
+            offset += 8
+
+        val_len = unpack_from(Block.VAL_SIZE_FMT, data, offset)[0]
+        offset += 4
+        return key, seq, kind, data[offset : offset + val_len]
+
+    def __iter__(self):
+        # Straight through the records, the offsets are only needed for
+        # random access
+        data = self.data
+        sequenced = self.sequenced
+        offset = 0
+        size = len(data)
+        while offset < size:
+            key_len = unpack_from(Block.KEY_SIZE_FMT, data, offset)[0]
             offset += 2
             key = data[offset : offset + key_len]
-
             offset += key_len
-            val_len = unpack(cls.VAL_SIZE_FMT, data[offset : offset + 4])[0]
+
+            seq, kind = 0, KIND_VALUE
+            if sequenced:
+                trailer = unpack_from(Block.TRAILER_FMT, data, offset)[0]
+                seq, kind = trailer >> 8, trailer & 0xFF
+                offset += 8
+
+            val_len = unpack_from(Block.VAL_SIZE_FMT, data, offset)[0]
             offset += 4
-            value = data[offset : offset + val_len]
+            yield key, seq, kind, data[offset : offset + val_len]
             offset += val_len
 
-            yield key, value
+    def find(self, key, seq=None):
+        """
+        Returns `(seq, kind, value)` of the newest version of `key` at or below
+        `seq`, or None if the block doesn't have one.
+        """
+        return next(self.find_versions(key, seq), None)
+
+    def find_versions(self, key, seq=None):
+        """
+        Yields the `(seq, kind, value)` versions of `key` at or below `seq`,
+        newest first.
+        """
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        for i in range(low, len(self)):
+            entry_key, entry_seq, kind, value = self.entry(i)
+            if entry_key != key:
+                break
+            if seq is None or entry_seq <= seq:
+                yield entry_seq, kind, value
 
 
 class WAL:
@@ -191,22 +528,86 @@ class WAL:
     crashes.
     """
 
-    def __init__(self, db_dir):
+    def __init__(self, db_dir, stats=None, id="log"):
         self.db_dir = db_dir
-        self.segment = Segment(id="log", db_dir=db_dir, fname="wal")
+        self.stats = stats
+        self.id = id
+        self.segment = Segment(id=id, db_dir=db_dir, fname="wal")
 
-    def add(self, key, value):
+    def add(self, key, value, seq=None, kind=KIND_VALUE):
         block = Block()
-        block.add(key, value)
+        block.add(key, value, seq=seq, kind=kind)
         with self.segment as segment:
+            start = time.perf_counter()
             segment.write(block.dump(compress=False))
+            if self.stats is not None:
+                self.stats.record_time("wal.fsync", time.perf_counter() - start)
 
     def reset(self):
-        os.remove(self.segment.path)
-        self.segment = Segment(id="log", db_dir=self.db_dir, fname="wal")
+        if os.path.exists(self.segment.path):
+            os.remove(self.segment.path)
+        self.segment = Segment(id=self.id, db_dir=self.db_dir, fname="wal")
 
     def __iter__(self):
-        with self.segment as segment:
-            for _, _, _, raw_block in segment:
-                for kv in Block.iter_from_binary(raw_block):
-                    yield kv
+        for key, _, _, value in self.iter_entries():
+            yield key, value
+
+    def iter_entries(self):
+        for batch in self.iter_batches():
+            yield from batch
+
+    def iter_batches(self, batch_size=WAL_REPLAY_BATCH_SIZE, read_size=WAL_READ_SIZE):
+        """
+        Streams the log in `read_size` chunks yielding lists of up to
+        `batch_size` `(key, seq, kind, value)` entries. A torn or corrupted
+        record at the end of the log (from crashing mid write) ends the replay.
+        Anything followed by more records wasn't from a torn write and raises
+        `BlockCorruption`, the records after it were acknowledged.
+        """
+        if not os.path.exists(self.segment.path):
+            return
+
+        batch = []
+        buffer = b""
+        # Where in the file the buffer starts
+        position = 0
+        with open(self.segment.path, "rb") as f:
+            while True:
+                chunk = f.read(read_size)
+                if not chunk:
+                    break
+
+                buffer += chunk
+                offset = 0
+                while len(buffer) - offset >= Block.HEADER_SIZE:
+                    _, _, size = unpack_from(Block.HEADER_FMT, buffer, offset)
+                    end = offset + Block.HEADER_SIZE + size
+                    if end > len(buffer):
+                        break
+
+                    raw_block = buffer[offset:end]
+                    if Block.is_block_corrupted(raw_block):
+                        if end < len(buffer) or f.read(1):
+                            raise BlockCorruption(
+                                f"{self.segment.path} at offset {position + offset}"
+                            )
+                        if batch:
+                            yield batch
+                        return
+
+                    batch.extend(
+                        Block.iter_entries_from_binary(
+                            raw_block, raise_for_corruption=False
+                        )
+                    )
+                    offset = end
+
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+
+                buffer = buffer[offset:]
+                position += offset
+
+        if batch:
+            yield batch
@@ -0,0 +1,183 @@
+"""
+Serves a database over TCP or Unix domain sockets so several processes can
+share it (and its block cache and memtable) instead of each embedding their
+own. See `protocol.py` for the wire format and `client.py` for the client.
+
+Run it with `python -m lsmtree.server --db-dir db --port 7070` (or `--unix`
+with the path of a socket).
+"""
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from struct import unpack_from
+
+from .memtable import MemTable
+from .protocol import (BATCH, BATCH_OPS, DELETE, DELETE_RANGE, ERROR, GET,
+                       HEADER_SIZE, MULTI_GET, NOT_FOUND, OK, PUT, SCAN,
+                       SCAN_LIMIT_FMT, pack_frame, unpack_batch, unpack_fields,
+                       unpack_header, unpack_ttl)
+from .scheduler import CompactionScheduler
+from .settings import MAX_FRAME_SIZE, SERVER_WORKERS
+
+
+class Server:
+    """
+    Answers requests for `memtable` on any number of listening sockets.
+
+    The event loop only does the network IO. Requests are run on a pool of
+    `workers` threads since they block on disk reads and WAL fsyncs. Requests
+    on a connection are answered in order, one at a time, but a client doesn't
+    have to wait for a reply before sending its next request.
+
+    Malformed requests are answered with an ERROR. Requests with a payload
+    over `max_frame_size` bytes are too, and their connection is closed.
+    """
+
+    def __init__(self, memtable, workers=SERVER_WORKERS, max_frame_size=MAX_FRAME_SIZE):
+        self.memtable = memtable
+        self.max_frame_size = max_frame_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.servers = []
+
+    async def start_tcp(self, host="127.0.0.1", port=0):
+        server = await asyncio.start_server(self.handle, host, port)
+        self.servers.append(server)
+        return server
+
+    async def start_unix(self, path):
+        server = await asyncio.start_unix_server(self.handle, path)
+        self.servers.append(server)
+        return server
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        self.servers = []
+        self.executor.shutdown()
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(HEADER_SIZE)
+                except asyncio.IncompleteReadError:
+                    return
+                length, request_id, op = unpack_header(header)
+                if length > self.max_frame_size:
+                    # Rather than read it all, give up on the connection
+                    message = f"Frame of {length} bytes is too large"
+                    writer.write(pack_frame(request_id, ERROR, [message.encode()]))
+                    await writer.drain()
+                    return
+
+                try:
+                    fields = unpack_fields(await reader.readexactly(length))
+                except ValueError as e:
+                    status, result = ERROR, [f"Malformed request: {e}".encode()]
+                else:
+                    status, result = await loop.run_in_executor(
+                        self.executor, self.dispatch, op, fields
+                    )
+                writer.write(pack_frame(request_id, status, result))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def dispatch(self, op, fields):
+        """
+        Runs a request and returns `(status, fields)` for the response.
+        """
+        memtable = self.memtable
+        try:
+            if op == GET:
+                try:
+                    return OK, [memtable[fields[0]]]
+                except KeyError:
+                    return NOT_FOUND, []
+            elif op == MULTI_GET:
+                return OK, [self.get_or_none(key) for key in fields]
+            elif op == PUT:
+                key, value, ttl = fields
+                memtable.put(key, value, ttl=unpack_ttl(ttl))
+            elif op == DELETE:
+                del memtable[fields[0]]
+            elif op == DELETE_RANGE:
+                memtable.delete_range(*fields)
+            elif op == BATCH:
+                ops = list(unpack_batch(fields))
+                # Checked up front so a bad batch isn't applied halfway
+                unknown = {code for code, _, _, _ in ops} - set(BATCH_OPS.values())
+                if unknown:
+                    return ERROR, [f"Unknown batch ops {sorted(unknown)}".encode()]
+                for code, key, value, ttl in ops:
+                    if code == PUT:
+                        memtable.put(key, value, ttl=ttl)
+                    elif code == DELETE:
+                        del memtable[key]
+                    elif code == DELETE_RANGE:
+                        memtable.delete_range(key, value)
+            elif op == SCAN:
+                start, end, limit = fields
+                scan = memtable.scan(start, end)
+                try:
+                    pairs = list(islice(scan, unpack_from(SCAN_LIMIT_FMT, limit)[0]))
+                finally:
+                    scan.close()
+                return OK, [field for pair in pairs for field in pair]
+            else:
+                return ERROR, [f"Unknown op {op}".encode()]
+        except Exception as e:
+            return ERROR, [repr(e).encode()]
+
+        return OK, []
+
+    def get_or_none(self, key):
+        try:
+            return self.memtable[key]
+        except KeyError:
+            return None
+
+
+async def serve(db_dir, host=None, port=None, unix=None):
+    memtable = MemTable.reconstruct(db_dir)
+    scheduler = CompactionScheduler()
+    scheduler.register(memtable)
+    scheduler.start()
+
+    server = Server(memtable)
+    listening = []
+    if port is not None:
+        listening.append(await server.start_tcp(host, port))
+    if unix is not None:
+        listening.append(await server.start_unix(unix))
+
+    try:
+        await asyncio.gather(*(s.serve_forever() for s in listening))
+    finally:
+        await server.close()
+        scheduler.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a database")
+    parser.add_argument("--db-dir", required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--unix", help="path of a Unix domain socket to listen on")
+    args = parser.parse_args(argv)
+    if args.port is None and args.unix is None:
+        parser.error("one of --port or --unix is required")
+
+    try:
+        asyncio.run(serve(args.db_dir, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -27,3 +27,116 @@ BLOCK_COMPRESSION = True
 # increased memory usage.
 BLOOM_FILTER_SIZE = 9679  # prime number
 BLOOM_FILTER_HASHES = 3
+
+# With a prefix length every segment also gets a bloom filter of the first
+# `PREFIX_LENGTH` bytes of its keys, so `scan_prefix` can skip the segments
+# without any keys under a prefix. Set it to the length of the prefixes keys
+# are grouped by (a tenant id for example). None to disable.
+PREFIX_LENGTH = None
+
+# How many threads load segment indexes in parallel when starting up.
+RECOVERY_WORKERS = 4
+
+# The WAL is replayed on startup by reading it `WAL_READ_SIZE` bytes at a time
+# and applying `WAL_REPLAY_BATCH_SIZE` records to the tree at a time.
+WAL_READ_SIZE = 1048576  # 1 MB
+WAL_REPLAY_BATCH_SIZE = 10000
+
+# New segment files (from flushes and compactions) are written this many bytes
+# at a time and fsynced once when they're complete.
+WRITE_BUFFER_SIZE = 1048576  # 1 MB
+
+# Sequential passes over a segment file (compaction, scans and rebuilding an
+# index) read it in chunks instead of a block at a time. The first read is
+# `INITIAL_READAHEAD_SIZE` bytes and every following one doubles in size up to
+# `READAHEAD_SIZE`, so short scans don't read much more than they need.
+INITIAL_READAHEAD_SIZE = 1024 * 64  # 64 KB
+READAHEAD_SIZE = 1048576 * 2  # 2 MB
+
+# The sparse index of a segment with more than this many blocks is written to
+# the segment file in partitions of this many entries. Only an index over the
+# partitions stays in memory and the partitions themselves are read through the
+# block cache. 0 keeps every sparse index fully in memory.
+INDEX_PARTITION_ENTRIES = 1024
+
+# The size, in bytes, of the LRU cache holding recently read blocks and index
+# partitions.
+BLOCK_CACHE_SIZE = 1048576 * 8  # 8 MB
+
+# The size, in bytes, of the LRU cache of values (and misses) point lookups
+# found in the segment files. Hot keys are then found without a bloom filter
+# check or a block read. 0 to disable.
+ROW_CACHE_SIZE = 0
+
+# The default limit, in bytes, of a `MemoryBudget`: the memory the memtables,
+# caches, sparse indexes and bloom filters sharing it may use in total.
+MEMORY_BUDGET_SIZE = 1048576 * 512  # 512 MB
+
+# A `MemoryBudget` only flushes a memtable early if its RBTree takes up at least
+# this much (or all of what's over the limit). Flushing smaller ones gives back
+# next to nothing and every segment adds an index and a bloom filter.
+MEMORY_BUDGET_MIN_FLUSH_SIZE = 1048576  # 1 MB
+
+# Segments where at least this fraction of the entries are tombstones are
+# compacted first, so the space taken by deleted keys is freed quickly and reads
+# don't have to keep skipping over the tombstones.
+TOMBSTONE_COMPACTION_RATIO = 0.5
+
+# Values larger than this many bytes are stored in blob files when flushed and
+# segments only keep a pointer to them, so compaction doesn't have to rewrite
+# them and blocks stay small. Reads of those values take an extra disk read.
+# 0 keeps every value in the segment files.
+BLOB_THRESHOLD = 0
+
+# Live values in a blob file where at least this fraction of the file is no
+# longer referenced are moved to a new blob file by compactions, so the old one
+# can be removed.
+BLOB_GC_RATIO = 0.5
+
+# How many column families of a `DB` can be compacted at the same time.
+COMPACTION_WORKERS = 2
+
+# Writes are slowed down once there are this many segments, and stopped until
+# compaction catches up at the stop count. Every segment is another place a
+# read has to look, so this keeps reads from getting slower and slower under a
+# burst of writes.
+SLOWDOWN_SEGMENT_COUNT = 20
+STOP_SEGMENT_COUNT = 36
+
+# The same for the bytes compaction still has to merge, which is the size of
+# every segment but the oldest.
+SLOWDOWN_PENDING_COMPACTION_BYTES = 1048576 * 256  # 256 MB
+STOP_PENDING_COMPACTION_BYTES = 1048576 * 1024  # 1 GB
+
+# The longest, in seconds, a single write sleeps for while writes are slowed
+# down. Writes sleep for longer the closer things get to the stop limits.
+WRITE_SLOWDOWN_MAX_DELAY = 0.01
+
+# How long, in seconds, a write waits while writes are stopped before raising
+# a `TimeoutError`. None waits until compaction catches up.
+WRITE_STALL_TIMEOUT = None
+
+# How many worker processes a `ShardedDB` splits the keys over by default.
+SHARD_COUNT = 4
+
+# Scans of a `ShardedDB` fetch this many key value pairs from a shard at a time.
+SCAN_BATCH_SIZE = 1000
+
+# How many threads the server runs requests on.
+SERVER_WORKERS = 8
+
+# The largest request payload, in bytes, the server accepts. Connections
+# announcing a larger one are answered with an error and closed.
+MAX_FRAME_SIZE = 1048576 * 64  # 64 MB
+
+# How many connections to the server a client keeps open at most.
+CLIENT_POOL_SIZE = 8
+
+# A primary sends its followers the newest sequence number when it has had
+# nothing else to send them for this many seconds, which is how followers know
+# how far behind they are.
+REPLICATION_HEARTBEAT_INTERVAL = 0.1
+
+# Records shipped to followers are batched into messages of up to this many
+# bytes.
+REPLICATION_BATCH_SIZE = 1048576  # 1 MB
@@ -0,0 +1,349 @@
+"""
+Spreads the keys of a database over several `MemTable`s that each run in a
+worker process of their own, so reads and writes can use more than the one
+core the GIL allows a single process.
+
+Keys are assigned to shards by a hash of the key or, when split keys are given,
+by key range. Every shard has its own sub directory (`shard.0`, `shard.1`, ...)
+with its own WAL, segments and compaction. Requests go to the workers over
+pipes, and batched requests (`multi_get` and `write` of a `WriteBatch`) are
+sent to every shard they involve before waiting on any of the replies so the
+shards work on them in parallel.
+"""
+import heapq
+import json
+import multiprocessing
+import os
+import threading
+import zlib
+from bisect import bisect_right
+
+from .memtable import MemTable
+from .scheduler import CompactionScheduler
+from .segment import fsync_dir
+from .settings import SCAN_BATCH_SIZE, SHARD_COUNT
+
+
+class WriteBatch:
+    """
+    Writes to apply together with `ShardedDB.write`. They're applied in order
+    on each shard, but a batch spanning several shards isn't atomic: a crash
+    part way through can leave it applied on some of them only.
+    """
+
+    def __init__(self):
+        self.ops = []
+
+    def __len__(self):
+        return len(self.ops)
+
+    def put(self, key, value, ttl=None):
+        assert isinstance(key, bytes)
+        assert isinstance(value, bytes)
+        self.ops.append(("put", key, value, ttl))
+
+    def delete(self, key):
+        assert isinstance(key, bytes)
+        self.ops.append(("delete", key, None, None))
+
+    def delete_range(self, start, end):
+        assert isinstance(start, bytes)
+        assert isinstance(end, bytes)
+        self.ops.append(("delete_range", start, end, None))
+
+
+class ShardedDB:
+    """
+    Opens (or creates) a database in `db_dir` split over `shards` worker
+    processes. With `split_keys` the shards hold key ranges instead, shard `i`
+    holding the keys from `split_keys[i - 1]` up to (but excluding)
+    `split_keys[i]`. Any other `options` are passed on to every shard's
+    `MemTable`.
+
+    How the keys are split is saved in `shards.json`, a database has to be
+    reopened with the same sharding.
+    """
+
+    CONFIG_FILE = "shards.json"
+
+    def __init__(self, db_dir, shards=SHARD_COUNT, split_keys=None, **options):
+        split_keys = sorted(split_keys) if split_keys else []
+        if split_keys:
+            shards = len(split_keys) + 1
+
+        config = {"shards": shards, "split_keys": [key.hex() for key in split_keys]}
+        path = os.path.join(db_dir, self.CONFIG_FILE)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                saved = json.load(f)
+            if saved != config:
+                raise ValueError(f"The database in {db_dir} is sharded as {saved}")
+        else:
+            os.makedirs(db_dir, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(config, f)
+                f.flush()
+                os.fsync(f.fileno())
+            fsync_dir(db_dir)
+
+        self.db_dir = db_dir
+        self.split_keys = split_keys
+        self.shards = []
+        # Spawned rather than forked so the workers don't inherit the locks
+        # (and threads) of this process
+        context = multiprocessing.get_context("spawn")
+        for i in range(shards):
+            shard_dir = os.path.join(db_dir, f"shard.{i}")
+            os.makedirs(shard_dir, exist_ok=True)
+            conn, worker_conn = context.Pipe()
+            process = context.Process(
+                target=serve, args=(worker_conn, shard_dir, options), daemon=True
+            )
+            process.start()
+            worker_conn.close()
+            self.shards.append(_Shard(conn, process))
+
+        # Wait for every shard to finish recovering
+        self._broadcast("ping")
+
+    def shard_for(self, key):
+        if self.split_keys:
+            return bisect_right(self.split_keys, key)
+        return zlib.crc32(key) % len(self.shards)
+
+    def get(self, key):
+        value = self.multi_get([key])[0]
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        self.delete(key)
+
+    def put(self, key, value, ttl=None):
+        batch = WriteBatch()
+        batch.put(key, value, ttl=ttl)
+        self.write(batch)
+
+    def delete(self, key):
+        batch = WriteBatch()
+        batch.delete(key)
+        self.write(batch)
+
+    def delete_range(self, start, end):
+        batch = WriteBatch()
+        batch.delete_range(start, end)
+        self.write(batch)
+
+    def multi_get(self, keys):
+        """
+        Returns the values of `keys` in the same order, None for the keys that
+        aren't set.
+        """
+        by_shard = {}
+        for i, key in enumerate(keys):
+            by_shard.setdefault(self.shard_for(key), []).append(i)
+
+        values = [None] * len(keys)
+        results = self._request(
+            {
+                shard: ("multi_get", [keys[i] for i in indexes])
+                for shard, indexes in by_shard.items()
+            }
+        )
+        for shard, found in results.items():
+            for i, value in zip(by_shard[shard], found):
+                values[i] = value
+        return values
+
+    def write(self, batch):
+        by_shard = {}
+        for op in batch.ops:
+            kind, key, value, _ = op
+            if kind == "delete_range":
+                shards = self._shards_for_range(key, value)
+            else:
+                shards = [self.shard_for(key)]
+            for shard in shards:
+                by_shard.setdefault(shard, []).append(op)
+
+        self._request({shard: ("write", ops) for shard, ops in by_shard.items()})
+
+    def scan(self, start=None, end=None):
+        """
+        Yields the `(key, value)` pairs with `start <= key < end` in key order,
+        merged from every shard. Each shard scans from a snapshot of its own,
+        there is no snapshot across shards.
+        """
+        shards = self._shards_for_range(start, end)
+        scans = [self._scan_shard(shard, start, end) for shard in shards]
+        if self.split_keys:
+            # The shards hold consecutive key ranges already
+            for scan in scans:
+                yield from scan
+        else:
+            yield from heapq.merge(*scans)
+
+    def _scan_shard(self, shard, start, end):
+        scan_id = self._request({shard: ("scan_open", (start, end))})[shard]
+        done = False
+        try:
+            while not done:
+                pairs, done = self._request(
+                    {shard: ("scan_next", (scan_id, SCAN_BATCH_SIZE))}
+                )[shard]
+                yield from pairs
+        finally:
+            if not done:
+                self._request({shard: ("scan_close", scan_id)})
+
+    def _shards_for_range(self, start, end):
+        if not self.split_keys:
+            return list(range(len(self.shards)))
+        first = 0 if start is None else self.shard_for(start)
+        last = len(self.shards) - 1 if end is None else self.shard_for(end)
+        return list(range(first, last + 1))
+
+    def flush(self):
+        self._broadcast("flush")
+
+    def stats(self):
+        """
+        The stats of every shard, see `MemTable.stats`.
+        """
+        results = self._broadcast("stats")
+        return [results[i] for i in range(len(self.shards))]
+
+    def _broadcast(self, op, args=None):
+        return self._request({i: (op, args) for i in range(len(self.shards))})
+
+    def _request(self, requests):
+        """
+        Sends `{shard: (op, args)}` requests and returns `{shard: result}`.
+        Every request is sent before any reply is read so the shards handle
+        them in parallel. An exception raised by a shard is raised here.
+        """
+        shards = sorted(requests)
+        # Locked in order so concurrent requests can't deadlock
+        for shard in shards:
+            self.shards[shard].lock.acquire()
+        try:
+            for shard in shards:
+                self.shards[shard].conn.send(requests[shard])
+
+            results = {}
+            error = None
+            for shard in shards:
+                ok, result = self.shards[shard].conn.recv()
+                if ok:
+                    results[shard] = result
+                elif error is None:
+                    error = result
+        finally:
+            for shard in shards:
+                self.shards[shard].lock.release()
+
+        if error is not None:
+            raise error
+        return results
+
+    def close(self):
+        if not self.shards:
+            return
+
+        self._broadcast("close")
+        for shard in self.shards:
+            shard.process.join()
+            shard.conn.close()
+        self.shards = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _Shard:
+    def __init__(self, conn, process):
+        self.conn = conn
+        self.process = process
+        self.lock = threading.Lock()
+
+
+def serve(conn, shard_dir, options):
+    """
+    The main loop of a shard's worker process. Replies to every `(op, args)`
+    request with `(True, result)`, or `(False, exception)` if it failed.
+    """
+    memtable = MemTable.reconstruct(shard_dir, **options)
+    scheduler = CompactionScheduler(workers=1, stats=memtable.statistics)
+    scheduler.register(memtable)
+    scheduler.start()
+    scans = {}
+    next_scan_id = 0
+
+    while True:
+        op, args = conn.recv()
+        try:
+            if op == "multi_get":
+                result = []
+                for key in args:
+                    try:
+                        result.append(memtable[key])
+                    except KeyError:
+                        result.append(None)
+            elif op == "write":
+                for kind, key, value, ttl in args:
+                    if kind == "put":
+                        memtable.put(key, value, ttl=ttl)
+                    elif kind == "delete":
+                        del memtable[key]
+                    else:
+                        memtable.delete_range(key, value)
+                result = None
+            elif op == "scan_open":
+                result = next_scan_id
+                scans[next_scan_id] = memtable.scan(*args)
+                next_scan_id += 1
+            elif op == "scan_next":
+                scan_id, count = args
+                pairs = []
+                for pair in scans[scan_id]:
+                    pairs.append(pair)
+                    if len(pairs) == count:
+                        break
+                done = len(pairs) < count
+                if done:
+                    del scans[scan_id]
+                result = pairs, done
+            elif op == "scan_close":
+                scans.pop(args).close()
+                result = None
+            elif op == "flush":
+                with memtable.sparse_index_lock:
+                    memtable.flush_tree()
+                result = None
+            elif op == "stats":
+                result = memtable.stats()
+            elif op == "ping":
+                result = None
+            elif op == "close":
+                for scan in scans.values():
+                    scan.close()
+                scheduler.stop()
+                conn.send((True, None))
+                conn.close()
+                return
+            else:
+                raise ValueError(f"Unknown request {op!r}")
+        except Exception as e:
+            conn.send((False, e))
+        else:
+            conn.send((True, result))
@@ -0,0 +1,149 @@
+"""
+Back pressure on writers for when compaction can't keep up with them. Without
+it the number of segments grows without bound and every read that misses has
+to look through all of them.
+"""
+import time
+from threading import Condition
+
+from .settings import (SLOWDOWN_PENDING_COMPACTION_BYTES,
+                       SLOWDOWN_SEGMENT_COUNT, STOP_PENDING_COMPACTION_BYTES,
+                       STOP_SEGMENT_COUNT, WRITE_SLOWDOWN_MAX_DELAY,
+                       WRITE_STALL_TIMEOUT)
+
+NORMAL = "normal"
+SLOWDOWN = "slowdown"
+STOP = "stop"
+
+
+class CompactionError(Exception):
+    """
+    Raised to writes that are stopped while the compaction they're waiting on
+    fails.
+    """
+
+
+class WriteController:
+    """
+    Decides how long writes have to wait based on the number of live segments
+    and the bytes compaction still has to merge, which the memtable updates
+    every time its segments change.
+
+    Past a slowdown limit every write sleeps, for longer the closer it gets to
+    the stop limit, up to `max_delay` seconds. Past a stop limit writes block
+    until compaction brings things back under it, or raise `TimeoutError`
+    after `timeout` seconds if one is given. Memtables only throttle their
+    writes while a `CompactionScheduler` is running their compactions. When
+    one of those fails stopped writes raise `CompactionError` rather than
+    waiting on it.
+    """
+
+    def __init__(
+        self,
+        slowdown_segment_count=SLOWDOWN_SEGMENT_COUNT,
+        stop_segment_count=STOP_SEGMENT_COUNT,
+        slowdown_pending_compaction_bytes=SLOWDOWN_PENDING_COMPACTION_BYTES,
+        stop_pending_compaction_bytes=STOP_PENDING_COMPACTION_BYTES,
+        max_delay=WRITE_SLOWDOWN_MAX_DELAY,
+        timeout=WRITE_STALL_TIMEOUT,
+    ):
+        self.slowdown_segment_count = slowdown_segment_count
+        self.stop_segment_count = stop_segment_count
+        self.slowdown_pending_compaction_bytes = slowdown_pending_compaction_bytes
+        self.stop_pending_compaction_bytes = stop_pending_compaction_bytes
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.segment_count = 0
+        self.pending_compaction_bytes = 0
+        # The exception the last compaction failed with, if it did
+        self.compaction_error = None
+        self._cond = Condition()
+
+    def update(self, segment_count, pending_compaction_bytes):
+        with self._cond:
+            self.segment_count = segment_count
+            self.pending_compaction_bytes = pending_compaction_bytes
+            self._cond.notify_all()
+
+    def set_compaction_error(self, error):
+        with self._cond:
+            self.compaction_error = error
+            self._cond.notify_all()
+
+    @property
+    def state(self):
+        if (
+            self.segment_count >= self.stop_segment_count
+            or self.pending_compaction_bytes >= self.stop_pending_compaction_bytes
+        ):
+            return STOP
+        if (
+            self.segment_count >= self.slowdown_segment_count
+            or self.pending_compaction_bytes >= self.slowdown_pending_compaction_bytes
+        ):
+            return SLOWDOWN
+        return NORMAL
+
+    @property
+    def delay(self):
+        """
+        How long a write sleeps for in the slowdown state. That grows linearly
+        from a tenth of `max_delay` at the slowdown limit to `max_delay` at the
+        stop limit, going by whichever limit is closer.
+        """
+        progress = max(
+            _progress(
+                self.segment_count,
+                self.slowdown_segment_count,
+                self.stop_segment_count,
+            ),
+            _progress(
+                self.pending_compaction_bytes,
+                self.slowdown_pending_compaction_bytes,
+                self.stop_pending_compaction_bytes,
+            ),
+        )
+        return self.max_delay * max(progress, 0.1)
+
+    def throttle(self, stats=None):
+        """
+        Called before every write, returns once the write can go ahead.
+        """
+        state = self.state
+        if state == NORMAL:
+            return
+
+        if state == SLOWDOWN:
+            delay = self.delay
+            time.sleep(delay)
+            if stats is not None:
+                stats.incr("write_stall.slowdowns")
+                stats.record_time("write_stall.slowdown", delay)
+            return
+
+        start = time.perf_counter()
+        if stats is not None:
+            stats.incr("write_stall.stops")
+        with self._cond:
+            while self.state == STOP:
+                if self.compaction_error is not None:
+                    raise CompactionError(
+                        "Writes are stopped and compaction failed"
+                    ) from self.compaction_error
+                remaining = None
+                if self.timeout is not None:
+                    remaining = self.timeout - (time.perf_counter() - start)
+                    if remaining <= 0:
+                        raise TimeoutError(
+                            "Writes are stopped until compaction catches up"
+                        )
+                self._cond.wait(remaining)
+
+        if stats is not None:
+            stats.record_time("write_stall.stop", time.perf_counter() - start)
+
+
+def _progress(value, slowdown, stop):
+    if value < slowdown:
+        return 0
+    return min(1, (value - slowdown) / max(stop - slowdown, 1))
@@ -0,0 +1,184 @@
+"""
+Engine statistics. Counters are kept per thread so that incrementing them on
+the hot path is just a dict update without any locking. Reading the stats
+aggregates the per thread counters together. The counters of threads that
+have exited are folded into a shared total so they don't pile up.
+"""
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+
+
+class Statistics:
+    """
+    A collection of named counters and timers.
+
+    Counters are plain integers (`memtable.hits`, `blocks.read`, ...). Segment
+    counters are keyed by segment id as well as by name so the bloom filter
+    effectiveness can be looked at per segment, until the segment is removed
+    with `remove_segments`. Timers keep a count, a total and a max which is
+    enough to get the average and worst case of an operation.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # (thread, shard) of every thread that has counted anything
+        self._shards = []
+        # What the threads that have exited counted
+        self._retired = _new_shard()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = _new_shard()
+            with self._lock:
+                self._retire_dead_shards()
+                self._shards.append((threading.current_thread(), shard))
+            self._local.shard = shard
+            return shard
+
+    def _retire_dead_shards(self):
+        # Callers hold the lock. Nothing writes to the shard of a thread that
+        # has exited, so it can be folded in safely.
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                _fold(self._retired, shard)
+        self._shards = alive
+
+    def remove_segments(self, segment_ids):
+        """
+        Drops the per segment counters of segments that no longer exist.
+        """
+        with self._lock:
+            for shard in [self._retired] + [shard for _, shard in self._shards]:
+                for per_segment in list(shard["segments"].values()):
+                    for segment_id in segment_ids:
+                        per_segment.pop(segment_id, None)
+
+    def incr(self, name, amount=1):
+        self._shard()["counters"][name] += amount
+
+    def incr_segment(self, name, segment, amount=1):
+        self._shard()["segments"][name][segment] += amount
+
+    def record_time(self, name, seconds):
+        timer = self._shard()["timers"][name]
+        timer[0] += 1
+        timer[1] += seconds
+        if seconds > timer[2]:
+            timer[2] = seconds
+
+    def snapshot(self):
+        """
+        Aggregate the counters of every thread into a single dict.
+        """
+        totals = _new_shard()
+        with self._lock:
+            self._retire_dead_shards()
+            _fold(totals, self._retired)
+            shards = [shard for _, shard in self._shards]
+
+        for shard in shards:
+            _fold(totals, shard)
+
+        result = dict(totals["counters"])
+        for name, per_segment in totals["segments"].items():
+            if per_segment:
+                result[name] = dict(per_segment)
+        for name, (count, total, maximum) in totals["timers"].items():
+            result[name] = {
+                "count": count,
+                "total": total,
+                "avg": total / count if count else 0.0,
+                "max": maximum,
+            }
+
+        compaction_in = result.get("compaction.bytes_in", 0)
+        compaction_out = result.get("compaction.bytes_out", 0)
+        flushed = result.get("flush.bytes", 0)
+        if flushed:
+            # Everything that was written to disk divided by what the user
+            # actually wrote.
+            result["write_amplification"] = (flushed + compaction_out) / flushed
+        if compaction_in:
+            result["compaction.ratio"] = compaction_out / compaction_in
+        if result.get("get.count"):
+            result["get.segments_probed_avg"] = (
+                result.get("get.segments_probed", 0) / result["get.count"]
+            )
+
+        return result
+
+    def reset(self):
+        with self._lock:
+            for shard in [self._retired] + [shard for _, shard in self._shards]:
+                shard["counters"].clear()
+                shard["segments"].clear()
+                shard["timers"].clear()
+
+
+def _new_shard():
+    return {
+        "counters": defaultdict(int),
+        "segments": defaultdict(lambda: defaultdict(int)),
+        "timers": defaultdict(lambda: [0, 0.0, 0.0]),
+    }
+
+
+def _fold(totals, shard):
+    """
+    Adds the counters and timers of `shard` to `totals`.
+    """
+    for name, value in list(shard["counters"].items()):
+        totals["counters"][name] += value
+    for name, per_segment in list(shard["segments"].items()):
+        for segment, value in list(per_segment.items()):
+            totals["segments"][name][segment] += value
+    for name, (count, total, maximum) in list(shard["timers"].items()):
+        timer = totals["timers"][name]
+        timer[0] += count
+        timer[1] += total
+        timer[2] = max(timer[2], maximum)
+
+
+class StatsDumper:
+    """
+    Periodically writes the stats of a memtable as a json line to `out`.
+    """
+
+    def __init__(self, memtable, interval=60, out=None):
+        self.memtable = memtable
+        self.interval = interval
+        self.out = out or sys.stderr
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def dump(self):
+        record = {"time": time.time(), "stats": self.memtable.stats()}
+        self.out.write(json.dumps(record, default=str) + "\n")
+        self.out.flush()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.dump()
+
+
+def run_stats_dumper(memtable, interval=60, out=None):
+    return StatsDumper(memtable, interval, out).start()
@@ -0,0 +1,80 @@
+"""
+Range tombstones mark every key in `[start, end)` as deleted by a single write,
+see `MemTable.delete_range`.
+"""
+from bisect import insort
+
+
+class RangeTombstones:
+    """
+    A sorted list of `(start, end, seq)` range tombstones. A tombstone deletes
+    the versions of the keys it covers that are older than its sequence number.
+
+    The memtable keeps the range tombstones written since the last flush in one
+    of these and every sparse index keeps the ones written to its segment.
+    """
+
+    def __init__(self, tombstones=()):
+        self.tombstones = []
+        for start, end, seq in tombstones:
+            self.add(start, end, seq)
+
+    def __len__(self):
+        return len(self.tombstones)
+
+    def __iter__(self):
+        return iter(self.tombstones)
+
+    def add(self, start, end, seq):
+        insort(self.tombstones, (start, end, seq))
+
+    def extend(self, tombstones):
+        for start, end, seq in tombstones:
+            self.add(start, end, seq)
+
+    @property
+    def smallest(self):
+        return self.tombstones[0][0] if self.tombstones else None
+
+    @property
+    def largest(self):
+        # The ends are exclusive so this is an upper bound on the deleted keys
+        return max(end for _, end, _ in self.tombstones) if self.tombstones else None
+
+    def covering(self, key, seq=None):
+        """
+        Returns the sequence number of the newest tombstone covering `key` that
+        is visible at `seq`, or 0 if there isn't one.
+        """
+        covered = 0
+        for start, end, tombstone_seq in self.tombstones:
+            if start > key:
+                break
+            if key < end and (seq is None or tombstone_seq <= seq):
+                covered = max(covered, tombstone_seq)
+        return covered
+
+    def seqs_covering(self, key):
+        """
+        Returns the sequence numbers of every tombstone covering `key`.
+        """
+        seqs = []
+        for start, end, tombstone_seq in self.tombstones:
+            if start > key:
+                break
+            if key < end:
+                seqs.append(tombstone_seq)
+        return seqs
+
+    def covers(self, smallest, largest, seq, visible_at=None):
+        """
+        Is every key in `[smallest, largest]` deleted by a single tombstone
+        newer than `seq` (and visible at `visible_at`)?
+        """
+        for start, end, tombstone_seq in self.tombstones:
+            if start > smallest:
+                break
+            if largest < end and tombstone_seq > seq:
+                if visible_at is None or tombstone_seq <= visible_at:
+                    return True
+        return False
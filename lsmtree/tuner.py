@@ -0,0 +1,155 @@
+"""
+Retunes a memtable for the workload it's actually seeing, rather than the one
+the defaults in `settings.py` were picked for.
+"""
+import math
+
+from .events import EventListener
+from .settings import (BLOOM_FILTER_SIZE, RBTREE_FLUSH_SIZE,
+                       TOMBSTONE_COMPACTION_RATIO)
+
+
+class AutoTuner(EventListener):
+    """
+    Watches the reads and writes of `memtable` and adjusts its options after
+    every flush, so they apply to the segments written from then on.
+
+     - The flush size grows with the share of writes, from
+       `min_flush_tree_size` for reads only up to `max_flush_tree_size` for
+       writes only. Fewer, larger flushes mean less compaction.
+     - Blocks hold about 16 entries of the average written size when reading
+       and up to 64 when writing, between `min_block_size` and
+       `max_block_size`. Point reads decode less of a small block, writes and
+       scans compress better and index fewer entries with large ones.
+     - The bloom filters get more bits per key when the observed false
+       positive rate is over `target_false_positive_rate` and fewer when it's
+       well under it. They're sized for the keys a flush holds, up to
+       `max_bloom_filter_size`.
+     - The more of the writes are deletes, the sooner segments full of
+       tombstones are compacted.
+
+    Counts are kept without locking, so under concurrent use they're
+    approximate, which is all the heuristics need.
+    """
+
+    def __init__(
+        self,
+        memtable,
+        min_flush_tree_size=RBTREE_FLUSH_SIZE,
+        max_flush_tree_size=RBTREE_FLUSH_SIZE * 4,
+        min_block_size=1024 * 4,
+        max_block_size=1024 * 64,
+        target_false_positive_rate=0.01,
+        min_bits_per_key=4,
+        max_bits_per_key=20,
+        max_bloom_filter_size=BLOOM_FILTER_SIZE * 16,
+    ):
+        self.memtable = memtable
+        self.min_flush_tree_size = min_flush_tree_size
+        self.max_flush_tree_size = max_flush_tree_size
+        self.min_block_size = min_block_size
+        self.max_block_size = max_block_size
+        self.target_false_positive_rate = target_false_positive_rate
+        self.min_bits_per_key = min_bits_per_key
+        self.max_bits_per_key = max_bits_per_key
+        self.max_bloom_filter_size = max_bloom_filter_size
+        self.bits_per_key = 10
+        self._bloom_counts = self.bloom_counts()
+        self.reset()
+        memtable.add_listener(self)
+
+    def reset(self):
+        self.reads = 0
+        self.writes = 0
+        self.deletes = 0
+        self.written_bytes = 0
+
+    def close(self):
+        self.memtable.remove_listener(self)
+
+    def on_get_begin(self, key):
+        self.reads += 1
+
+    def on_put_begin(self, key, size):
+        self.writes += 1
+        self.written_bytes += len(key) + size
+        if not size:
+            self.deletes += 1
+
+    def on_flush_end(self, segment, size, duration):
+        self.tune()
+
+    def bloom_counts(self):
+        """
+        The number of bloom filter checks of keys a segment didn't have, and
+        how many of them were false positives.
+        """
+        stats = self.memtable.stats()
+        negatives = sum(stats.get("bloom.negatives", {}).values())
+        false_positives = sum(stats.get("bloom.false_positives", {}).values())
+        return negatives + false_positives, false_positives
+
+    def tune(self):
+        """
+        Adjusts the memtable's options for what's been seen since the last
+        time. Returns the options that changed.
+        """
+        reads, writes = self.reads, self.writes
+        if not reads + writes:
+            return {}
+        write_share = writes / (reads + writes)
+        options = self.memtable.options
+        changes = {}
+
+        flush_tree_size = int(
+            self.min_flush_tree_size
+            + (self.max_flush_tree_size - self.min_flush_tree_size) * write_share
+        )
+        changes["flush_tree_size"] = flush_tree_size
+
+        entry_size = self.written_bytes / writes if writes else None
+        if entry_size:
+            block_size = int(entry_size * (16 + 48 * write_share))
+            changes["block_size"] = min(
+                max(block_size, self.min_block_size), self.max_block_size
+            )
+
+        checks, false_positives = self.bloom_counts()
+        checks -= self._bloom_counts[0]
+        false_positives -= self._bloom_counts[1]
+        if checks:
+            rate = false_positives / checks
+            if rate > self.target_false_positive_rate:
+                self.bits_per_key += 2
+            elif rate < self.target_false_positive_rate / 2:
+                self.bits_per_key -= 1
+            self.bits_per_key = min(
+                max(self.bits_per_key, self.min_bits_per_key), self.max_bits_per_key
+            )
+        if entry_size:
+            keys_per_flush = flush_tree_size / entry_size
+            changes["bloom_filter_size"] = min(
+                int(keys_per_flush * self.bits_per_key), self.max_bloom_filter_size
+            )
+            # The number of hashes with the lowest false positive rate
+            changes["bloom_filter_hashes"] = max(
+                1, round(self.bits_per_key * math.log(2))
+            )
+
+        if writes:
+            changes["tombstone_compaction_ratio"] = max(
+                0.1, TOMBSTONE_COMPACTION_RATIO * (1 - self.deletes / writes)
+            )
+
+        changes = {
+            name: value
+            for name, value in changes.items()
+            if getattr(options, name) != value
+        }
+        if changes:
+            self.memtable.set_options(**changes)
+            self.memtable.statistics.incr("tuner.adjustments", len(changes))
+
+        self._bloom_counts = self.bloom_counts()
+        self.reset()
+        return changes
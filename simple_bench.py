@@ -5,8 +5,8 @@ import shutil
 import statistics
 import time
 
-from lsmtree.compaction import run_compactor, stop_compactor
 from lsmtree.memtable import MemTable
+from lsmtree.scheduler import CompactionScheduler
 from lsmtree.segment import Segment
 
 
@@ -86,8 +86,10 @@ if __name__ == "__main__":
     write_events = gather_events("example_transactions.jl")
     expected_records = gather_events("expected_state.jl")
     memtable = MemTable(db_dir="db")
+    scheduler = CompactionScheduler()
     if not args.no_compaction:
-        run_compactor(memtable)
+        scheduler.register(memtable)
+        scheduler.start()
 
     print("=========Starting Benchmark=========\n")
     print("- Test write performance [ ]", end="\r", flush=True)
@@ -111,8 +113,7 @@ if __name__ == "__main__":
         read_times.append(time.time() - start)
     print("- Test read performance [x]")
 
-    if not args.no_compaction:
-        stop_compactor()
+    scheduler.stop()
 
     report_results(report, write_times, read_times)
     report.append("")
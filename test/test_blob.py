@@ -0,0 +1,36 @@
+import os
+
+from lsmtree.blob import (BlobFile, pack_pointer, read_blob, separate_values,
+                          unpack_pointer)
+from lsmtree.segment import KIND_BLOB, KIND_VALUE
+
+
+def test_blob_file(tmp_path):
+    blob_file = BlobFile(3, tmp_path)
+    first = blob_file.add(b"a", b"x" * 100)
+    second = blob_file.add(b"b", b"y" * 100)
+    blob_file.close()
+
+    assert os.path.getsize(os.path.join(tmp_path, "blob.3")) == blob_file.size
+    assert unpack_pointer(first)[:2] == (3, 0)
+    assert unpack_pointer(second)[1] == unpack_pointer(first)[2]
+    assert read_blob(tmp_path, first) == b"x" * 100
+    assert read_blob(tmp_path, second) == b"y" * 100
+    assert unpack_pointer(pack_pointer(1, 2, 3)) == (1, 2, 3)
+
+
+def test_separate_values(tmp_path):
+    blob_file = BlobFile(0, tmp_path)
+    entries = [
+        (b"a", 1, KIND_VALUE, b"small"),
+        (b"b", 2, KIND_VALUE, b"large value"),
+        # tombstones and other kinds are never moved
+        (b"c", 3, KIND_VALUE, b""),
+    ]
+    separated = list(separate_values(entries, blob_file, threshold=5))
+    blob_file.close()
+
+    assert separated[0] == entries[0]
+    assert separated[1][:3] == (b"b", 2, KIND_BLOB)
+    assert read_blob(tmp_path, separated[1][3]) == b"large value"
+    assert separated[2] == entries[2]
@@ -0,0 +1,88 @@
+import pytest
+
+from lsmtree.cache import BlockCache, RowCache
+from lsmtree.compaction import Compactor
+from lsmtree.memtable import MemTable
+from lsmtree.stats import Statistics
+
+
+def test_block_cache_lru():
+    cache = BlockCache(capacity=10)
+    cache.put((0, 0), b"a", 4)
+    cache.put((0, 4), b"b", 4)
+    assert cache.get((0, 0)) == b"a"
+
+    # evicts (0, 4) since (0, 0) was used more recently
+    cache.put((1, 0), b"c", 4)
+    assert cache.get((0, 4)) is None
+    assert cache.get((0, 0)) == b"a"
+    assert cache.usage == 8
+
+    # too big to ever fit
+    cache.put((1, 4), b"d", 11)
+    assert cache.get((1, 4)) is None
+
+    cache.evict_segment(0)
+    assert len(cache) == 1
+    assert cache.usage == 4
+
+    cache.shrink(0)
+    assert len(cache) == 0
+
+
+def test_block_cache_stats():
+    stats = Statistics()
+    cache = BlockCache(capacity=10, stats=stats)
+    cache.get((0, 0))
+    cache.put((0, 0), b"a", 1)
+    cache.get((0, 0))
+
+    assert stats.snapshot() == {"block_cache.misses": 1, "block_cache.hits": 1}
+
+
+def test_row_cache(tmp_path):
+    memtable = MemTable(tmp_path, row_cache_size=1024)
+    memtable[b"a"] = b"1"
+    memtable[b"b"] = b"2"
+    memtable[b"c"] = b"3"
+    memtable.flush_tree()
+
+    assert memtable[b"a"] == b"1"
+    with pytest.raises(KeyError):
+        memtable[b"missing"]
+    # hits for the value and the miss, without reading a block
+    blocks_read = memtable.stats()["block_cache.misses"]
+    assert memtable[b"a"] == b"1"
+    with pytest.raises(KeyError):
+        memtable[b"missing"]
+    assert memtable.stats()["row_cache.hits"] == 2
+    assert memtable.stats()["block_cache.misses"] == blocks_read
+
+    assert memtable[b"b"] == b"2"
+
+    # writes and deletes are seen before and after they're flushed
+    memtable[b"a"] = b"11"
+    memtable[b"missing"] = b"found"
+    memtable.delete_range(b"b", b"c")
+    memtable.flush_tree()
+    assert memtable[b"a"] == b"11"
+    assert memtable[b"missing"] == b"found"
+    with pytest.raises(KeyError):
+        memtable[b"b"]
+
+    Compactor(memtable).compact()
+    assert memtable[b"a"] == b"11"
+    assert memtable[b"c"] == b"3"
+    with pytest.raises(KeyError):
+        memtable[b"b"]
+
+
+def test_row_cache_evict():
+    cache = RowCache(capacity=100)
+    for key in (b"a", b"b", b"c", b"d"):
+        cache.put(key, key, 2)
+    cache.evict_keys([b"a", b"x"])
+    cache.evict_range(b"b", b"d")
+    assert cache.get(b"d") == b"d"
+    assert len(cache) == 1
+    assert cache.usage == 2
@@ -0,0 +1,131 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from lsmtree import checkpoint as checkpoint_module
+from lsmtree.checkpoint import list_backups, purge_backups, restore_backup
+from lsmtree.compaction import Compactor
+from lsmtree.memtable import MemTable
+
+
+def test_checkpoint(tmp_path):
+    db_dir = tmp_path / "db"
+    db_dir.mkdir()
+    memtable = MemTable(db_dir, blob_threshold=16)
+    for i in range(3):
+        memtable[b"k%d" % i] = b"v%d" % i
+        memtable.flush_tree()
+    memtable[b"big"] = b"x" * 32
+    memtable[b"k0"] = b"unflushed"
+
+    checkpoint_dir = tmp_path / "checkpoint"
+    memtable.checkpoint(checkpoint_dir)
+    segment = os.path.join(db_dir, "segment.0")
+    assert os.stat(segment).st_ino == os.stat(checkpoint_dir / "segment.0").st_ino
+
+    # compaction removes the segments from the database but not the checkpoint
+    memtable[b"k1"] = b"after"
+    memtable.flush_tree()
+    Compactor(memtable).compact()
+    assert not os.path.exists(segment)
+
+    checkpoint = MemTable.reconstruct(checkpoint_dir)
+    assert list(checkpoint.scan()) == [
+        (b"big", b"x" * 32),
+        (b"k0", b"unflushed"),
+        (b"k1", b"v1"),
+        (b"k2", b"v2"),
+    ]
+
+
+def test_backup(tmp_path):
+    db_dir = tmp_path / "db"
+    db_dir.mkdir()
+    backup_dir = tmp_path / "backup"
+    memtable = MemTable(db_dir)
+    for i in range(3):
+        memtable[b"k%d" % i] = b"v%d" % i
+        memtable.flush_tree()
+
+    assert memtable.backup(backup_dir) == 0
+    copied = memtable.stats()["backup.bytes_copied"]
+
+    memtable[b"k3"] = b"v3"
+    assert memtable.backup(backup_dir) == 1
+    # only the new segment is copied
+    segment_size = os.path.getsize(db_dir / "segment.3")
+    assert memtable.stats()["backup.bytes_copied"] == copied + segment_size
+    assert list_backups(backup_dir) == [0, 1]
+
+    restore_backup(backup_dir, tmp_path / "restored")
+    restored = MemTable.reconstruct(tmp_path / "restored")
+    assert [k for k, _ in restored.scan()] == [b"k0", b"k1", b"k2", b"k3"]
+
+    restore_backup(backup_dir, tmp_path / "restored0", backup_id=0)
+    restored = MemTable.reconstruct(tmp_path / "restored0")
+    assert [k for k, _ in restored.scan()] == [b"k0", b"k1", b"k2"]
+
+    # compact so the next backup no longer needs the old segments
+    Compactor(memtable).compact()
+    memtable.backup(backup_dir)
+    purge_backups(backup_dir, keep=1)
+    assert list_backups(backup_dir) == [2]
+    assert not os.path.exists(backup_dir / "segment.0")
+    restore_backup(backup_dir, tmp_path / "restored2")
+    restored = MemTable.reconstruct(tmp_path / "restored2")
+    assert [k for k, _ in restored.scan()] == [b"k0", b"k1", b"k2", b"k3"]
+
+
+def test_checkpoint_during_compaction(tmp_path, monkeypatch):
+    db_dir = tmp_path / "db"
+    db_dir.mkdir()
+    memtable = MemTable(db_dir)
+    for i in range(3):
+        memtable[b"k%d" % i] = b"v%d" % i
+        memtable.flush_tree()
+
+    # compaction runs while the files are being copied
+    link_or_copy = checkpoint_module.link_or_copy
+    copied = []
+
+    def compact_and_copy(src, dst):
+        if not copied:
+            Compactor(memtable).compact()
+            assert os.path.exists(db_dir / "segment.3")
+            assert os.path.exists(src)
+        copied.append(os.path.basename(src))
+        shutil.copyfile(src, dst)
+
+    monkeypatch.setattr(checkpoint_module, "link_or_copy", compact_and_copy)
+    memtable.checkpoint(tmp_path / "checkpoint")
+    monkeypatch.setattr(checkpoint_module, "link_or_copy", link_or_copy)
+
+    assert copied == ["segment.0", "segment.1", "segment.2"]
+    # the files compaction replaced are gone once they're copied
+    assert not os.path.exists(db_dir / "segment.0")
+    assert not os.path.exists(db_dir / "segment.1")
+    assert not memtable.pinned_files
+    checkpoint = MemTable.reconstruct(tmp_path / "checkpoint")
+    assert list(checkpoint.scan()) == [(b"k0", b"v0"), (b"k1", b"v1"), (b"k2", b"v2")]
+    assert list(memtable.scan()) == [(b"k0", b"v0"), (b"k1", b"v1"), (b"k2", b"v2")]
+
+
+def test_checkpoint_with_concurrent_writes(tmp_path):
+    db_dir = tmp_path / "db"
+    db_dir.mkdir()
+    memtable = MemTable(db_dir)
+
+    def put(thread):
+        for i in range(500):
+            memtable[b"%d-%03d" % (thread, i)] = b"value"
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        writes = [pool.submit(put, thread) for thread in range(4)]
+        for i in range(5):
+            memtable.checkpoint(tmp_path / f"checkpoint{i}")
+        for write in writes:
+            write.result()
+
+    # the writes that were flushed by a checkpoint aren't lost
+    restored = MemTable.reconstruct(db_dir)
+    assert len(list(restored.scan())) == 4 * 500
@@ -1,6 +1,8 @@
 import os
 
-from lsmtree.compaction import Compactor
+import pytest
+
+from lsmtree.compaction import Compactor, retained_versions
 from lsmtree.memtable import MemTable
 from lsmtree.segment import Block, Segment
 
@@ -8,8 +10,12 @@ from lsmtree.segment import Block, Segment
 def test_compactor_get_target_segments(tmp_path):
     memtable = MemTable(db_dir=tmp_path)
     for i in range(5):
-        with open(os.path.join(tmp_path, f"segment.{i}"), "w+") as f:
-            pass
+        memtable[b"a"] = bytes(i)
+        memtable.flush_tree()
+
+    # not in the manifest so it's not a segment yet
+    with open(os.path.join(tmp_path, "segment.9"), "w+") as f:
+        pass
 
     assert Compactor(memtable).get_target_segments() == [
         0,
@@ -30,7 +36,7 @@ def test_compactor_iter_kv_pairs(tmp_path):
     assert results == [(b"a", b"a"), (b"b", b"b"), (b"x", b"x")]
 
 
-def test_compactor_iter_smallest_kv_pair(tmp_path):
+def test_compactor_iter_merged_versions(tmp_path):
     memtable = MemTable(tmp_path)
     memtable[b"x"] = b"x1"
     memtable[b"a"] = b"a1"
@@ -47,18 +53,37 @@ def test_compactor_iter_smallest_kv_pair(tmp_path):
 
     compactor = Compactor(memtable)
     targets = compactor.get_target_segments()
-    results = [kv for kv in compactor.iter_smallest_kv_pair(targets[0], targets[1])]
+    results = [kv for kv in compactor.iter_merged_versions(targets[0], targets[1])]
     expected = [
-        (b"a", b"a1"),
-        (b"b", b"b2"),
-        (b"c", b"c2"),
-        (b"d", b""),
-        (b"x", b"x2"),
-        (b"y", b"y1"),
+        (b"a", [(2, 0, b"a1")]),
+        (b"b", [(7, 0, b"b2"), (3, 0, b"b1")]),
+        (b"c", [(8, 0, b"c2")]),
+        (b"d", [(9, 0, b""), (4, 0, b"d1")]),
+        (b"x", [(6, 0, b"x2"), (1, 0, b"x1")]),
+        (b"y", [(5, 0, b"y1")]),
     ]
     assert results == expected
 
 
+def test_retained_versions():
+    versions = [(9, 0, b"c"), (7, 0, b""), (5, 0, b"b"), (2, 0, b"a")]
+
+    assert retained_versions(versions, []) == [(9, 0, b"c")]
+    assert retained_versions(versions, [5, 6]) == [(9, 0, b"c"), (5, 0, b"b")]
+    assert retained_versions(versions, [1]) == [(9, 0, b"c")]
+    assert retained_versions(versions, [8]) == [(9, 0, b"c"), (7, 0, b"")]
+    assert retained_versions(versions, [8], bottommost=True) == [(9, 0, b"c")]
+    assert retained_versions(versions, [3, 8]) == [
+        (9, 0, b"c"),
+        (7, 0, b""),
+        (2, 0, b"a"),
+    ]
+    deleted = [(3, 0, b""), (1, 0, b"a")]
+    assert retained_versions(deleted, [], bottommost=True) == []
+    # an older segment might still have the key
+    assert retained_versions(deleted, []) == [(3, 0, b"")]
+
+
 def test_compactor_compact(tmp_path):
     memtable = MemTable(tmp_path)
     memtable[b"x"] = b"x1"
@@ -76,8 +101,10 @@ def test_compactor_compact(tmp_path):
 
     compactor = Compactor(memtable)
     compactor.compact()
+    assert memtable.manifest.live_ids() == [2]
+    assert sorted(os.listdir(tmp_path)) == ["manifest.log", "segment.2"]
     kvs = []
-    with Segment(id=1, db_dir=tmp_path) as segment:
+    with Segment(id=2, db_dir=tmp_path) as segment:
         for _, _, _, raw_block in segment:
             for kv in Block.iter_from_binary(raw_block):
                 kvs.append(kv)
@@ -90,3 +117,202 @@ def test_compactor_compact(tmp_path):
         (b"y", b"y1"),
     ]
     assert kvs == expected
+
+
+def test_compactor_compact_keeps_snapshot_versions(tmp_path):
+    memtable = MemTable(tmp_path)
+    memtable[b"a"] = b"a1"
+    memtable[b"b"] = b"b1"
+    memtable.flush_tree()
+    snapshot = memtable.snapshot()
+
+    memtable[b"a"] = b"a2"
+    del memtable[b"b"]
+    memtable.flush_tree()
+
+    Compactor(memtable).compact()
+    assert memtable[b"a"] == b"a2"
+    assert snapshot.get(b"a") == b"a1"
+    assert snapshot.get(b"b") == b"b1"
+    with pytest.raises(KeyError):
+        memtable[b"b"]
+
+    snapshot.release()
+    memtable[b"c"] = b"c"
+    memtable.flush_tree()
+    Compactor(memtable).compact()
+    assert list(memtable.scan()) == [(b"a", b"a2"), (b"c", b"c")]
+
+
+def test_compactor_compact_expired(tmp_path):
+    memtable = MemTable(tmp_path)
+    now = 1000.0
+    memtable.clock = lambda: now
+
+    memtable[b"a"] = b"a1"
+    memtable.put(b"b", b"b1", ttl=10)
+    memtable.flush_tree()
+    memtable.put(b"a", b"a2", ttl=10)
+    memtable.put(b"c", b"c2", ttl=100)
+    memtable.flush_tree()
+
+    now = 1050.0
+    Compactor(memtable).compact()
+    kvs = [kv for kv in Compactor(memtable).iter_kv_pairs(2)]
+    # the expired b"a" and b"b" are dropped, c still has its expiry prefix
+    assert [k for k, _ in kvs] == [b"c"]
+    assert memtable[b"c"] == b"c2"
+    assert memtable.manifest.get(2).expires_at == 1100 * 1000
+
+
+def test_compactor_drop_expired_segments(tmp_path):
+    memtable = MemTable(tmp_path)
+    now = 1000.0
+    memtable.clock = lambda: now
+
+    memtable[b"a"] = b"a"
+    memtable.flush_tree()
+    # overlaps segment 0 so can't be dropped without bringing back b"a"
+    memtable.put(b"a", b"a2", ttl=10)
+    memtable.put(b"b", b"b2", ttl=10)
+    memtable.flush_tree()
+    # doesn't overlap anything older
+    memtable.put(b"x", b"x", ttl=10)
+    memtable.flush_tree()
+    memtable[b"z"] = b"z"
+    memtable.flush_tree()
+
+    compactor = Compactor(memtable)
+    compactor.drop_expired_segments()
+    assert memtable.manifest.live_ids() == [0, 1, 2, 3]
+
+    now = 1010.0
+    compactor.drop_expired_segments()
+    assert memtable.manifest.live_ids() == [0, 1, 3]
+    assert not os.path.exists(os.path.join(tmp_path, "segment.2"))
+    with pytest.raises(KeyError):
+        memtable[b"a"]
+    assert memtable[b"z"] == b"z"
+
+
+def test_compactor_compact_range_tombstones(tmp_path):
+    memtable = MemTable(tmp_path)
+    for key in (b"a", b"b", b"c"):
+        memtable[key] = key
+    memtable.flush_tree()
+    snapshot = memtable.snapshot()
+    memtable.delete_range(b"a", b"c")
+    memtable[b"d"] = b"d"
+    memtable.flush_tree()
+
+    Compactor(memtable).compact()
+    # kept since the snapshot can't see the tombstone
+    assert len(memtable.sparse_index.range_tombstones) == 1
+    assert [k for k, _ in Compactor(memtable).iter_kv_pairs(2)] == [
+        b"a",
+        b"b",
+        b"c",
+        b"d",
+    ]
+    assert snapshot.get(b"a") == b"a"
+    with pytest.raises(KeyError):
+        memtable[b"a"]
+    snapshot.release()
+
+    memtable[b"e"] = b"e"
+    memtable.flush_tree()
+    Compactor(memtable).compact()
+    # nothing older is left for the tombstone to delete
+    assert memtable.manifest.live_ids() == [4]
+    assert len(memtable.sparse_index.range_tombstones) == 0
+    assert [k for k, _ in Compactor(memtable).iter_kv_pairs(4)] == [b"c", b"d", b"e"]
+    assert list(memtable.scan()) == [(b"c", b"c"), (b"d", b"d"), (b"e", b"e")]
+
+
+def test_compactor_drop_deleted_segments(tmp_path):
+    memtable = MemTable(tmp_path)
+    memtable[b"b"] = b"b"
+    memtable[b"c"] = b"c"
+    memtable.flush_tree()
+    memtable[b"x"] = b"x"
+    memtable.flush_tree()
+
+    compactor = Compactor(memtable)
+    with memtable.snapshot():
+        memtable.delete_range(b"a", b"d")
+        compactor.drop_deleted_segments()
+        assert memtable.manifest.live_ids() == [0, 1]
+
+    compactor.drop_deleted_segments()
+    assert memtable.manifest.live_ids() == [1]
+    assert not os.path.exists(os.path.join(tmp_path, "segment.0"))
+    assert list(memtable.scan()) == [(b"x", b"x")]
+
+
+def test_compactor_tombstone_density(tmp_path):
+    memtable = MemTable(tmp_path)
+    memtable[b"a"] = b"a"
+    memtable[b"b"] = b"b"
+    memtable.flush_tree()
+    memtable[b"c"] = b"c"
+    memtable[b"z"] = b"z"
+    memtable.flush_tree()
+    del memtable[b"a"]
+    del memtable[b"b"]
+    memtable[b"y"] = b"y"
+    memtable.flush_tree()
+
+    meta = memtable.manifest.get(2)
+    assert (meta.num_entries, meta.num_tombstones) == (3, 2)
+    assert memtable.sparse_index.num_tombstones == 2
+
+    compactor = Compactor(memtable)
+    # the segment full of tombstones and the one before it
+    assert compactor.get_target_segments() == [1, 2]
+    assert Compactor(memtable, tombstone_ratio=0.9).get_target_segments() == [0, 1]
+
+    compactor.compact()
+    assert memtable.manifest.live_ids() == [0, 3]
+    # segment 0 still has the keys so the tombstones have to stay
+    assert [k for k, _ in compactor.iter_kv_pairs(3)] == [b"a", b"b", b"c", b"y", b"z"]
+    with pytest.raises(KeyError):
+        memtable[b"a"]
+
+    compactor.compact()
+    assert [k for k, _ in compactor.iter_kv_pairs(4)] == [b"c", b"y", b"z"]
+    assert memtable.manifest.get(4).num_tombstones == 0
+    with pytest.raises(KeyError):
+        memtable[b"a"]
+
+
+def test_compactor_blob_gc(tmp_path):
+    memtable = MemTable(tmp_path, blob_threshold=10)
+    memtable[b"a"] = b"a" * 100
+    memtable[b"b"] = b"b" * 100
+    memtable.flush_tree()
+    memtable[b"a"] = b"A" * 100
+    memtable.flush_tree()
+
+    compactor = Compactor(memtable, blob_gc_ratio=0.9)
+    compactor.compact()
+    # the old b"a" is garbage but b"b" still lives in blob.0
+    blob_files = memtable.manifest.blob_files
+    assert sorted(blob_files) == [0, 1]
+    assert 0.4 < blob_files[0].garbage_ratio < 0.6
+    assert memtable.manifest.get(2).blob_refs == [0, 1]
+
+    memtable[b"c"] = b"c"
+    memtable.flush_tree()
+    Compactor(memtable, blob_gc_ratio=0.4).compact()
+    # b"b" was moved to the compaction's blob file so blob.0 could be removed
+    assert sorted(memtable.manifest.blob_files) == [1, 4]
+    assert not os.path.exists(os.path.join(tmp_path, "blob.0"))
+    assert memtable[b"a"] == b"A" * 100
+    assert memtable[b"b"] == b"b" * 100
+
+    del memtable[b"a"]
+    del memtable[b"b"]
+    memtable.flush_tree()
+    Compactor(memtable).compact()
+    assert memtable.manifest.blob_files == {}
+    assert list(memtable.scan()) == [(b"c", b"c")]
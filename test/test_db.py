@@ -0,0 +1,161 @@
+import os
+import threading
+
+import pytest
+
+from lsmtree.db import DB
+
+
+def test_column_families(tmp_path):
+    db = DB(tmp_path)
+    assert db.list_column_families() == ["default"]
+
+    users = db.create_column_family("users", block_size=64, bloom_filter_size=101)
+    assert users.block_size == 64
+    with pytest.raises(ValueError):
+        db.create_column_family("users")
+    with pytest.raises(TypeError):
+        db.create_column_family("other", not_an_option=1)
+
+    db.put(b"a", b"default a")
+    db.put(b"a", b"users a", column_family="users")
+    assert db.get(b"a") == b"default a"
+    assert db.get(b"a", column_family="users") == b"users a"
+
+    db.delete(b"a", column_family="users")
+    with pytest.raises(KeyError):
+        db.get(b"a", column_family="users")
+    assert db.get(b"a") == b"default a"
+
+    # only the shared WAL is used
+    assert sorted(os.listdir(tmp_path)) == [
+        "default",
+        "families.json",
+        "users",
+        "wal.0",
+    ]
+    assert os.listdir(os.path.join(tmp_path, "users")) == []
+
+
+def test_column_families_recover(tmp_path):
+    db = DB(tmp_path)
+    db.create_column_family("users", block_size=64)
+    db.put(b"a", b"1")
+    db.put(b"b", b"2", column_family="users")
+    db.column_family("users").flush_tree()
+    db.put(b"c", b"3", column_family="users")
+    db.close()
+
+    db = DB(tmp_path)
+    assert db.column_family("users").block_size == 64
+    assert db.get(b"a") == b"1"
+    assert db.get(b"b", column_family="users") == b"2"
+    assert db.get(b"c", column_family="users") == b"3"
+    # b"b" was flushed so it isn't replayed from the WAL again
+    assert len(db.column_family("users").rbtree) == 1
+
+
+def test_column_family_options_saved(tmp_path):
+    db = DB(tmp_path)
+    db.create_column_family("users", block_size=64)
+    db.column_family("users").set_options(block_size=128, row_cache_size=256)
+    db.column_family().set_options(bloom_filter_size=101)
+    db.close()
+
+    db = DB(tmp_path)
+    users = db.column_family("users")
+    assert users.block_size == 128
+    assert users.row_cache.capacity == 256
+    assert db.column_family().bloom_filter_size == 101
+
+    db.drop_column_family("users")
+    users.set_options(block_size=256)
+    assert db.list_column_families() == ["default"]
+
+
+def test_column_families_wal_release(tmp_path):
+    db = DB(tmp_path)
+    db.create_column_family("users")
+    db.put(b"a", b"1")
+    db.put(b"b", b"2", column_family="users")
+
+    db.column_family("users").flush_tree()
+    # wal.0 still has the default column family's record
+    assert sorted(db.wal.logs) == [0, 1]
+    assert os.path.exists(os.path.join(tmp_path, "wal.0"))
+
+    db.column_family().flush_tree()
+    assert sorted(db.wal.logs) == [1]
+    assert not os.path.exists(os.path.join(tmp_path, "wal.0"))
+
+    db.drop_column_family("users")
+    assert db.list_column_families() == ["default"]
+    assert not os.path.exists(os.path.join(tmp_path, "users"))
+    db.close()
+    assert DB(tmp_path).list_column_families() == ["default"]
+
+
+def test_group_commit(tmp_path):
+    db = DB(tmp_path)
+    names = [f"cf{i}" for i in range(4)]
+    for name in names:
+        db.create_column_family(name)
+
+    def write(name):
+        for i in range(50):
+            db.put(str(i).encode(), name.encode(), column_family=name)
+
+    threads = [threading.Thread(target=write, args=(name,)) for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = db.statistics.snapshot()
+    assert stats["wal.group_commit_records"] == 200
+    assert stats["wal.group_commits"] <= 200
+    db.close()
+
+    db = DB(tmp_path)
+    for name in names:
+        assert db.get(b"49", column_family=name) == name.encode()
+
+
+def test_group_commit_one_column_family(tmp_path):
+    db = DB(tmp_path)
+
+    def write(thread):
+        for i in range(50):
+            db.put(b"%d-%d" % (thread, i), b"value")
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # writers to the same column family share fsyncs too
+    stats = db.statistics.snapshot()
+    assert stats["wal.group_commit_records"] == 400
+    assert stats["wal.group_commits"] < 400
+    db.close()
+
+    db = DB(tmp_path)
+    assert len(list(db.column_family().scan())) == 400
+
+
+def test_compaction_pool(tmp_path):
+    db = DB(tmp_path)
+    users = db.create_column_family("users")
+    for memtable in (db.column_family(), users):
+        for i in range(3):
+            memtable[b"k"] = bytes([i])
+            memtable.flush_tree()
+
+    db.start_compaction()
+    db.scheduler.wait_until_idle()
+    db.close()
+
+    assert len(users.manifest.segments) == 1
+    assert users[b"k"] == bytes([2])
+    assert db.column_family()[b"k"] == bytes([2])
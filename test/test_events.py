@@ -0,0 +1,95 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from lsmtree.compaction import Compactor
+from lsmtree.events import EventListener, SamplingProfiler
+from lsmtree.memtable import MemTable
+
+
+class RecordingListener(EventListener):
+    def __init__(self):
+        self.events = []
+
+    def on_get_end(self, key, found, duration):
+        self.events.append(("get", key, found))
+
+    def on_put_end(self, key, size, duration):
+        self.events.append(("put", key, size))
+
+    def on_segment_probe(self, segment, key, bloom_hit):
+        self.events.append(("probe", segment, key))
+
+    def on_block_read(self, segment, offset, size, duration):
+        self.events.append(("block", segment, offset, size > 0))
+
+    def on_flush_end(self, segment, size, duration):
+        self.events.append(("flush", segment, size > 0))
+
+    def on_compaction_begin(self, targets):
+        self.events.append(("compaction_begin", targets))
+
+    def on_compaction_end(self, targets, output, bytes_in, bytes_out, duration):
+        self.events.append(("compaction_end", targets, output))
+
+
+def test_event_listener(tmp_path):
+    listener = RecordingListener()
+    memtable = MemTable(tmp_path, listeners=[listener])
+    memtable[b"a"] = b"abc"
+    memtable.flush_tree()
+    memtable[b"b"] = b"b"
+    del memtable[b"b"]
+    memtable.flush_tree()
+
+    assert memtable[b"a"] == b"abc"
+    Compactor(memtable).compact()
+
+    assert listener.events == [
+        ("put", b"a", 3),
+        ("flush", 0, True),
+        ("put", b"b", 1),
+        ("put", b"b", 0),
+        ("flush", 1, True),
+        ("probe", 0, b"a"),
+        ("block", 0, 0, True),
+        ("get", b"a", True),
+        ("compaction_begin", [0, 1]),
+        ("compaction_end", [0, 1], 2),
+    ]
+
+    memtable.remove_listener(listener)
+    memtable[b"c"] = b"c"
+    assert len(listener.events) == 10
+
+
+def test_sampling_profiler(tmp_path):
+    profiler = SamplingProfiler(sample_rate=2, slow_threshold=0)
+    memtable = MemTable(tmp_path, listeners=[profiler])
+    memtable[b"a"] = b"a"
+
+    assert profiler.report() == ""
+    for _ in range(4):
+        assert memtable[b"a"] == b"a"
+
+    assert "function calls" in profiler.report()
+    assert [key for key, _ in profiler.slow_operations] == [b"a"] * 4
+
+
+def test_sampling_profiler_concurrent_gets(tmp_path):
+    profiler = SamplingProfiler(sample_rate=1)
+    memtable = MemTable(tmp_path, listeners=[profiler])
+    memtable[b"a"] = b"a"
+
+    # another get is being profiled, so this one is skipped rather than failing
+    profiler.on_get_begin(b"a")
+    results = []
+    thread = threading.Thread(target=lambda: results.append(memtable[b"a"]))
+    thread.start()
+    thread.join()
+    profiler.on_get_end(b"a", True, 0)
+    assert results == [b"a"]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        values = list(executor.map(lambda _: memtable[b"a"], range(200)))
+    assert values == [b"a"] * 200
+    assert "function calls" in profiler.report()
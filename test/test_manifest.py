@@ -0,0 +1,70 @@
+import os
+
+from lsmtree.manifest import BlobMeta, Manifest, SegmentMeta
+
+
+def test_manifest_apply_and_load(tmp_path):
+    manifest = Manifest(tmp_path)
+    assert not manifest.exists
+
+    manifest.apply(add=[SegmentMeta(0, smallest=b"a", largest=b"c")], last_seq=3)
+    manifest.apply(add=[SegmentMeta(1)])
+    manifest.apply(add=[SegmentMeta(2)])
+    # replaces the newest of the removed segments
+    manifest.apply(add=[SegmentMeta(3, level=1)], remove=[0, 1])
+    assert manifest.live_ids() == [3, 2]
+
+    loaded = Manifest(tmp_path)
+    assert loaded.live_ids() == [3, 2]
+    assert loaded.get(3).level == 1
+    assert loaded.next_segment == 4
+    assert loaded.last_seq == 3
+    assert loaded.edits == 4
+
+
+def test_manifest_torn_write(tmp_path):
+    manifest = Manifest(tmp_path)
+    manifest.apply(add=[SegmentMeta(0, smallest=b"a", largest=b"c")])
+    size = os.path.getsize(manifest.segment.path)
+    manifest.apply(add=[SegmentMeta(1)])
+
+    with open(manifest.segment.path, "r+b") as f:
+        f.truncate(size + 10)
+
+    loaded = Manifest(tmp_path)
+    assert loaded.live_ids() == [0]
+    assert loaded.get(0).smallest == b"a"
+    assert os.path.getsize(manifest.segment.path) == size
+
+
+def test_manifest_rewrite(tmp_path):
+    manifest = Manifest(tmp_path)
+    for i in range(10):
+        manifest.apply(add=[SegmentMeta(i)])
+    manifest.apply(remove=list(range(9)))
+    manifest.rewrite()
+
+    loaded = Manifest(tmp_path)
+    assert loaded.live_ids() == [9]
+    assert loaded.next_segment == 10
+    assert loaded.edits == 1
+    assert not os.path.exists(os.path.join(tmp_path, "manifest.tmp"))
+
+
+def test_manifest_blob_files(tmp_path):
+    manifest = Manifest(tmp_path)
+    manifest.apply(
+        add=[SegmentMeta(0, blob_refs=[0])], add_blobs=[BlobMeta(0, size=100)]
+    )
+    manifest.apply(blob_garbage=[(0, 60)])
+    assert manifest.blob_files[0].garbage_ratio == 0.6
+    assert manifest.referenced_blobs() == {0}
+
+    loaded = Manifest(tmp_path)
+    assert loaded.blob_files[0].garbage == 60
+    assert loaded.get(0).blob_refs == [0]
+    loaded.rewrite()
+    assert Manifest(tmp_path).blob_files[0].size == 100
+
+    manifest.apply(remove=[0], remove_blobs=[0])
+    assert Manifest(tmp_path).blob_files == {}
@@ -0,0 +1,162 @@
+import threading
+
+from lsmtree.compaction import Compactor
+from lsmtree.db import DB
+from lsmtree.memory import RBTREE_ENTRY_OVERHEAD, MemoryBudget
+from lsmtree.memtable import MemTable
+
+
+def test_memory_usage(tmp_path):
+    memtable = MemTable(tmp_path, row_cache_size=1024)
+    assert memtable.memory_usage() == {
+        "memtable": 0,
+        "block_cache": 0,
+        "row_cache": 0,
+        "indexes": 0,
+        "filters": 0,
+    }
+
+    memtable[b"a"] = b"1"
+    memtable[b"b"] = b"2"
+    assert memtable.memory_usage()["memtable"] == 4 + 2 * RBTREE_ENTRY_OVERHEAD
+
+    with memtable.sparse_index_lock:
+        memtable.flush_tree()
+    assert memtable[b"a"] == b"1"
+    usage = memtable.memory_usage()
+    assert usage["memtable"] == 0
+    assert usage["block_cache"] > 0
+    assert usage["row_cache"] == 2
+    assert usage["indexes"] == memtable.sparse_index.index_nbytes
+    assert usage["filters"] == memtable.sparse_index.filter_nbytes > 0
+
+
+def test_budget_usage(tmp_path):
+    budget = MemoryBudget()
+    (tmp_path / "first").mkdir()
+    (tmp_path / "second").mkdir()
+    first = MemTable(tmp_path / "first", memory_budget=budget)
+    second = MemTable(tmp_path / "second", memory_budget=budget)
+    first[b"a"] = b"1"
+    second[b"b"] = b"22"
+
+    usage = budget.usage()
+    assert usage["memtable"] == 5 + 2 * RBTREE_ENTRY_OVERHEAD
+    assert usage["total"] == usage["memtable"]
+
+    budget.unregister(second)
+    assert budget.usage()["memtable"] == 2 + RBTREE_ENTRY_OVERHEAD
+
+
+def test_budget_shrinks_caches_first(tmp_path):
+    budget = MemoryBudget()
+    memtable = MemTable(tmp_path, block_size=64, memory_budget=budget)
+    for i in range(100):
+        memtable[b"key%03d" % i] = b"value"
+    with memtable.sparse_index_lock:
+        memtable.flush_tree()
+    for i in range(100):
+        memtable[b"key%03d" % i]
+    cached = memtable.block_cache.usage
+    assert cached > 0
+
+    # only the cache has to give anything back
+    budget.limit = budget.usage()["total"] + RBTREE_ENTRY_OVERHEAD
+    memtable[b"new"] = b"value"
+    assert 0 < memtable.block_cache.usage < cached
+    assert len(memtable.rbtree) == 1
+    assert memtable.stats()["memory_budget.cache_bytes_freed"] > 0
+    assert "memory_budget.flushes" not in memtable.stats()
+
+
+def test_budget_flushes_largest_memtable(tmp_path):
+    budget = MemoryBudget()
+    (tmp_path / "small").mkdir()
+    (tmp_path / "large").mkdir()
+    small = MemTable(tmp_path / "small", memory_budget=budget)
+    large = MemTable(tmp_path / "large", memory_budget=budget)
+    small[b"a"] = b"1"
+    for i in range(10):
+        large[b"key%d" % i] = b"value"
+
+    budget.limit = budget.usage()["total"]
+    small[b"b"] = b"2"
+
+    assert len(large.rbtree) == 0
+    assert large[b"key1"] == b"value"
+    assert len(small.rbtree) == 2
+    assert small.stats()["memory_budget.flushes"] == 1
+
+
+def test_db_memory_budget(tmp_path):
+    budget = MemoryBudget()
+    with DB(tmp_path, memory_budget=budget) as db:
+        db.create_column_family("other")
+        db.put(b"a", b"1")
+        db.put(b"b", b"2", column_family="other")
+        assert budget.usage()["memtable"] == 4 + 2 * RBTREE_ENTRY_OVERHEAD
+
+        db.drop_column_family("other")
+        assert len(budget.memtables) == 1
+
+
+def test_budget_over_with_indexes_and_filters(tmp_path):
+    # the bloom filter of a single segment takes up more than the limit
+    budget = MemoryBudget(limit=70_000)
+    memtable = MemTable(tmp_path, flush_tree_size=20000, memory_budget=budget)
+    for i in range(300):
+        memtable[b"key%04d" % i] = b"v" * 20
+
+    assert budget.usage()["filters"] > budget.limit
+    # small memtables aren't flushed for the little they'd give back
+    assert len(memtable.manifest.segments) == 1
+    assert memtable.stats()["memory_budget.flushes"] == 1
+    assert len(memtable.rbtree) > 0
+
+
+def test_index_and_filter_bytes(tmp_path):
+    def walk(memtable):
+        indexes = list(memtable.iter_sparse_indexes())
+        return (
+            sum(index.index_nbytes for index in indexes),
+            sum(index.filter_nbytes for index in indexes),
+        )
+
+    memtable = MemTable(tmp_path)
+    for i in range(3):
+        memtable[b"key%d" % i] = b"value"
+        memtable.flush_tree()
+    assert (memtable.index_bytes, memtable.filter_bytes) == walk(memtable)
+
+    Compactor(memtable).compact()
+    assert (memtable.index_bytes, memtable.filter_bytes) == walk(memtable)
+
+    # lazily loaded indexes are counted once they're read
+    memtable = MemTable.reconstruct(tmp_path, lazy=True)
+    memtable.wait_for_recovery()
+    assert memtable.index_bytes > 0
+    assert (memtable.index_bytes, memtable.filter_bytes) == walk(memtable)
+
+
+def test_budget_flush_with_concurrent_writers(tmp_path):
+    # each memtable's writes are flushed by the other's writer too
+    budget = MemoryBudget(limit=60000, min_flush_size=1)
+    memtables = []
+    for name in ("first", "second"):
+        (tmp_path / name).mkdir()
+        memtables.append(MemTable(tmp_path / name, memory_budget=budget))
+
+    def put(memtable):
+        for i in range(1000):
+            memtable[b"key%04d" % i] = b"value"
+
+    threads = [threading.Thread(target=put, args=(m,)) for m in memtables]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert memtables[0].stats()["memory_budget.flushes"] > 0
+
+    for name in ("first", "second"):
+        restored = MemTable.reconstruct(tmp_path / name)
+        assert len(list(restored.scan())) == 1000
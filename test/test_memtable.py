@@ -1,6 +1,11 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 
-from lsmtree.memtable import BloomFilter, MemTable, SparseIndex
+from lsmtree import memtable as memtable_module
+from lsmtree.memtable import BloomFilter, MemTable, SparseIndex, prefix_end
+from lsmtree.settings import BLOCK_SIZE
 
 
 def test_enforce_bytes_only(tmp_path):
@@ -42,11 +47,11 @@ def test_flush_tree(tmp_path):
     assert [kv for kv in memtable.wal] == []
     assert len(memtable.rbtree) == 0
     assert memtable.sparse_index is not None
-    assert memtable.sparse_index.entries == [(b"a", (0, 36))]
+    assert memtable.sparse_index.entries == [(b"a", (0, 60))]
     # all of these keys are in the same block so they share an index
-    assert memtable.sparse_index.find(b"a") == (0, 36)
-    assert memtable.sparse_index.find(b"b") == (0, 36)
-    assert memtable.sparse_index.find(b"c") == (0, 36)
+    assert memtable.sparse_index.find(b"a") == (0, 60)
+    assert memtable.sparse_index.find(b"b") == (0, 60)
+    assert memtable.sparse_index.find(b"c") == (0, 60)
 
 
 def test_read_from_sparse_index(tmp_path):
@@ -94,14 +99,60 @@ def test_delete_key(tmp_path):
 
 
 def test_sparse_index_find():
-    index = SparseIndex([("a", 0), ("c", 2), ("e", 4)], segment="fake_path/segment.0")
+    index = SparseIndex(
+        [(b"a", (0, 2)), (b"e", (4, 6)), (b"c", (2, 4))], segment="fake_path/segment.0"
+    )
+
+    assert index.entries == [(b"a", (0, 2)), (b"c", (2, 4)), (b"e", (4, 6))]
+    assert index.find(b"a") == (0, 2)
+    assert index.find(b"b") == (0, 2)
+    assert index.find(b"c") == (2, 4)
+    assert index.find(b"d") == (2, 4)
+    assert index.find(b"e") == (4, 6)
+    assert index.find(b"f") == (4, 6)
+
+
+def test_partitioned_sparse_index(tmp_path):
+    memtable = MemTable(tmp_path, index_partition_entries=2)
+    # one key per block
+    keys = [bytes([i]) * 10 for i in range(1, 8)]
+    for key in keys:
+        memtable[key] = b"x" * BLOCK_SIZE
+    memtable.flush_tree()
 
-    assert index.find("a") == 0
-    assert index.find("b") == 0
-    assert index.find("c") == 2
-    assert index.find("d") == 2
-    assert index.find("e") == 4
-    assert index.find("f") == 4
+    index = memtable.sparse_index
+    assert index.partitioned
+    # 7 blocks in partitions of 2
+    assert len(index.packed) == 4
+    assert index.smallest == keys[0]
+    assert index.largest == keys[-1]
+
+    memtable.block_cache.clear()
+    for key in keys:
+        assert memtable[key] == b"x" * BLOCK_SIZE
+    stats = memtable.stats()
+    # every partition was read once and then served from the cache
+    assert stats["block_cache.misses"] == 4 + 7
+    assert stats["block_cache.hits"] == 3
+
+    assert [k for k, _ in memtable.scan(start=keys[3])] == keys[3:]
+
+    restored_memtable = MemTable.reconstruct(tmp_path)
+    assert restored_memtable.sparse_index.partitioned
+    assert restored_memtable.sparse_index.entries == index.entries
+    assert restored_memtable[keys[4]] == b"x" * BLOCK_SIZE
+
+
+def test_block_cache_hit(tmp_path):
+    memtable = MemTable(tmp_path)
+    memtable[b"a"] = b"a"
+    memtable.flush_tree()
+
+    assert memtable[b"a"] == b"a"
+    assert memtable[b"a"] == b"a"
+    stats = memtable.stats()
+    assert stats["segment.reads"] == 1
+    assert stats["block_cache.hits"] == 1
 
 
 def test_bloom_filter():
@@ -139,3 +190,292 @@ def test_memtable_reconstruct(tmp_path):
     assert restored_memtable[b"foo"] == b"bar"
     assert restored_memtable[b"hello"] == b"world!"
     assert restored_memtable[b"a"] == b"a"
+
+
+def test_snapshot(tmp_path):
+    memtable = MemTable(tmp_path)
+    memtable[b"a"] = b"a1"
+    memtable[b"b"] = b"b1"
+
+    with memtable.snapshot() as snapshot:
+        memtable[b"a"] = b"a2"
+        del memtable[b"b"]
+        memtable[b"c"] = b"c2"
+
+        assert snapshot.get(b"a") == b"a1"
+        assert snapshot.get(b"b") == b"b1"
+        with pytest.raises(KeyError):
+            snapshot.get(b"c")
+
+        memtable.flush_tree()
+        assert snapshot.get(b"a") == b"a1"
+        assert memtable[b"a"] == b"a2"
+        assert list(snapshot.scan()) == [(b"a", b"a1"), (b"b", b"b1")]
+
+    assert memtable.snapshots == []
+    memtable[b"a"] = b"a3"
+    assert memtable.rbtree[b"a"] == [(6, 0, b"a3")]
+
+
+def test_scan(tmp_path):
+    memtable = MemTable(tmp_path)
+    for key in [b"d", b"a", b"c"]:
+        memtable[key] = key
+    memtable.flush_tree()
+    memtable[b"b"] = b"b"
+    memtable[b"c"] = b"c2"
+    del memtable[b"d"]
+
+    assert list(memtable.scan()) == [(b"a", b"a"), (b"b", b"b"), (b"c", b"c2")]
+    assert list(memtable.scan(b"b", b"c")) == [(b"b", b"b")]
+    assert list(memtable.scan(start=b"bb")) == [(b"c", b"c2")]
+
+
+def test_scan_concurrent_flush(tmp_path, monkeypatch):
+    memtable = MemTable(tmp_path)
+    memtable[b"a"] = b"a"
+    memtable.flush_tree()
+    memtable[b"b"] = b"b"
+
+    # a flush that happens once the scan has picked its segments must not take
+    # the RBTree's keys away from it
+    iter_segment_entries = memtable_module.iter_segment_entries
+
+    def flush_first(*args):
+        memtable.flush_tree()
+        return iter_segment_entries(*args)
+
+    monkeypatch.setattr(memtable_module, "iter_segment_entries", flush_first)
+    assert list(memtable.scan()) == [(b"a", b"a"), (b"b", b"b")]
+
+
+def test_scan_prefix(tmp_path):
+    memtable = MemTable(tmp_path, prefix_length=3)
+    # the key range of the first segment includes t02 but its prefix bloom
+    # filter doesn't
+    for tenants in ((b"t01", b"t03"), (b"t02",)):
+        for tenant in tenants:
+            for i in range(3):
+                memtable[tenant + b":%d" % i] = tenant
+        memtable.flush_tree()
+    memtable[b"t01:3"] = b"t01"
+    del memtable[b"t01:0"]
+
+    assert [k for k, _ in memtable.scan_prefix(b"t01")] == [
+        b"t01:1",
+        b"t01:2",
+        b"t01:3",
+    ]
+    skips = memtable.stats()["scan.prefix_skips"]
+    assert [k for k, _ in memtable.scan_prefix(b"t02:1")] == [b"t02:1"]
+    assert memtable.stats()["scan.prefix_skips"] == skips + 1
+    assert list(memtable.scan_prefix(b"t04")) == []
+    # shorter than the prefix length so only key ranges are checked
+    assert len(list(memtable.scan_prefix(b"t"))) == 9
+
+    restored = MemTable.reconstruct(tmp_path, lazy=True, prefix_length=3)
+    assert restored.sparse_index.may_contain_prefix(b"t02")
+    assert not restored.sparse_index.next.may_contain_prefix(b"t02")
+
+
+def test_prefix_end():
+    assert prefix_end(b"ab") == b"ac"
+    assert prefix_end(b"a\xff") == b"b"
+    assert prefix_end(b"\xff\xff") is None
+
+
+def test_memtable_reconstruct_sequence_numbers(tmp_path):
+    memtable = MemTable(tmp_path)
+    memtable[b"foo"] = b"bar"
+    memtable.flush_tree()
+    memtable[b"foo"] = b"baz"
+
+    del memtable
+    restored_memtable = MemTable.reconstruct(tmp_path)
+    assert restored_memtable.last_seq == 2
+    assert restored_memtable[b"foo"] == b"baz"
+
+
+def test_memtable_reconstruct_removes_orphans(tmp_path):
+    memtable = MemTable(tmp_path)
+    memtable[b"foo"] = b"bar"
+    memtable.flush_tree()
+
+    # a flush that didn't make it into the manifest
+    with open(os.path.join(tmp_path, "segment.1"), "wb") as f:
+        f.write(b"partial")
+
+    restored_memtable = MemTable.reconstruct(tmp_path)
+    assert restored_memtable[b"foo"] == b"bar"
+    assert not os.path.exists(os.path.join(tmp_path, "segment.1"))
+    assert restored_memtable.manifest.next_segment == 1
+
+
+def test_memtable_reconstruct_without_manifest(tmp_path):
+    memtable = MemTable(tmp_path)
+    memtable[b"foo"] = b"bar"
+    memtable.flush_tree()
+    memtable[b"hello"] = b"world!"
+    memtable.flush_tree()
+    os.remove(memtable.manifest.segment.path)
+
+    restored_memtable = MemTable.reconstruct(tmp_path)
+    assert restored_memtable.manifest.exists
+    assert restored_memtable.manifest.live_ids() == [0, 1]
+    assert restored_memtable.manifest.get(1).smallest == b"hello"
+    assert restored_memtable[b"foo"] == b"bar"
+    assert restored_memtable[b"hello"] == b"world!"
+
+
+def test_memtable_reconstruct_lazy(tmp_path):
+    memtable = MemTable(tmp_path)
+    for i in range(3):
+        memtable[bytes([i])] = b"val"
+        memtable.flush_tree()
+    memtable[b"wal"] = b"val"
+    memtable[b"wal"] = b"val2"
+
+    restored_memtable = MemTable.reconstruct(tmp_path, lazy=True)
+    assert restored_memtable[b"\x01"] == b"val"
+    assert restored_memtable[b"wal"] == b"val2"
+    assert restored_memtable.current_size_bytes == 7
+    restored_memtable.wait_for_recovery()
+    assert all(index.loaded for index in restored_memtable.iter_sparse_indexes())
+    assert list(restored_memtable.scan(end=b"\x03")) == [
+        (b"\x00", b"val"),
+        (b"\x01", b"val"),
+        (b"\x02", b"val"),
+    ]
+
+
+def test_sparse_index_lazy(tmp_path):
+    memtable = MemTable(tmp_path)
+    memtable[b"b"] = b"b"
+    memtable[b"c"] = b"c"
+    memtable.flush_tree()
+
+    index = SparseIndex.lazy(memtable.manifest.get(0), tmp_path)
+    assert not index.loaded
+    assert not index.in_range(b"a")
+    assert index.in_range(b"b")
+    assert not index.loaded
+    assert b"c" in index.bloomfilter
+    assert index.loaded
+    assert index.find(b"c") == memtable.sparse_index.find(b"c")
+
+
+def test_ttl(tmp_path):
+    memtable = MemTable(tmp_path)
+    now = 1000.0
+    memtable.clock = lambda: now
+
+    memtable[b"a"] = b"forever"
+    memtable.flush_tree()
+    memtable.put(b"a", b"short", ttl=10)
+    memtable.put(b"b", b"long", ttl=100)
+    assert memtable[b"a"] == b"short"
+    assert list(memtable.scan()) == [(b"a", b"short"), (b"b", b"long")]
+
+    now = 1010.0
+    # expired values hide older ones just like a delete
+    with pytest.raises(KeyError):
+        memtable[b"a"]
+    assert memtable[b"b"] == b"long"
+    assert list(memtable.scan()) == [(b"b", b"long")]
+
+    memtable.flush_tree()
+    with pytest.raises(KeyError):
+        memtable[b"a"]
+    assert memtable[b"b"] == b"long"
+    # everything left in the segment expires, so it can be dropped later
+    assert memtable.sparse_index.expires_at == 1100 * 1000
+
+    restored_memtable = MemTable.reconstruct(tmp_path)
+    restored_memtable.clock = lambda: now
+    assert restored_memtable[b"b"] == b"long"
+    with pytest.raises(KeyError):
+        restored_memtable[b"a"]
+
+
+def test_delete_range(tmp_path):
+    memtable = MemTable(tmp_path)
+    for key in (b"a", b"b", b"c", b"d"):
+        memtable[key] = key
+    memtable.flush_tree()
+    memtable[b"c"] = b"c2"
+
+    snapshot = memtable.snapshot()
+    memtable.delete_range(b"b", b"d")
+    memtable[b"c"] = b"c3"
+
+    assert memtable[b"a"] == b"a"
+    with pytest.raises(KeyError):
+        memtable[b"b"]
+    assert memtable[b"c"] == b"c3"
+    assert memtable[b"d"] == b"d"
+    assert list(memtable.scan()) == [(b"a", b"a"), (b"c", b"c3"), (b"d", b"d")]
+    assert snapshot.get(b"b") == b"b"
+    assert [k for k, _ in snapshot.scan()] == [b"a", b"b", b"c", b"d"]
+
+    memtable.flush_tree()
+    # the tombstone widens the key range of the segment
+    assert memtable.sparse_index.smallest == b"b"
+    assert memtable.sparse_index.largest == b"d"
+    with pytest.raises(KeyError):
+        memtable[b"b"]
+    assert memtable[b"c"] == b"c3"
+    assert list(memtable.scan(b"b")) == [(b"c", b"c3"), (b"d", b"d")]
+    assert snapshot.get(b"b") == b"b"
+    snapshot.release()
+
+    restored_memtable = MemTable.reconstruct(tmp_path)
+    assert list(restored_memtable.scan()) == [(b"a", b"a"), (b"c", b"c3"), (b"d", b"d")]
+
+
+def test_delete_range_wal_replay(tmp_path):
+    memtable = MemTable(tmp_path)
+    memtable[b"a"] = b"1"
+    memtable.delete_range(b"a", b"b")
+    memtable[b"aa"] = b"2"
+
+    restored_memtable = MemTable.reconstruct(tmp_path)
+    assert len(restored_memtable.range_tombstones) == 1
+    with pytest.raises(KeyError):
+        restored_memtable[b"a"]
+    assert restored_memtable[b"aa"] == b"2"
+
+
+def test_blob_values(tmp_path):
+    memtable = MemTable(tmp_path, blob_threshold=10)
+    memtable[b"a"] = b"small"
+    memtable[b"b"] = b"large" * 10
+    memtable.flush_tree()
+
+    assert memtable.manifest.blob_files[0].size > 0
+    assert memtable.manifest.get(0).blob_refs == [0]
+    assert memtable.sparse_index.blob_refs == {0}
+    # only the pointer is in the segment
+    assert os.path.getsize(os.path.join(tmp_path, "segment.0")) < 100
+
+    assert memtable[b"a"] == b"small"
+    assert memtable[b"b"] == b"large" * 10
+    assert list(memtable.scan()) == [(b"a", b"small"), (b"b", b"large" * 10)]
+
+    restored_memtable = MemTable.reconstruct(tmp_path)
+    assert restored_memtable[b"b"] == b"large" * 10
+
+
+def test_concurrent_puts_across_flush(tmp_path):
+    memtable = MemTable(tmp_path, flush_tree_size=2000)
+
+    def put(thread):
+        for i in range(400):
+            memtable[b"%d-%03d" % (thread, i)] = b"value"
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(put, range(8)))
+    assert memtable.manifest.segments
+
+    # nothing written while a flush was running is lost
+    restored = MemTable.reconstruct(tmp_path)
+    assert len(list(restored.scan())) == 8 * 400
@@ -0,0 +1,126 @@
+import pytest
+
+from lsmtree.compaction import Compactor
+from lsmtree.db import DB
+from lsmtree.memtable import MemTable
+from lsmtree.merge import (AppendMergeOperator, CounterMergeOperator,
+                           pack_counter, unpack_counter)
+from lsmtree.segment import KIND_MERGE, KIND_VALUE
+
+
+def counter(memtable, key):
+    return unpack_counter(memtable[key])
+
+
+def test_merge_counter(tmp_path):
+    memtable = MemTable(tmp_path, merge_operator=CounterMergeOperator())
+    for _ in range(3):
+        memtable.merge(b"hits", pack_counter(1))
+    assert counter(memtable, b"hits") == 3
+
+    memtable.flush_tree()
+    memtable.merge(b"hits", pack_counter(2))
+    memtable.flush_tree()
+    # merging never reads, the only get so far is the one above
+    assert memtable.stats()["get.count"] == 1
+    memtable.merge(b"hits", pack_counter(-1))
+    assert counter(memtable, b"hits") == 4
+
+    memtable.put(b"base", pack_counter(10))
+    memtable.flush_tree()
+    memtable.merge(b"base", pack_counter(5))
+    assert counter(memtable, b"base") == 15
+    assert list(memtable.scan()) == [
+        (b"base", pack_counter(15)),
+        (b"hits", pack_counter(4)),
+    ]
+
+    # operands after a delete start over
+    del memtable[b"base"]
+    memtable.merge(b"base", pack_counter(1))
+    assert counter(memtable, b"base") == 1
+    memtable.delete_range(b"a", b"z")
+    memtable.merge(b"hits", pack_counter(7))
+    assert counter(memtable, b"hits") == 7
+
+    with pytest.raises(ValueError):
+        MemTable(tmp_path).merge(b"hits", pack_counter(1))
+
+
+def test_merge_collapsed_by_flush_and_compaction(tmp_path):
+    memtable = MemTable(tmp_path, merge_operator=CounterMergeOperator())
+    memtable.put(b"a", pack_counter(1))
+    memtable.merge(b"a", pack_counter(1))
+    memtable.merge(b"a", pack_counter(1))
+    memtable.merge(b"b", pack_counter(1))
+    memtable.flush_tree()
+
+    entries = list(Compactor(memtable).iter_entries(0))
+    # the operands on a are merged into its value, b has nothing to merge into
+    assert [(key, kind) for key, _, kind, _ in entries] == [
+        (b"a", KIND_VALUE),
+        (b"b", KIND_MERGE),
+    ]
+
+    memtable.merge(b"b", pack_counter(2))
+    memtable.flush_tree()
+    Compactor(memtable).compact()
+    entries = list(Compactor(memtable).iter_entries(2))
+    assert [(key, kind) for key, _, kind, _ in entries] == [
+        (b"a", KIND_VALUE),
+        (b"b", KIND_VALUE),
+    ]
+    assert counter(memtable, b"a") == 3
+    assert counter(memtable, b"b") == 3
+
+
+def test_merge_snapshot_and_recovery(tmp_path):
+    memtable = MemTable(tmp_path, merge_operator=AppendMergeOperator())
+    memtable.put(b"list", b"a")
+    with memtable.snapshot() as snapshot:
+        memtable.merge(b"list", b"b")
+        memtable.flush_tree()
+        memtable.merge(b"list", b"c")
+        assert snapshot.get(b"list") == b"a"
+        assert memtable[b"list"] == b"a,b,c"
+
+    restored = MemTable.reconstruct(tmp_path, merge_operator=AppendMergeOperator())
+    assert restored[b"list"] == b"a,b,c"
+
+
+def test_db_merge(tmp_path):
+    operators = {"counters": CounterMergeOperator()}
+    db = DB(tmp_path, merge_operators=operators)
+    db.create_column_family("counters")
+    db.merge(b"x", pack_counter(2), column_family="counters")
+    db.merge(b"x", pack_counter(3), column_family="counters")
+
+    db = DB(tmp_path, merge_operators=operators)
+    assert unpack_counter(db.get(b"x", column_family="counters")) == 5
+
+
+def test_merge_compacted_with_snapshot(tmp_path):
+    memtable = MemTable(tmp_path, merge_operator=CounterMergeOperator())
+    memtable.put(b"hits", pack_counter(100))
+    memtable.flush_tree()
+    memtable.merge(b"hits", pack_counter(1))
+    memtable.flush_tree()
+
+    # the snapshot keeps the operand from being collapsed, the value it
+    # merges into has to be kept with it
+    with memtable.snapshot() as snapshot:
+        Compactor(memtable).compact()
+        assert unpack_counter(snapshot.get(b"hits")) == 101
+    assert counter(memtable, b"hits") == 101
+
+    restored = MemTable.reconstruct(tmp_path, merge_operator=CounterMergeOperator())
+    assert counter(restored, b"hits") == 101
+
+    # without an operator the operands can't be compacted
+    restored.merge(b"hits", pack_counter(1))
+    restored.flush_tree()
+    memtable = MemTable.reconstruct(tmp_path)
+    with pytest.raises(ValueError):
+        Compactor(memtable).compact()
+    restored = MemTable.reconstruct(tmp_path, merge_operator=CounterMergeOperator())
+    assert counter(restored, b"hits") == 102
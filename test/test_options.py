@@ -0,0 +1,39 @@
+import pytest
+
+from lsmtree.compaction import Compactor
+from lsmtree.memtable import MemTable
+from lsmtree.options import Options
+from lsmtree.settings import BLOCK_SIZE
+
+
+def test_options(tmp_path):
+    options = Options(block_size=128, row_cache_size=1024)
+    assert Options.from_dict(options.to_dict()) == options
+    assert options.copy(block_size=256).block_size == 256
+    assert Options().block_size == BLOCK_SIZE
+
+    memtable = MemTable(tmp_path, **options.to_dict())
+    assert memtable.options == options
+    # other memtables keep their own options
+    assert MemTable(tmp_path / "other").options == Options()
+
+
+def test_set_options(tmp_path):
+    memtable = MemTable(tmp_path)
+    memtable.set_options(
+        block_size=64, row_cache_size=1024, tombstone_compaction_ratio=0.1
+    )
+    assert memtable.row_cache.capacity == 1024
+    assert Compactor(memtable).tombstone_ratio == 0.1
+
+    # only segments written from now on use the new block size
+    for i in range(50):
+        memtable[b"k%03d" % i] = b"v" * 10
+    memtable.flush_tree()
+    assert len(memtable.sparse_index.entries) > 1
+
+    memtable.set_options(row_cache_size=0, block_cache_size=0)
+    assert memtable.row_cache is None
+    assert len(memtable.block_cache) == 0
+    with pytest.raises(TypeError):
+        memtable.set_options(not_an_option=1)
@@ -61,3 +61,16 @@ def test_items():
         (4, "4"),
         (5, "5"),
     ]
+
+
+def test_items_range():
+    tree = RBTree()
+    keys = list(range(100))
+    random.shuffle(keys)
+    for k in keys:
+        tree[k] = k
+
+    assert [k for k, _ in tree.items(10, 20)] == list(range(10, 20))
+    assert [k for k, _ in tree.items(start=95)] == list(range(95, 100))
+    assert [k for k, _ in tree.items(end=3)] == [0, 1, 2]
+    assert list(tree.items(50, 50)) == []
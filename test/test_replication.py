@@ -0,0 +1,115 @@
+import socket
+import threading
+import time
+from struct import pack
+
+import pytest
+
+from lsmtree.replication import (HEARTBEAT, MESSAGE_FMT, RECORDS, SEQ_FMT,
+                                 SNAPSHOT, Follower, Primary, StaleReadError,
+                                 send, send_records)
+from lsmtree.segment import Block
+
+
+def test_replication(tmp_path):
+    (tmp_path / "primary").mkdir()
+    primary = Primary(tmp_path / "primary", heartbeat_interval=0.01)
+    memtable = primary.memtable
+    memtable[b"a"] = b"1"
+    memtable[b"b"] = b"2"
+    memtable.put(b"c", b"3", ttl=60)
+    memtable.flush_tree()
+    memtable[b"d"] = b"4"
+    del memtable[b"b"]
+
+    # starts from a copy of what the primary has
+    follower = primary.attach(tmp_path / "follower")
+    assert follower.wait_for(memtable.last_seq, timeout=5)
+    assert list(follower.scan()) == [(b"a", b"1"), (b"c", b"3"), (b"d", b"4")]
+
+    remote = Follower.connect(tmp_path / "remote", primary.listen())
+
+    memtable[b"e"] = b"5"
+    memtable.delete_range(b"a", b"b")
+    with memtable.sparse_index_lock:
+        memtable.flush_tree()
+    memtable[b"f"] = b"6"
+
+    for replica in (follower, remote):
+        assert replica.wait_for(memtable.last_seq, timeout=5)
+        assert list(replica.scan(max_staleness=5)) == list(memtable.scan())
+        with pytest.raises(KeyError):
+            replica[b"a"]
+    # the followers flushed along with the primary
+    assert follower.memtable.sparse_index is not None
+    assert memtable.stats()["replication.records_shipped"] > 0
+
+    follower.close()
+    remote.close()
+    primary.close()
+    with pytest.raises(StaleReadError):
+        follower.get(b"e", max_staleness=0)
+
+
+def test_staleness_under_load(tmp_path):
+    sock, follower_sock = socket.socketpair()
+    follower = Follower(tmp_path / "follower", follower_sock)
+    send(sock, SNAPSHOT, pack(SEQ_FMT, 0))
+
+    # records keep coming but the primary is well ahead of them
+    for seq in range(1, 6):
+        block = Block()
+        block.add(b"key%d" % seq, b"value", seq=seq)
+        send_records(sock, 100, block)
+        assert follower.wait_for(seq, timeout=5)
+        time.sleep(0.01)
+    with pytest.raises(StaleReadError):
+        follower.get(b"key1", max_staleness=0.04)
+
+    block = Block()
+    block.add(b"key100", b"value", seq=100)
+    send_records(sock, 100, block)
+    send(sock, HEARTBEAT, pack(SEQ_FMT, 100))
+    assert follower.wait_for(100, timeout=5)
+    assert follower.get(b"key100", max_staleness=1) == b"value"
+
+    sock.close()
+    follower.close()
+
+
+def test_disconnect_mid_message(tmp_path, monkeypatch):
+    errors = []
+    monkeypatch.setattr(threading, "excepthook", errors.append)
+    sock, follower_sock = socket.socketpair()
+    follower = Follower(tmp_path / "follower", follower_sock)
+    send(sock, SNAPSHOT, pack(SEQ_FMT, 0))
+
+    # the header promises more than is sent before the connection drops
+    message = pack(MESSAGE_FMT, RECORDS, 100) + pack(SEQ_FMT, 1)[:3]
+    sock.sendall(message)
+    sock.close()
+
+    start = time.monotonic()
+    assert not follower.wait_for(1, timeout=5)
+    assert time.monotonic() - start < 5
+    assert follower.disconnected
+    follower.close()
+    assert not errors
+
+
+def test_follower_directory(tmp_path):
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "segment.0").write_bytes(b"important")
+    sock, follower_sock = socket.socketpair()
+    with pytest.raises(ValueError):
+        Follower(tmp_path / "data", follower_sock)
+    assert (tmp_path / "data" / "segment.0").exists()
+
+    # a follower's own directory is emptied and reused
+    follower = Follower(tmp_path / "follower", follower_sock)
+    follower.memtable[b"a"] = b"1"
+    follower.close()
+    follower = Follower(tmp_path / "follower", sock)
+    with pytest.raises(KeyError):
+        follower.memtable[b"a"]
+    follower.close()
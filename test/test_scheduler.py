@@ -0,0 +1,125 @@
+import pytest
+
+from lsmtree.compaction import Compactor
+from lsmtree.events import EventListener
+from lsmtree.memtable import MemTable
+from lsmtree.scheduler import CompactionScheduler, compaction_score
+from lsmtree.stall import CompactionError, WriteController
+
+
+def flush(memtable, *keys):
+    for key in keys:
+        memtable[key] = key
+    memtable.flush_tree()
+
+
+def test_compact_after_flush(tmp_path):
+    memtable = MemTable(tmp_path)
+    scheduler = CompactionScheduler(workers=1)
+    scheduler.register(memtable)
+    scheduler.start()
+
+    flush(memtable, b"a")
+    flush(memtable, b"b")
+    flush(memtable, b"c")
+    scheduler.wait_until_idle()
+    assert compaction_score(memtable) == 1
+    assert [k for k, _ in memtable.scan()] == [b"a", b"b", b"c"]
+
+    scheduler.stop()
+    flush(memtable, b"d")
+    flush(memtable, b"e")
+    # queued up until the scheduler is started again
+    assert compaction_score(memtable) == 3
+    scheduler.start()
+    scheduler.wait_until_idle()
+    assert compaction_score(memtable) == 1
+    scheduler.stop()
+
+
+def test_pause_resume(tmp_path):
+    memtable = MemTable(tmp_path)
+    scheduler = CompactionScheduler(workers=1)
+    scheduler.register(memtable)
+    scheduler.start()
+    scheduler.pause()
+
+    flush(memtable, b"a")
+    flush(memtable, b"b")
+    assert compaction_score(memtable) == 2
+
+    scheduler.resume()
+    scheduler.wait_until_idle()
+    assert compaction_score(memtable) == 1
+    scheduler.stop()
+
+
+def test_compaction_error(tmp_path, monkeypatch, caplog):
+    controller = WriteController(stop_segment_count=2)
+    memtable = MemTable(tmp_path, write_controller=controller)
+    scheduler = CompactionScheduler(workers=1, stats=memtable.statistics)
+    scheduler.register(memtable)
+    scheduler.start()
+    scheduler.pause()
+
+    def fail(self):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(Compactor, "compact", fail)
+    flush(memtable, b"a")
+    flush(memtable, b"b")
+    scheduler.resume()
+    scheduler.wait_until_idle()
+
+    assert isinstance(scheduler.last_error, OSError)
+    assert "Compaction of" in caplog.text
+    assert memtable.stats()["compaction.errors"] == 1
+    # stopped writes fail rather than wait on a compaction that isn't coming
+    scheduler.pause()
+    with pytest.raises(CompactionError):
+        memtable[b"c"] = b"c"
+
+    monkeypatch.undo()
+    # the failed write queued up another try, which works this time
+    scheduler.resume()
+    scheduler.wait_until_idle()
+    assert controller.compaction_error is None
+    memtable[b"c"] = b"c"
+    scheduler.stop()
+
+
+class Recorder(EventListener):
+    def __init__(self, name, order):
+        self.name = name
+        self.order = order
+
+    def on_compaction_begin(self, targets):
+        self.order.append(self.name)
+
+
+def test_priority(tmp_path):
+    order = []
+    (tmp_path / "busy").mkdir()
+    (tmp_path / "quiet").mkdir()
+    busy = MemTable(tmp_path / "busy", listeners=[Recorder("busy", order)])
+    quiet = MemTable(tmp_path / "quiet", listeners=[Recorder("quiet", order)])
+    for i in range(4):
+        flush(busy, bytes([i]))
+    flush(quiet, b"a")
+    flush(quiet, b"b")
+
+    scheduler = CompactionScheduler(workers=1)
+    scheduler.register(quiet)
+    scheduler.register(busy)
+    scheduler.start()
+    scheduler.wait_until_idle()
+    scheduler.stop()
+
+    # busy has the most segments to read through until it's down to 2 as well
+    assert order[:2] == ["busy", "busy"]
+    assert compaction_score(busy) == compaction_score(quiet) == 1
+
+    scheduler.unregister(busy)
+    flush(busy, b"x")
+    assert busy.compaction_scheduler is None
+    assert busy not in scheduler._pending
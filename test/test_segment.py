@@ -1,9 +1,11 @@
 import os
+import zlib
 
 import pytest
 
-from lsmtree.segment import (WAL, Block, BlockCorruption, MaxSizeExceeded,
-                             Segment)
+from lsmtree.segment import (WAL, Block, BlockCorruption, BlockView,
+                             MaxSizeExceeded, Segment, SegmentWriter)
+from lsmtree.stats import Statistics
 
 
 def test_segment_write(tmp_path):
@@ -49,6 +51,53 @@ def test_segment_iter_raw_blocks(tmp_path):
         assert count == 5
 
 
+def test_segment_iter_readahead(tmp_path):
+    blocks = []
+    with Segment(id=0, db_dir=tmp_path) as segment:
+        for i in range(20):
+            block = Block()
+            block.add(b"key%d" % i, bytes(i * 10))
+            blocks.append(block.dump(compress=False))
+            segment.write(blocks[-1])
+
+    stats = Statistics()
+    with Segment(id=0, db_dir=tmp_path, stats=stats) as segment:
+        # readahead smaller than some of the blocks
+        read = [raw for _, _, _, raw in segment.iter_blocks(readahead=64)]
+        assert read == blocks
+        reads = stats.snapshot()["segment.reads"]
+
+        # the whole file fits in the first read
+        offsets = [offset for offset, _, _, _ in segment.iter_blocks()]
+        assert offsets[1] == len(blocks[0])
+        assert stats.snapshot()["segment.reads"] == reads + 1
+
+        read = [raw for _, _, _, raw in segment.iter_data_blocks(drop_cache=True)]
+        assert read == blocks
+        read = [raw for _, _, _, raw in segment.iter_blocks(offsets[5])]
+        assert read == blocks[5:]
+
+
+def test_segment_writer(tmp_path, monkeypatch):
+    fsyncs = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: fsyncs.append(fd) or fsync(fd))
+
+    blocks = []
+    with SegmentWriter(id=0, db_dir=tmp_path, buffer_size=64) as writer:
+        for i in range(10):
+            block = Block()
+            block.add(b"key%d" % i, b"val%d" % i)
+            blocks.append(block.dump())
+            assert writer.write(blocks[-1]) == len(blocks[-1])
+            assert writer.tell_eof == sum(len(b) for b in blocks)
+    assert len(fsyncs) == 1
+
+    with Segment(id=0, db_dir=tmp_path) as segment:
+        assert [raw for _, _, _, raw in segment] == blocks
+        assert segment.tell_eof == writer.tell_eof
+
+
 def test_block_add():
     block = Block()
 
@@ -126,3 +175,114 @@ def test_wal(tmp_path):
     wal.reset()
     results = [item for item in wal]
     assert results == []
+
+
+def test_block_sequence_numbers():
+    block = Block()
+    block.add(b"foo", b"bar", seq=5)
+    block.add(b"foo", b"baz", seq=2)
+    # 8 bytes extra for the sequence number trailer
+    assert len(block) == 2 * (2 + 3 + 8 + 4 + 3)
+
+    with pytest.raises(ValueError):
+        block.add(b"hello", b"world!")
+
+    dump = block.dump()
+    assert [kv for kv in Block.iter_entries_from_binary(dump)] == [
+        (b"foo", 5, 0, b"bar"),
+        (b"foo", 2, 0, b"baz"),
+    ]
+    assert [kv for kv in Block.iter_from_binary(dump)] == [
+        (b"foo", b"bar"),
+        (b"foo", b"baz"),
+    ]
+
+    # blocks without sequence numbers decode with a sequence number of 0
+    block = Block()
+    block.add(b"foo", b"bar")
+    assert [kv for kv in Block.iter_entries_from_binary(block.dump())] == [
+        (b"foo", 0, 0, b"bar")
+    ]
+
+
+def test_wal_iter_batches(tmp_path):
+    wal = WAL(tmp_path)
+    for i in range(5):
+        wal.add(bytes([i]), b"val", seq=i + 1)
+
+    batches = [batch for batch in wal.iter_batches(batch_size=2, read_size=7)]
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert batches[0][0] == (b"\x00", 1, 0, b"val")
+
+    # a torn write at the end of the log is ignored
+    with open(wal.segment.path, "ab") as f:
+        f.write(b"\x40\x00\x00")
+    assert len([entry for entry in wal.iter_entries()]) == 5
+
+
+def test_wal_corruption_before_the_end(tmp_path):
+    wal = WAL(tmp_path)
+    for i in range(3):
+        wal.add(bytes([i]), b"val", seq=i + 1)
+
+    # a bad record at the end is a torn write, anything before it is not
+    with open(wal.segment.path, "r+b") as f:
+        data = f.read()
+        f.seek(len(data) - 1)
+        f.write(b"\x00")
+    assert len(list(wal.iter_entries())) == 2
+
+    wal.add(b"\x03", b"val", seq=4)
+    with pytest.raises(BlockCorruption):
+        list(wal.iter_entries())
+
+
+def test_block_view_offset_table():
+    block = Block()
+    block.add(b"a", b"1", seq=3)
+    block.add(b"b", b"22", seq=5)
+    block.add(b"b", b"2", seq=4)
+    block.add(b"c", b"333", seq=1)
+    dump = block.dump(compress=True, offset_table=True)
+    # 4 offsets plus the count
+    assert len(zlib.decompress(dump[Block.HEADER_SIZE :])) == len(block) + 5 * 4
+
+    view = BlockView.from_binary(dump)
+    assert list(view.offsets) == [0, 16, 33, 49]
+    assert view.key(2) == b"b"
+    assert list(view) == [
+        (b"a", 3, 0, b"1"),
+        (b"b", 5, 0, b"22"),
+        (b"b", 4, 0, b"2"),
+        (b"c", 1, 0, b"333"),
+    ]
+    assert view.find(b"b") == (5, 0, b"22")
+    assert view.find(b"b", seq=4) == (4, 0, b"2")
+    assert view.find(b"b", seq=3) is None
+    assert view.find(b"bb") is None
+    assert view.find(b"c") == (1, 0, b"333")
+
+    # blocks without a table are scanned for their offsets
+    block = Block()
+    block.add(b"a", b"1")
+    block.add(b"b", b"22")
+    view = BlockView.from_binary(block.dump())
+    assert list(view.offsets) == [0, 8]
+    assert view.find(b"b") == (0, 0, b"22")
+
+
+def test_block_view_iter_matches_entries():
+    block = Block()
+    for i in range(100):
+        block.add(bytes([i]) * (i % 7 + 1), b"v" * i, seq=i * 1000)
+
+    for offset_table in (True, False):
+        view = BlockView.from_binary(block.dump(offset_table=offset_table))
+        entries = list(view)
+        assert len(entries) == 100
+        assert entries == [view.entry(i) for i in range(len(view))]
+
+    # iterating doesn't need the offsets of blocks without a table
+    view = BlockView.from_binary(block.dump())
+    assert len(list(iter(view))) == 100
+    assert view._offsets is None
@@ -0,0 +1,129 @@
+import asyncio
+import socket
+import threading
+from struct import pack
+
+import pytest
+
+from lsmtree.client import Client, ServerError
+from lsmtree.memtable import MemTable
+from lsmtree.protocol import (BATCH, ERROR, GET, HEADER_FMT, HEADER_SIZE,
+                              NOT_FOUND, OK, PUT, pack_fields, pack_frame,
+                              unpack_fields, unpack_header)
+from lsmtree.server import Server
+from lsmtree.shard import WriteBatch
+
+
+@pytest.fixture
+def server(tmp_path):
+    memtable = MemTable(tmp_path)
+    server = Server(memtable, workers=2, max_frame_size=1024)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    tcp = asyncio.run_coroutine_threadsafe(server.start_tcp(), loop).result()
+    unix_path = str(tmp_path / "server.sock")
+    asyncio.run_coroutine_threadsafe(server.start_unix(unix_path), loop).result()
+    yield tcp.sockets[0].getsockname()[:2], unix_path
+
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+
+def test_fields():
+    fields = [b"a", None, b"", b"bc"]
+    assert unpack_fields(pack_fields(fields)) == fields
+
+
+def test_client(server):
+    tcp_address, unix_path = server
+    with Client(tcp_address, pool_size=2) as client:
+        client[b"a"] = b"1"
+        client.put(b"b", b"2", ttl=60)
+        assert client[b"a"] == b"1"
+        assert client.get(b"b") == b"2"
+        del client[b"a"]
+        with pytest.raises(KeyError):
+            client[b"a"]
+
+        batch = WriteBatch()
+        for i in range(10):
+            batch.put(b"k%d" % i, b"v%d" % i)
+        batch.delete(b"k5")
+        batch.delete_range(b"k8", b"k9")
+        client.write(batch)
+
+        assert client.multi_get([b"k1", b"k5", b"b"]) == [b"v1", None, b"2"]
+        expected = [b"k%d" % i for i in (0, 1, 2, 3, 4, 6, 7, 9)]
+        assert [k for k, _ in client.scan(b"k", batch_size=3)] == expected
+
+        pipeline = client.pipeline()
+        pipeline.put(b"c", b"3")
+        pipeline.get(b"c")
+        pipeline.get(b"missing")
+        pipeline.multi_get([b"b", b"c"])
+        assert pipeline.execute() == [None, b"3", None, [b"2", b"3"]]
+
+        with pytest.raises(ServerError):
+            client.delete_range(b"a", None)
+
+    # the other process sees the same data over the unix socket
+    with Client(unix_path) as client:
+        assert client[b"c"] == b"3"
+
+
+def test_client_pool(server):
+    tcp_address, _ = server
+    client = Client(tcp_address, pool_size=2)
+
+    def write(n):
+        for i in range(20):
+            client[b"%d-%d" % (n, i)] = b"%d" % i
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert client._pool.qsize() <= 2
+    assert len(list(client.scan())) == 80
+    client.close()
+
+
+def request(sock, frame):
+    sock.sendall(frame)
+    header = b""
+    while len(header) < HEADER_SIZE:
+        header += sock.recv(HEADER_SIZE - len(header))
+    length, request_id, status = unpack_header(header)
+    payload = b""
+    while len(payload) < length:
+        payload += sock.recv(length - len(payload))
+    return request_id, status, unpack_fields(payload)
+
+
+def test_bad_requests(server):
+    tcp_address, _ = server
+    with socket.create_connection(tcp_address) as sock:
+        assert request(sock, pack_frame(1, PUT, [b"a", b"1", None]))[1] == OK
+
+        # an unknown batch op is refused rather than applied as anything else
+        fields = [bytes([PUT]), b"b", b"2", None, bytes([99]), b"a", b"z", None]
+        request_id, status, result = request(sock, pack_frame(2, BATCH, fields))
+        assert (request_id, status) == (2, ERROR)
+        assert b"Unknown batch ops" in result[0]
+        assert request(sock, pack_frame(3, GET, [b"a"]))[1:] == (OK, [b"1"])
+        assert request(sock, pack_frame(4, GET, [b"b"]))[1] == NOT_FOUND
+
+        # a payload that isn't a list of fields
+        malformed = pack(HEADER_FMT, 3, 5, GET) + b"\x01\x02\x03"
+        assert request(sock, malformed)[:2] == (5, ERROR)
+        assert request(sock, pack_frame(6, GET, [b"a"]))[1:] == (OK, [b"1"])
+
+        # a frame over the limit is refused and the connection closed
+        too_large = pack(HEADER_FMT, 1025, 7, GET)
+        assert request(sock, too_large)[:2] == (7, ERROR)
+        assert sock.recv(1) == b""
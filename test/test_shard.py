@@ -0,0 +1,54 @@
+import pytest
+
+from lsmtree.shard import ShardedDB, WriteBatch
+
+
+def test_sharded_db(tmp_path):
+    with ShardedDB(tmp_path, shards=3) as db:
+        batch = WriteBatch()
+        for i in range(100):
+            batch.put(b"%03d" % i, b"v%d" % i)
+        db.write(batch)
+        del db[b"050"]
+        db.delete_range(b"090", b"095")
+
+        assert db[b"001"] == b"v1"
+        with pytest.raises(KeyError):
+            db[b"050"]
+        assert db.multi_get([b"099", b"050", b"000", b"missing"]) == [
+            b"v99",
+            None,
+            b"v0",
+            None,
+        ]
+
+        expected = [b"%03d" % i for i in range(100) if i != 50 and not 90 <= i < 95]
+        assert [k for k, _ in db.scan()] == expected
+        assert [k for k, _ in db.scan(b"010", b"020")] == expected[10:20]
+        stats = db.stats()
+        assert len(stats) == 3
+        assert sum(s.get("get.count", 0) for s in stats) == 6
+
+        scan = db.scan()
+        assert next(scan) == (b"000", b"v0")
+        scan.close()
+        db.flush()
+
+    with ShardedDB(tmp_path, shards=3) as db:
+        assert [k for k, _ in db.scan()] == expected
+
+    with pytest.raises(ValueError):
+        ShardedDB(tmp_path, shards=2)
+
+
+def test_sharded_db_key_ranges(tmp_path):
+    with ShardedDB(tmp_path, split_keys=[b"b", b"d"]) as db:
+        for key in (b"a", b"b", b"c", b"d", b"e"):
+            db[key] = key
+        db.delete_range(b"a", b"c")
+
+        assert db.shard_for(b"a") == 0
+        assert db.shard_for(b"b") == 1
+        assert db.shard_for(b"e") == 2
+        assert list(db.scan()) == [(b"c", b"c"), (b"d", b"d"), (b"e", b"e")]
+        assert list(db.scan(b"c", b"e")) == [(b"c", b"c"), (b"d", b"d")]
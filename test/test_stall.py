@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+from lsmtree.compaction import Compactor
+from lsmtree.memtable import MemTable
+from lsmtree.scheduler import CompactionScheduler
+from lsmtree.stall import NORMAL, SLOWDOWN, STOP, WriteController
+
+
+def test_write_controller_state():
+    controller = WriteController(
+        slowdown_segment_count=2,
+        stop_segment_count=4,
+        slowdown_pending_compaction_bytes=100,
+        stop_pending_compaction_bytes=200,
+        max_delay=1,
+    )
+    assert controller.state == NORMAL
+
+    controller.update(2, 0)
+    assert controller.state == SLOWDOWN
+    assert controller.delay == 0.1
+    controller.update(3, 0)
+    assert controller.delay == 0.5
+    controller.update(3, 190)
+    assert controller.delay == 0.9
+
+    controller.update(1, 200)
+    assert controller.state == STOP
+    controller.update(4, 0)
+    assert controller.state == STOP
+
+
+def test_write_stall(tmp_path):
+    controller = WriteController(
+        slowdown_segment_count=2, stop_segment_count=3, max_delay=0, timeout=0.05
+    )
+    memtable = MemTable(tmp_path, write_controller=controller)
+    # only compactions run in the background stall writes, pausing the
+    # scheduler keeps it from catching up on its own
+    scheduler = CompactionScheduler()
+    scheduler.register(memtable)
+    scheduler.start()
+    scheduler.pause()
+    memtable[b"a"] = b"1"
+    memtable.flush_tree()
+    memtable[b"b"] = b"2"
+    memtable.flush_tree()
+    assert controller.segment_count == 2
+
+    memtable[b"c"] = b"3"
+    assert memtable.stats()["write_stall.slowdowns"] == 1
+    memtable.flush_tree()
+
+    with pytest.raises(TimeoutError):
+        memtable[b"d"] = b"4"
+    assert memtable.stats()["write_stall.stops"] == 1
+
+    # compaction catching up lets the blocked write through
+    controller.timeout = None
+    writer = threading.Thread(target=memtable.put, args=(b"d", b"4"))
+    writer.start()
+    Compactor(memtable).compact()
+    writer.join(timeout=5)
+    assert not writer.is_alive()
+    assert controller.segment_count == 2
+    assert memtable[b"d"] == b"4"
+    scheduler.stop()
+
+    restored_memtable = MemTable.reconstruct(tmp_path, write_controller=controller)
+    assert restored_memtable.write_controller.segment_count == 2
+
+
+def test_no_stall_without_background_compaction(tmp_path):
+    controller = WriteController(slowdown_segment_count=1, stop_segment_count=2)
+    memtable = MemTable(tmp_path, write_controller=controller)
+    # nothing compacts while a write waits, so writes go ahead regardless
+    for i in range(5):
+        memtable[b"%d" % i] = b"value"
+        memtable.flush_tree()
+    assert controller.segment_count == 5
+    assert "write_stall.stops" not in memtable.stats()
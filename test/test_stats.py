@@ -0,0 +1,82 @@
+import io
+import json
+import threading
+
+from lsmtree.compaction import Compactor
+from lsmtree.memtable import MemTable
+from lsmtree.stats import Statistics, StatsDumper
+
+
+def test_statistics_aggregates_threads():
+    stats = Statistics()
+
+    def work():
+        for _ in range(100):
+            stats.incr("foo")
+        stats.incr_segment("bar", 1)
+        stats.record_time("baz", 0.5)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    snapshot = stats.snapshot()
+    assert snapshot["foo"] == 400
+    assert snapshot["bar"] == {1: 4}
+    assert snapshot["baz"] == {"count": 4, "total": 2.0, "avg": 0.5, "max": 0.5}
+    # the counters of the exited threads are folded together
+    assert stats._shards == []
+    assert stats.snapshot() == snapshot
+
+    stats.incr_segment("bar", 2)
+    stats.remove_segments([1])
+    assert stats.snapshot()["bar"] == {2: 1}
+    stats.remove_segments([2])
+    assert "bar" not in stats.snapshot()
+
+    stats.reset()
+    assert stats.snapshot() == {}
+
+
+def test_memtable_stats(tmp_path):
+    memtable = MemTable(tmp_path)
+    memtable[b"a"] = b"a"
+    memtable[b"b"] = b"b"
+    assert memtable[b"a"] == b"a"
+    memtable.flush_tree()
+    memtable[b"c"] = b"c"
+    memtable.flush_tree()
+
+    assert memtable[b"b"] == b"b"
+    stats = memtable.stats()
+    assert stats["get.count"] == 2
+    assert stats["memtable.hits"] == 1
+    # segment 1 is skipped without a bloom filter check since b"b" is outside of
+    # its key range
+    assert stats["bloom.checks"] == {0: 1}
+    assert "bloom.negatives" not in stats
+    assert stats["get.segments_probed"] == 1
+    assert stats["segment.reads"] == 1
+    assert stats["wal.fsync"]["count"] == 3
+    assert stats["flush"]["count"] == 2
+
+    Compactor(memtable).compact()
+    stats = memtable.stats()
+    assert stats["compaction.count"] == 1
+    assert stats["compaction.bytes_in"] > 0
+    assert stats["compaction.bytes_out"] > 0
+    assert stats["write_amplification"] > 1
+    # the compacted segments' counters went with them
+    assert "bloom.checks" not in stats
+
+
+def test_stats_dumper(tmp_path):
+    memtable = MemTable(tmp_path)
+    memtable[b"a"] = b"a"
+    out = io.StringIO()
+    StatsDumper(memtable, out=out).dump()
+
+    record = json.loads(out.getvalue())
+    assert record["stats"]["wal.fsync"]["count"] == 1
@@ -0,0 +1,25 @@
+from lsmtree.tombstones import RangeTombstones
+
+
+def test_range_tombstones_covering():
+    tombstones = RangeTombstones([(b"c", b"f", 5), (b"a", b"d", 3), (b"e", b"g", 9)])
+    assert list(tombstones) == [(b"a", b"d", 3), (b"c", b"f", 5), (b"e", b"g", 9)]
+    assert tombstones.smallest == b"a"
+    assert tombstones.largest == b"g"
+
+    assert tombstones.covering(b"a") == 3
+    assert tombstones.covering(b"c") == 5
+    assert tombstones.covering(b"e") == 9
+    assert tombstones.covering(b"e", seq=8) == 5
+    # ends are exclusive
+    assert tombstones.covering(b"g") == 0
+    assert tombstones.seqs_covering(b"c") == [3, 5]
+
+
+def test_range_tombstones_covers():
+    tombstones = RangeTombstones([(b"a", b"m", 5)])
+    assert tombstones.covers(b"b", b"l", 4)
+    assert not tombstones.covers(b"b", b"m", 4)
+    assert not tombstones.covers(b"b", b"l", 5)
+    # not visible to a snapshot at seq 4
+    assert not tombstones.covers(b"b", b"l", 3, visible_at=4)
@@ -0,0 +1,50 @@
+from lsmtree.memtable import MemTable
+from lsmtree.settings import RBTREE_FLUSH_SIZE
+from lsmtree.tuner import AutoTuner
+
+
+def test_tuner_write_heavy(tmp_path):
+    memtable = MemTable(tmp_path)
+    tuner = AutoTuner(memtable)
+    for i in range(100):
+        memtable[b"key%05d" % i] = b"v" * 100
+    memtable.flush_tree()
+
+    options = memtable.options
+    assert options.flush_tree_size == RBTREE_FLUSH_SIZE * 4
+    assert options.block_size == 64 * 108
+    assert options.bloom_filter_size > 0
+    assert memtable.stats()["tuner.adjustments"] > 0
+
+    # nothing happened since, so nothing changes
+    assert tuner.tune() == {}
+    tuner.close()
+    assert tuner not in memtable.listeners
+
+
+def test_tuner_read_heavy(tmp_path):
+    memtable = MemTable(tmp_path, bloom_filter_size=2, bloom_filter_hashes=1)
+    tuner = AutoTuner(memtable)
+    for i in range(100):
+        memtable[b"key%05d" % i] = b"v" * 100
+    memtable.flush_tree()
+    bits_per_key = tuner.bits_per_key
+
+    # the tiny bloom filter of the first segment has lots of false positives
+    memtable[b"other"] = b"v"
+    for i in range(1000):
+        try:
+            memtable[b"key%05d-" % (i % 100)]
+        except KeyError:
+            pass
+    memtable.flush_tree()
+
+    options = memtable.options
+    assert tuner.bits_per_key > bits_per_key
+    assert options.flush_tree_size < RBTREE_FLUSH_SIZE * 2
+    assert options.block_size == 4096
+    # deletes make tombstones get compacted sooner
+    for i in range(10):
+        del memtable[b"key%05d" % i]
+    memtable.flush_tree()
+    assert memtable.options.tombstone_compaction_ratio < 0.5